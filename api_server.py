@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Local HTTP API for the demand calculation
+Author: Ricky
+
+Exposes load_data / calculate_demand to other systems (e.g. the ERP
+replenishment job) on localhost. Requests are served by a pool of
+pre-warmed worker processes that keep pandas/openpyxl imported and cache
+cleaned File B workbooks by content hash.
+
+Endpoints:
+    POST /analyze   JSON body, see parse_request()
+    GET  /health    worker and queue status
+    GET  /metrics   request latency percentiles and queue depth
+    GET  /runs/<run_id>/dispatch.zip[?format=csv]
+                    per-site DN and buyer order files of a saved run,
+                    streamed to the client as they are rendered
+
+Usage:
+    python api_server.py [--host 127.0.0.1] [--port 8600] [--workers 2]
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from config import Config
+from logging_setup import init_worker_logging, worker_log_queue
+
+SUPPORTED_FORMATS = ('xlsx', 'csv', 'parquet')
+
+# --- 子進程狀態 ---
+_file_b_cache = OrderedDict()
+
+
+def _read_table(fmt, content, key_columns, sheet_name=0):
+    """按格式讀取單一工作表，鍵欄位一律以字串讀入。"""
+    import pandas as pd
+
+    dtype = {col: str for col in key_columns}
+    buffer = io.BytesIO(content)
+    if fmt == 'xlsx':
+        return pd.read_excel(buffer, sheet_name=sheet_name, dtype=dtype)
+    if fmt == 'csv':
+        return pd.read_csv(buffer, dtype=dtype)
+    df = pd.read_parquet(buffer)
+    for col in key_columns:
+        if col in df.columns:
+            df[col] = df[col].astype(str)
+    return df
+
+
+def _require_columns(df, required_cols, label):
+    missing_cols = [col for col in required_cols if col not in df.columns]
+    if missing_cols:
+        raise ValueError(f"{label} 缺少必要欄位：{', '.join(missing_cols)}")
+
+
+def _load_file_b(file_b):
+    """讀取並清理檔案 B；結果按內容雜湊快取於子進程中。"""
+    from app import clean_file_b, find_sheet_name
+
+    key = hashlib.sha256(repr(sorted((k, hashlib.sha256(v).hexdigest()) for k, v in file_b.items())).encode()).hexdigest()
+    if key in _file_b_cache:
+        _file_b_cache.move_to_end(key)
+        return _file_b_cache[key]
+
+    fmt = file_b['format'].decode()
+    if fmt == 'xlsx':
+        import pandas as pd
+        sheet_names = pd.ExcelFile(io.BytesIO(file_b['content'])).sheet_names
+        sheet1_name = find_sheet_name(sheet_names, Config.SHEET1_CANDIDATES)
+        sheet2_name = find_sheet_name(sheet_names, Config.SHEET2_CANDIDATES)
+        if not sheet1_name or not sheet2_name:
+            raise ValueError("檔案 B 必須包含 'Sheet1' (或 'Sheet 1') 和 'Sheet2' (或 'Sheet 2')。")
+        df_b1 = _read_table(fmt, file_b['content'], ['Article'], sheet1_name)
+        df_b2 = _read_table(fmt, file_b['content'], ['Site'], sheet2_name)
+    else:
+        df_b1 = _read_table(fmt, file_b['sheet1'], ['Article'])
+        df_b2 = _read_table(fmt, file_b['sheet2'], ['Site'])
+    _require_columns(df_b1, Config.REQUIRED_COLUMNS_B1, "檔案 B 的 Sheet1")
+    _require_columns(df_b2, Config.REQUIRED_COLUMNS_B2, "檔案 B 的 Sheet2")
+
+    cached = clean_file_b(df_b1, df_b2)
+    _file_b_cache[key] = cached
+    while len(_file_b_cache) > Config.API_FILE_B_CACHE_SIZE:
+        _file_b_cache.popitem(last=False)
+    return cached
+
+
+def _init_worker():
+    """子進程初始化：預先導入函式庫並執行一次小型計算以預熱程式路徑。"""
+    import pandas as pd
+    import openpyxl  # noqa: F401
+    from app import calculate_demand
+
+    sample = pd.DataFrame({col: [0] for col in Config.REQUIRED_COLUMNS_A + Config.REQUIRED_COLUMNS_B1
+                           + Config.REQUIRED_COLUMNS_B2})
+    sample['Notes'] = ''
+    calculate_demand(sample, Config.DEFAULT_LEAD_TIME)
+
+
+def _ping(delay=0.0):
+    time.sleep(delay)
+    return os.getpid()
+
+
+def _analyze(file_a, file_b, lead_time, include_results):
+    """子進程入口：執行一次完整的載入及需求計算，返回 JSON 片段。"""
+    from app import clean_file_a, merge_data, calculate_demand
+
+    df_a = _read_table(file_a['format'].decode(), file_a['content'], ['Article', 'Site'])
+    _require_columns(df_a, Config.REQUIRED_COLUMNS_A, "檔案 A")
+    df_b1, df_b2 = _load_file_b(file_b)
+
+    df_merged = merge_data(clean_file_a(df_a), df_b1, df_b2)
+    results, summary = calculate_demand(df_merged, lead_time)
+    if results.empty and not df_merged.empty:
+        raise RuntimeError("計算需求時發生錯誤，詳情請查看 app.log。")
+    return {
+        'rows': len(results),
+        'summary': summary.to_json(orient='records', force_ascii=False),
+        'results': results.to_json(orient='records', force_ascii=False) if include_results else None,
+    }
+
+
+# --- 主進程 ---
+def _decode_file(spec, label, parts):
+    if not isinstance(spec, dict):
+        raise ValueError(f"缺少 {label}")
+    fmt = str(spec.get('format', 'xlsx')).lower()
+    if fmt not in SUPPORTED_FORMATS:
+        raise ValueError(f"{label} 的格式不支援，僅接受：{', '.join(SUPPORTED_FORMATS)}")
+    decoded = {'format': fmt.encode()}
+    for part in parts(fmt):
+        if part not in spec:
+            raise ValueError(f"{label} 缺少 '{part}'")
+        decoded[part] = base64.b64decode(spec[part])
+    return decoded
+
+
+def parse_request(body):
+    """解析 /analyze 的 JSON 請求。
+
+    {
+        "lead_time": 2.0,
+        "include_results": true,
+        "file_a": {"format": "xlsx" | "csv" | "parquet", "content": "<base64>"},
+        "file_b": {"format": "xlsx", "content": "<base64>"}
+               或 {"format": "csv" | "parquet", "sheet1": "<base64>", "sheet2": "<base64>"}
+    }
+    """
+    payload = json.loads(body)
+    if not isinstance(payload, dict):
+        raise ValueError("請求內容必須為 JSON 物件")
+    file_a = _decode_file(payload.get('file_a'), 'file_a', lambda fmt: ['content'])
+    file_b = _decode_file(payload.get('file_b'), 'file_b',
+                          lambda fmt: ['content'] if fmt == 'xlsx' else ['sheet1', 'sheet2'])
+    try:
+        lead_time = float(payload.get('lead_time', Config.DEFAULT_LEAD_TIME))
+    except (TypeError, ValueError):
+        raise ValueError("lead_time 必須為數字") from None
+    # 與介面滑桿的範圍一致；NaN / inf 不是有效的前置時間
+    if not math.isfinite(lead_time) or not Config.LEAD_TIME_MIN <= lead_time <= Config.LEAD_TIME_MAX:
+        raise ValueError(f"lead_time 必須介於 {Config.LEAD_TIME_MIN} 至 {Config.LEAD_TIME_MAX} 之間")
+    return file_a, file_b, lead_time, bool(payload.get('include_results', True))
+
+
+class ServiceMetrics:
+    """請求計數、延遲百分位數及佇列深度。"""
+
+    def __init__(self, window=None):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window or Config.API_LATENCY_WINDOW)
+        self.requests_total = 0
+        self.errors_total = 0
+        self.rejected_total = 0
+        self.in_flight = 0
+
+    def try_begin(self, capacity):
+        """未達 capacity 時佔用一個位置並返回 True；已滿時計為拒絕並返回 False。檢查及佔用在同一個鎖內完成。"""
+        with self._lock:
+            if self.in_flight >= capacity:
+                self.rejected_total += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def end(self, elapsed, ok):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests_total += 1
+            self.errors_total += 0 if ok else 1
+            self._latencies.append(elapsed)
+
+    def snapshot(self, workers):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            snapshot = {
+                'requests_total': self.requests_total,
+                'errors_total': self.errors_total,
+                'rejected_total': self.rejected_total,
+                'in_flight': self.in_flight,
+                'queue_depth': max(0, self.in_flight - workers),
+                'workers': workers,
+            }
+        for pct in (50, 95, 99):
+            snapshot[f'latency_p{pct}_ms'] = round(float(np.percentile(latencies, pct)), 2) if len(latencies) else None
+        return snapshot
+
+
+class ApiService:
+    """持有預熱的子進程池並執行分析請求。"""
+
+    def __init__(self, workers=None, max_queue=None, run_store=None):
+        self.workers = workers or Config.API_WORKERS
+        self.run_store = run_store
+        self.max_queue = Config.API_MAX_QUEUE if max_queue is None else max_queue
+        self.metrics = ServiceMetrics()
+        context = multiprocessing.get_context(Config.PARALLEL_START_METHOD)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=init_worker_logging,
+                                        initargs=(worker_log_queue(context), _init_worker))
+        self.started_at = time.time()
+
+    def warm_up(self):
+        """啟動所有子進程並等待其完成預熱。"""
+        pids = {future.result() for future in [self.pool.submit(_ping, 0.2) for _ in range(self.workers)]}
+        logging.info(f"API workers ready: {sorted(pids)}")
+        return pids
+
+    def analyze(self, body):
+        """處理一個 /analyze 請求，返回 (HTTP 狀態碼, 回應 bytes)。"""
+        if not self.metrics.try_begin(self.workers + self.max_queue):
+            return 503, _json_bytes({'error': '伺服器忙碌，請稍後再試'})
+
+        start = time.perf_counter()
+        ok = False
+        try:
+            file_a, file_b, lead_time, include_results = parse_request(body)
+            result = self.pool.submit(_analyze, file_a, file_b, lead_time, include_results).result()
+            ok = True
+        except (ValueError, KeyError) as e:
+            return 400, _json_bytes({'error': str(e)})
+        except Exception as e:
+            logging.error(f"API analyze error: {e}", exc_info=True)
+            return 500, _json_bytes({'error': str(e)})
+        finally:
+            self.metrics.end(time.perf_counter() - start, ok)
+
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+        return 200, _json_bytes({
+            'rows': result['rows'],
+            'lead_time': lead_time,
+            'elapsed_ms': elapsed_ms,
+            'summary': json.loads(result['summary']),
+            'results': json.loads(result['results']) if result['results'] is not None else None,
+        })
+
+    def run_results(self, run_id):
+        """讀取分析記錄庫中某次運行的計算結果；運行不存在時返回 None。"""
+        from run_store import RunStore
+
+        if self.run_store is None:
+            self.run_store = RunStore()
+        if self.run_store.get_run(run_id) is None:
+            return None
+        return self.run_store.load_frame(run_id, 'results')
+
+    def health(self):
+        return {'status': 'ok', 'workers': self.workers, 'uptime_s': round(time.time() - self.started_at, 1),
+                'in_flight': self.metrics.in_flight}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _json_bytes(obj):
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'RetailPromotionAPI/1.0'
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if url.path == '/health':
+            self._send(200, _json_bytes(service.health()))
+        elif url.path == '/metrics':
+            self._send(200, _json_bytes(service.metrics.snapshot(service.workers)))
+        elif len(parts) == 3 and parts[0] == 'runs' and parts[2] == 'dispatch.zip':
+            fmt = parse_qs(url.query).get('format', [Config.BULK_EXPORT_FORMAT])[0]
+            self._send_dispatch_archive(parts[1], fmt)
+        else:
+            self._send(404, _json_bytes({'error': 'not found'}))
+
+    def _send_dispatch_archive(self, run_id, fmt):
+        """把派貨檔案 zip 邊生成邊寫入回應 (HTTP/1.0，以關閉連線表示結束)，不在記憶體中保存整個 zip。"""
+        from dispatch_files import write_dispatch_zip
+
+        if fmt not in ('xlsx', 'csv'):
+            self._send(400, _json_bytes({'error': f'不支援的檔案格式：{fmt}'}))
+            return
+        results = self.server.service.run_results(run_id)
+        if results is None:
+            self._send(404, _json_bytes({'error': f'找不到運行 {run_id}'}))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', f'attachment; filename="Dispatch_Files_{run_id}.zip"')
+        self.end_headers()
+        try:
+            write_dispatch_zip(results, self.wfile, fmt=fmt)
+        except Exception as e:
+            # 回應標頭已送出，只能中斷連線；客戶端會收到不完整的 zip
+            logging.error(f"API dispatch archive error for run {run_id}: {e}", exc_info=True)
+
+    def do_POST(self):
+        if self.path != '/analyze':
+            self._send(404, _json_bytes({'error': 'not found'}))
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length > Config.API_MAX_REQUEST_BYTES:
+            self._send(413, _json_bytes({'error': '請求內容過大'}))
+            return
+        self._send(*self.server.service.analyze(self.rfile.read(length)))
+
+    def log_message(self, format, *args):
+        logging.info(f"API {self.address_string()} {format % args}")
+
+
+def create_server(service, host=None, port=None):
+    """建立綁定在本機的 HTTP 伺服器；port 為 0 時由系統分配。"""
+    server = ThreadingHTTPServer((host or Config.API_HOST, Config.API_PORT if port is None else port),
+                                 ApiRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local HTTP API for the demand calculation')
+    parser.add_argument('--host', default=Config.API_HOST)
+    parser.add_argument('--port', type=int, default=Config.API_PORT)
+    parser.add_argument('--workers', type=int, default=Config.API_WORKERS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format=Config.LOG_FORMAT)
+    service = ApiService(workers=args.workers)
+    service.warm_up()
+    server = create_server(service, args.host, args.port)
+    logging.info(f"API listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,31 @@ import pandas as pd
 import numpy as np
 import openpyxl
 import matplotlib.pyplot as plt
-import seaborn as sns
 import logging
 from datetime import datetime
+import contextvars
 import io
-
-# --- 日誌記錄設置 ---
-logging.basicConfig(filename='app.log', level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+import os
+import time
+import zipfile
+
+from config import Config
+from jobs import JobManager, JobLimitError, Job
+from parallel_demand import calculate_demand_parallel
+from run_store import RunStore, file_hash
+from delta_demand import calculate_demand_delta
+from results_grid import ResultsGrid
+from ingest import read_files_a
+from charts import plot_heatmap, plot_sku_bars
+from logging_setup import setup_logging, log_stage
+from session_store import SessionStore
+from dataset_store import DatasetStore, dataset_key
+from dispatch_files import dispatch_archive_bytes
+from sparse_matrix import SiteArticleMatrix
+from sales_history import HISTORY_RATE_COLUMN, SalesHistory
+from campaigns import export_campaign_comparison, run_campaigns
+import metrics
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # --- 函數定義 ---
 def find_sheet_name(sheet_names, candidates):
@@ -20,457 +37,1230 @@ def find_sheet_name(sheet_names, candidates):
             return name
     return None
 
-def load_data(file_a, file_b):
-    """載入、驗證、清理並合併兩個上傳的 Excel 檔案。"""
+def report_progress(progress_callback, progress, message):
+    """向背景作業回報階段進度；未提供回呼時不做任何事。"""
+    if progress_callback is not None:
+        progress_callback(progress, message)
+
+def progress_range(progress_callback, start, end):
+    """把子步驟的 0-100 進度映射到整體進度的 start-end 區間。"""
+    if progress_callback is None:
+        return None
+    return lambda progress, message: progress_callback(start + (end - start) * progress / 100, message)
+
+# 背景作業中 Streamlit 元素無法顯示，載入函數的錯誤及警告改為收集後交由頁面顯示
+_load_notices = contextvars.ContextVar('load_notices', default=None)
+
+def notify(level, message):
+    """顯示載入過程的錯誤或警告；在 run_load 作業中則記錄為 (level, message)。"""
+    notices = _load_notices.get()
+    if notices is None:
+        getattr(st, level)(message)
+    else:
+        notices.append((level, message))
+
+def _file_name(file):
+    if isinstance(file, (str, os.PathLike)):
+        return os.fspath(file)
+    return getattr(file, 'name', None)
+
+def _file_size(file):
+    if isinstance(file, (str, os.PathLike)):
+        return os.path.getsize(file)
+    if hasattr(file, 'size'):
+        return file.size
+    if hasattr(file, 'getbuffer'):
+        return file.getbuffer().nbytes
+    return None
+
+def read_workbook_headers(file):
+    """只讀取工作表名稱及各工作表的首行，不解析整個活頁簿。"""
+    position = file.tell() if hasattr(file, 'tell') else None
     try:
-        # --- 檔案 A 處理 ---
-        df_a = pd.read_excel(file_a, sheet_name=0, dtype={'Article': str, 'Site': str})
-        required_cols_a = [
-            'Article', 'Article Description', 'RP Type', 'Site', 'MOQ', 
-            'SaSa Net Stock', 'Pending Received', 'Safety Stock', 
-            'Last Month Sold Qty', 'MTD Sold Qty', 'Supply source', 'Description p. group'
-        ]
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            headers = {}
+            for sheet in workbook.worksheets:
+                first_row = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+                headers[sheet.title] = [value for value in first_row if value is not None]
+            return headers
+        finally:
+            workbook.close()
+    finally:
+        if position is not None:
+            file.seek(position)
+
+def _as_file_list(file_a):
+    """檔案 A 可為單一檔案或多個地區檔案的列表。"""
+    return list(file_a) if isinstance(file_a, (list, tuple)) else [file_a]
+
+def _file_a_labels(files_a):
+    if len(files_a) == 1:
+        return ["檔案 A"]
+    return [f"檔案 A ({_file_name(file) or i + 1})" for i, file in enumerate(files_a)]
+
+def preflight_check(file_a, file_b):
+    """在完整解析前快速檢查檔案類型、大小、工作表及表頭，返回錯誤訊息列表。"""
+    errors = []
+    headers = {}
+    files_a = _as_file_list(file_a)
+    labels_a = _file_a_labels(files_a)
+    for label, file in list(zip(labels_a, files_a)) + [("檔案 B", file_b)]:
+        name = _file_name(file)
+        if name and os.path.splitext(name)[1].lstrip('.').lower() not in Config.SUPPORTED_FILE_TYPES:
+            errors.append(f"{label} 的檔案類型不支援，僅接受：{', '.join(Config.SUPPORTED_FILE_TYPES)}")
+            continue
+        size = _file_size(file)
+        if size is not None and size > Config.MAX_FILE_SIZE_BYTES:
+            errors.append(f"{label} 超過檔案大小上限 ({size / 1024 / 1024:.1f} MB > {Config.MAX_FILE_SIZE_MB} MB)")
+            continue
+        if not zipfile.is_zipfile(file):
+            errors.append(f"{label} 不是有效的 Excel (.xlsx) 檔案")
+            continue
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        headers[label] = read_workbook_headers(file)
+
+    for label in labels_a:
+        if label not in headers:
+            continue
+        sheets_a = list(headers[label].values())
+        columns_a = sheets_a[0] if sheets_a else []
+        missing_cols = [col for col in Config.REQUIRED_COLUMNS_A if col not in columns_a]
+        if missing_cols:
+            errors.append(f"{label} 缺少必要欄位：{', '.join(missing_cols)}")
+
+    if "檔案 B" in headers:
+        sheets_b = headers["檔案 B"]
+        sheet1_name = find_sheet_name(list(sheets_b), Config.SHEET1_CANDIDATES)
+        sheet2_name = find_sheet_name(list(sheets_b), Config.SHEET2_CANDIDATES)
+        if not sheet1_name or not sheet2_name:
+            errors.append("檔案 B 必須包含 'Sheet1' (或 'Sheet 1') 和 'Sheet2' (或 'Sheet 2')。")
+        else:
+            for sheet_name, required_cols in ((sheet1_name, Config.REQUIRED_COLUMNS_B1),
+                                              (sheet2_name, Config.REQUIRED_COLUMNS_B2)):
+                missing_cols = [col for col in required_cols if col not in sheets_b[sheet_name]]
+                if missing_cols:
+                    errors.append(f"檔案 B 的 {sheet_name} 缺少必要欄位：{', '.join(missing_cols)}")
+    return errors
+
+def clean_file_a(df_a):
+    """清理檔案 A：去除空格，修正無效、負數及異常的數值，並記錄於 Notes 欄位。"""
+    df_a['Notes'] = ''
+
+    # 清理字串欄位
+    for col in ['Article', 'Site']:
+        if col in df_a.columns:
+            df_a[col] = df_a[col].str.strip()
+
+    # 處理數值欄位
+    numeric_cols_a = ['MOQ', 'SaSa Net Stock', 'Pending Received', 'Safety Stock', 'Last Month Sold Qty', 'MTD Sold Qty']
+    for col in numeric_cols_a:
+        if col in df_a.columns:
+            df_a['Notes'] += np.where(pd.to_numeric(df_a[col], errors='coerce').isnull(), f'{col} 包含無效值; ', '')
+            df_a[col] = pd.to_numeric(df_a[col], errors='coerce').fillna(0).astype(int)
+            df_a['Notes'] += np.where(df_a[col] < 0, f'{col} 修正為 0; ', '')
+            df_a[col] = np.where(df_a[col] < 0, 0, df_a[col])
+
+    # 處理銷量異常
+    if 'Last Month Sold Qty' in df_a.columns:
+        df_a['Notes'] += np.where(df_a['Last Month Sold Qty'] > 100000, '銷量異常調整; ', '')
+        df_a['Last Month Sold Qty'] = np.where(df_a['Last Month Sold Qty'] > 100000, 100000, df_a['Last Month Sold Qty'])
+    return df_a
+
+def clean_file_b(df_b1, df_b2):
+    """清理檔案 B 兩個工作表的鍵欄位。"""
+    if 'Article' in df_b1.columns:
+        df_b1['Article'] = df_b1['Article'].str.strip()
+    if 'Site' in df_b2.columns:
+        df_b2['Site'] = df_b2['Site'].str.strip()
+    return df_b1, df_b2
+
+def merge_data(df_a, df_b1, df_b2):
+    """合併已清理的檔案 A 與檔案 B，並填充未匹配產生的空值。"""
+    df_merged = pd.merge(df_a, df_b1, on='Article', how='left')
+    df_merged = pd.merge(df_merged, df_b2, on='Site', how='left')
+
+    # 填充合併後產生的 NaN
+    fill_cols = list(df_b1.columns) + list(df_b2.columns)
+    fill_cols = [c for c in fill_cols if c not in ['Article', 'Site']]
+
+    for col in fill_cols:
+        if col in df_merged.columns:
+            if pd.api.types.is_numeric_dtype(df_merged[col]):
+                df_merged[col] = df_merged[col].fillna(0)
+            else:
+                df_merged[col] = df_merged[col].fillna('')
+
+    if 'Group No.' in df_merged.columns:
+         df_merged['Notes'] += np.where(df_merged['Group No.'].fillna('') == '', '未匹配到推廣目標; ', '')
+    return df_merged
+
+def read_file_b(file_b, progress_callback=None):
+    """讀取、驗證並清理檔案 B 的兩個工作表，返回 (df_b1, df_b2)；驗證失敗時返回 None。"""
+    xls_b = pd.ExcelFile(file_b)
+    sheet_names_b = xls_b.sheet_names
+
+    sheet1_name = find_sheet_name(sheet_names_b, Config.SHEET1_CANDIDATES)
+    sheet2_name = find_sheet_name(sheet_names_b, Config.SHEET2_CANDIDATES)
+
+    if not sheet1_name or not sheet2_name:
+        notify("error", "檔案 B 必須包含 'Sheet1' (或 'Sheet 1') 和 'Sheet2' (或 'Sheet 2')。")
+        return None
+
+    df_b1 = pd.read_excel(xls_b, sheet1_name, dtype={'Article': str})
+    required_cols_b1 = Config.REQUIRED_COLUMNS_B1
+    if not all(col in df_b1.columns for col in required_cols_b1):
+        missing_cols = [col for col in required_cols_b1 if col not in df_b1.columns]
+        notify("error", f"檔案 B 的 {sheet1_name} 缺少必要欄位：{', '.join(missing_cols)}")
+        return None
+
+    df_b2 = pd.read_excel(xls_b, sheet2_name, dtype={'Site': str})
+    required_cols_b2 = Config.REQUIRED_COLUMNS_B2
+    if not all(col in df_b2.columns for col in required_cols_b2):
+        missing_cols = [col for col in required_cols_b2 if col not in df_b2.columns]
+        notify("error", f"檔案 B 的 {sheet2_name} 缺少必要欄位：{', '.join(missing_cols)}")
+        return None
+
+    # --- 數據清理與預處理 ---
+    report_progress(progress_callback, 60, "清理數據...")
+    return clean_file_b(df_b1, df_b2)
+
+def load_cleaned(dataset_store, kinds, file, build):
+    """讀取並清理一個上傳檔案，返回 build() 生成的數據框元組 (失敗時為 None)。
+
+    啟用數據快照時，相同內容的檔案只解析一次，其後由同一主機上的任何進程直接映射開啟。
+    """
+    if dataset_store is None:
+        return build()
+    digest = file_hash(file)
+    return dataset_store.load_or_build([dataset_key(kind, digest) for kind in kinds], build)
+
+def load_file_a(files_a, dataset_store=None):
+    """讀取並清理一個或多個檔案 A，返回合併後的數據框；驗證失敗時返回 None。"""
+    if len(files_a) > 1:
+        df_a, duplicates = read_files_a(files_a, _file_a_labels(files_a), dataset_store=dataset_store)
+        if duplicates:
+            notify("warning", f"多個檔案 A 之間有 {duplicates} 行重複的 (Article, Site)，已保留先上傳檔案中的記錄。")
+        return df_a
+
+    def read_file_a():
+        df_a = pd.read_excel(files_a[0], sheet_name=0, dtype={'Article': str, 'Site': str})
+        required_cols_a = Config.REQUIRED_COLUMNS_A
         if not all(col in df_a.columns for col in required_cols_a):
             missing_cols = [col for col in required_cols_a if col not in df_a.columns]
-            st.error(f"檔案 A 缺少必要欄位：{', '.join(missing_cols)}")
-            return None, None
+            notify("error", f"檔案 A 缺少必要欄位：{', '.join(missing_cols)}")
+            return None
+        return (clean_file_a(df_a),)
 
-        # --- 檔案 B 處理 ---
-        xls_b = pd.ExcelFile(file_b)
-        sheet_names_b = xls_b.sheet_names
+    frames = load_cleaned(dataset_store, ['file_a'], files_a[0], read_file_a)
+    return None if frames is None else frames[0]
 
-        sheet1_name = find_sheet_name(sheet_names_b, ['Sheet1', 'Sheet 1'])
-        sheet2_name = find_sheet_name(sheet_names_b, ['Sheet2', 'Sheet 2'])
+def load_data(file_a, file_b, progress_callback=None):
+    """載入、驗證、清理並合併兩個上傳的 Excel 檔案。
 
-        if not sheet1_name or not sheet2_name:
-            st.error("檔案 B 必須包含 'Sheet1' (或 'Sheet 1') 和 'Sheet2' (或 'Sheet 2')。")
-            return None, None
-        
-        df_b1 = pd.read_excel(xls_b, sheet1_name, dtype={'Article': str})
-        required_cols_b1 = ['Group No.', 'Article', 'SKU Target', 'Target Type', 'Promotion Days', 'Target Cover Days']
-        if not all(col in df_b1.columns for col in required_cols_b1):
-            missing_cols = [col for col in required_cols_b1 if col not in df_b1.columns]
-            st.error(f"檔案 B 的 {sheet1_name} 缺少必要欄位：{', '.join(missing_cols)}")
-            return None, None
+    file_a 可為多個地區 (例如 HK、MO) 的庫存檔案列表，會被平行解析後合併。
+    """
+    start = time.perf_counter()
+    try:
+        # --- 預檢：只讀取表頭，格式錯誤的檔案無需完整解析 ---
+        if Config.ENABLE_FILE_VALIDATION:
+            report_progress(progress_callback, 2, "檢查檔案格式...")
+            errors = preflight_check(file_a, file_b)
+            if errors:
+                for error in errors:
+                    notify("error", error)
+                return None, None
 
-        df_b2 = pd.read_excel(xls_b, sheet2_name, dtype={'Site': str})
-        required_cols_b2 = ['Site', 'Shop Target(HK)', 'Shop Target(MO)', 'Shop Target(ALL)']
-        if not all(col in df_b2.columns for col in required_cols_b2):
-            missing_cols = [col for col in required_cols_b2 if col not in df_b2.columns]
-            st.error(f"檔案 B 的 {sheet2_name} 缺少必要欄位：{', '.join(missing_cols)}")
+        # --- 檔案 A 處理 ---
+        report_progress(progress_callback, 5, "讀取檔案 A...")
+        files_a = _as_file_list(file_a)
+        dataset_store = get_dataset_store() if Config.DATASET_STORE_ENABLED else None
+        df_a = load_file_a(files_a, dataset_store)
+        if df_a is None:
             return None, None
 
-        # --- 數據清理與預處理 ---
-        df_a['Notes'] = ''
-        
-        # 清理字串欄位
-        for col in ['Article', 'Site']:
-            if col in df_a.columns:
-                df_a[col] = df_a[col].str.strip()
-        if 'Article' in df_b1.columns:
-            df_b1['Article'] = df_b1['Article'].str.strip()
-        if 'Site' in df_b2.columns:
-            df_b2['Site'] = df_b2['Site'].str.strip()
-
-        # 處理數值欄位
-        numeric_cols_a = ['MOQ', 'SaSa Net Stock', 'Pending Received', 'Safety Stock', 'Last Month Sold Qty', 'MTD Sold Qty']
-        for col in numeric_cols_a:
-            if col in df_a.columns:
-                df_a['Notes'] += np.where(pd.to_numeric(df_a[col], errors='coerce').isnull(), f'{col} 包含無效值; ', '')
-                df_a[col] = pd.to_numeric(df_a[col], errors='coerce').fillna(0).astype(int)
-                df_a['Notes'] += np.where(df_a[col] < 0, f'{col} 修正為 0; ', '')
-                df_a[col] = np.where(df_a[col] < 0, 0, df_a[col])
-
-        # 處理銷量異常
-        if 'Last Month Sold Qty' in df_a.columns:
-            df_a['Notes'] += np.where(df_a['Last Month Sold Qty'] > 100000, '銷量異常調整; ', '')
-            df_a['Last Month Sold Qty'] = np.where(df_a['Last Month Sold Qty'] > 100000, 100000, df_a['Last Month Sold Qty'])
+        # --- 檔案 B 處理 ---
+        report_progress(progress_callback, 40, "讀取檔案 B...")
+        frames = load_cleaned(dataset_store, ['file_b1', 'file_b2'], file_b,
+                              lambda: read_file_b(file_b, progress_callback))
+        if frames is None:
+            return None, None
+        df_b1, df_b2 = frames
 
         # --- 合併數據 ---
-        df_merged = pd.merge(df_a, df_b1, on='Article', how='left')
-        df_merged = pd.merge(df_merged, df_b2, on='Site', how='left')
-
-        # 填充合併後產生的 NaN
-        fill_cols = list(df_b1.columns) + list(df_b2.columns)
-        fill_cols = [c for c in fill_cols if c not in ['Article', 'Site']]
-        
-        for col in fill_cols:
-            if col in df_merged.columns:
-                if pd.api.types.is_numeric_dtype(df_merged[col]):
-                    df_merged[col] = df_merged[col].fillna(0)
-                else:
-                    df_merged[col] = df_merged[col].fillna('')
-        
-        if 'Group No.' in df_merged.columns:
-             df_merged['Notes'] += np.where(df_merged['Group No.'].fillna('') == '', '未匹配到推廣目標; ', '')
-
+        report_progress(progress_callback, 80, "合併數據...")
+        df_merged = merge_data(df_a, df_b1, df_b2)
+
+        report_progress(progress_callback, 100, "資料載入完成")
+        elapsed = time.perf_counter() - start
+        logging.info("Input files loaded", extra={
+            'stage': 'load', 'file_a_count': len(files_a), 'file_a_rows': len(df_a), 'merged_rows': len(df_merged),
+            'duration_seconds': round(elapsed, 3),
+        })
+        metrics.observe('load_duration_seconds', elapsed)
+        metrics.inc('load_rows_total', len(df_a), file='a')
+        metrics.inc('load_rows_total', len(df_b1) + len(df_b2), file='b')
+        metrics.set_gauge('load_rows_per_second', len(df_a) / elapsed if elapsed > 0 else 0)
         return df_merged, None
 
     except Exception as e:
-        st.error(f"處理檔案時發生錯誤：{e}")
+        metrics.inc('load_errors_total')
+        notify("error", f"處理檔案時發生錯誤：{e}")
         logging.error(f"File processing error: {e}", exc_info=True)
         return None, None
 
-def calculate_demand(df, lead_time):
-    """計算推廣貨量需求。"""
-    try:
-        if df is None or df.empty:
-            return pd.DataFrame(), pd.DataFrame()
-
-        # 複製數據框以避免修改原始數據
-        df_calc = df.copy()
-
-        # 1. 計算每日銷售率
-        df_calc['Daily Sales Rate'] = (df_calc['Last Month Sold Qty'] / 30).apply(lambda x: max(0, x))
-
-        # 2. 確定推廣目標係數
-        df_calc['Site Target %'] = df_calc.apply(
-            lambda row: row['Shop Target(HK)'] if row['Target Type'] == 'HK'
-            else (row['Shop Target(MO)'] if row['Target Type'] == 'MO'
-                  else (row['Shop Target(ALL)'] if row['Target Type'] == 'ALL' else 0)),
-            axis=1
-        )
-
-        # 3. 計算日常銷售需求
-        df_calc['Regular Demand'] = df_calc['Daily Sales Rate'] * (df_calc['Target Cover Days'] + lead_time)
-
-        # 4. 計算推廣特定需求
-        df_calc['Promo Demand'] = df_calc['SKU Target'] * df_calc['Site Target %']
-
-        # 5. 計算總需求
-        # 對於多 SKU 組，需要先聚合
-        group_sku_counts = df_calc.groupby('Group No.')['Article'].nunique()
-        multi_sku_groups = group_sku_counts[group_sku_counts > 1].index
-
-        # 初始化 Total Demand
-        df_calc['Total Demand'] = 0
-
-        # 單 SKU 組
-        single_sku_mask = ~df_calc['Group No.'].isin(multi_sku_groups)
-        df_calc.loc[single_sku_mask, 'Total Demand'] = df_calc.loc[single_sku_mask, 'Regular Demand'] + df_calc.loc[single_sku_mask, 'Promo Demand']
-
-        # 多 SKU 組
-        if not multi_sku_groups.empty:
-            # 按 Group No. 和 Site 聚合 Regular Demand
-            agg_regular_demand = df_calc[df_calc['Group No.'].isin(multi_sku_groups)].groupby(['Group No.', 'Site'])['Regular Demand'].sum().reset_index()
-            agg_regular_demand.rename(columns={'Regular Demand': 'Aggregated Regular Demand'}, inplace=True)
-
-            # 將聚合後的需求合併回主數據框
-            df_calc = pd.merge(df_calc, agg_regular_demand, on=['Group No.', 'Site'], how='left')
-            df_calc['Aggregated Regular Demand'].fillna(0, inplace=True)
-
-            # 計算多 SKU 組的 Total Demand
-            multi_sku_mask = df_calc['Group No.'].isin(multi_sku_groups)
-            df_calc.loc[multi_sku_mask, 'Total Demand'] = df_calc.loc[multi_sku_mask, 'Aggregated Regular Demand'] + df_calc.loc[multi_sku_mask, 'Promo Demand']
-            df_calc.drop(columns=['Aggregated Regular Demand'], inplace=True)
+def _load_in_job(load, *args, **kwargs):
+    """在背景作業中執行載入函數，收集其錯誤及警告；載入失敗時拋出例外讓作業標記為失敗。
 
+    返回 (載入函數的返回值, [(level, message)])。
+    """
+    notices = []
+    token = _load_notices.set(notices)
+    try:
+        loaded = load(*args, **kwargs)
+    finally:
+        _load_notices.reset(token)
+    if loaded[0] is None:
+        raise ValueError("\n".join(message for level, message in notices if level == "error")
+                         or "檔案載入失敗，詳情請查看 app.log。")
+    return loaded, notices
+
+def run_load(file_a, file_b, progress_callback=None):
+    """背景作業入口：執行 load_data，驗證失敗時拋出例外讓作業標記為失敗。
+
+    返回 {'merged': 合併數據, 'notices': [(level, message)]}，notices 為載入時的警告。
+    """
+    (df_merged, _), notices = _load_in_job(load_data, file_a, file_b, progress_callback=progress_callback)
+    return {'merged': df_merged, 'notices': notices}
+
+def campaign_labels(files_b):
+    """以檔案名稱 (不含副檔名) 作為推廣方案名稱，重複時加上序號。"""
+    labels = []
+    for i, file in enumerate(files_b):
+        name = _file_name(file)
+        label = os.path.splitext(os.path.basename(name))[0] if name else f"方案 {i + 1}"
+        base, suffix = label, 1
+        while label in labels:
+            suffix += 1
+            label = f"{base} ({suffix})"
+        labels.append(label)
+    return labels
+
+def load_campaign_data(file_a, files_b, progress_callback=None):
+    """載入一份庫存快照 (檔案 A) 及多個推廣方案的檔案 B；檔案 A 只解析及清理一次。
+
+    返回 (df_a, [(方案名稱, df_b1, df_b2)])；任何檔案驗證失敗時返回 (None, None)。
+    """
+    try:
+        labels = campaign_labels(files_b)
+        if Config.ENABLE_FILE_VALIDATION:
+            report_progress(progress_callback, 2, "檢查檔案格式...")
+            errors = [error.replace("檔案 B", f"檔案 B ({label})")
+                      for label, file_b in zip(labels, files_b) for error in preflight_check(file_a, file_b)]
+            errors = list(dict.fromkeys(errors))
+            if errors:
+                for error in errors:
+                    notify("error", error)
+                return None, None
+
+        report_progress(progress_callback, 5, "讀取檔案 A...")
+        dataset_store = get_dataset_store() if Config.DATASET_STORE_ENABLED else None
+        df_a = load_file_a(_as_file_list(file_a), dataset_store)
+        if df_a is None:
+            return None, None
 
-        # 6. 計算淨需求
-        df_calc['Net Demand'] = df_calc['Total Demand'] - (df_calc['SaSa Net Stock'] + df_calc['Pending Received']) + df_calc['Safety Stock']
+        campaigns = []
+        for i, (label, file_b) in enumerate(zip(labels, files_b)):
+            report_progress(progress_callback, 40 + int(60 * i / len(files_b)), f"讀取檔案 B ({label})...")
+            frames = load_cleaned(dataset_store, ['file_b1', 'file_b2'], file_b, lambda: read_file_b(file_b))
+            if frames is None:
+                return None, None
+            campaigns.append((label, *frames))
+        return df_a, campaigns
 
-        # 7. 計算派貨建議
-        # 新邏輯: 派貨數量需為 MOQ 的倍數，且不小於 MOQ
-        
-        # 步驟 1: 確定基礎派貨量，至少為 Net Demand 和 MOQ 中的較大者
-        base_dispatch_qty = np.maximum(df_calc['Net Demand'], df_calc['MOQ'])
-        
-        # 步驟 2: 將基礎派貨量向上取整至 MOQ 的最接近倍數
-        moq = df_calc['MOQ']
-        # 為避免除以零的錯誤，只在 MOQ > 0 時執行計算
-        final_dispatch_qty = np.where(
-            moq > 0,
-            np.ceil(base_dispatch_qty / moq) * moq,
-            base_dispatch_qty # 若 MOQ 為 0，則回退到基礎派貨量
-        )
-        
-        # 步驟 3: 僅對 RP Type 為 'RF' 的項目應用此邏輯
-        df_calc['Suggested Dispatch Qty'] = np.where(
-            df_calc['RP Type'] == 'RF',
-            final_dispatch_qty,
-            0
-        )
-        
-        # 步驟 4: 清理數據，確保為非負整數
-        df_calc['Suggested Dispatch Qty'] = df_calc['Suggested Dispatch Qty'].clip(lower=0).fillna(0).astype(int)
+    except Exception as e:
+        metrics.inc('load_errors_total')
+        notify("error", f"處理檔案時發生錯誤：{e}")
+        logging.error(f"Campaign file processing error: {e}", exc_info=True)
+        return None, None
 
-        # 8. 確定派貨類型
-        df_calc['Dispatch Type'] = np.where(
-            df_calc['Site'] == 'D001',
-            'D001',
+def run_campaign_comparison(file_a, files_b, lead_time, parallel=False, progress_callback=None):
+    """背景作業入口：載入檔案 A 及各推廣方案的檔案 B，再計算並比較所有方案。
+
+    載入佔整體進度的前 30%；返回 run_campaigns 的結果，另附載入時的警告 (notices)。
+    """
+    (df_a, campaigns), notices = _load_in_job(load_campaign_data, file_a, files_b,
+                                              progress_callback=progress_range(progress_callback, 0, 30))
+    result = run_campaigns(df_a, campaigns, lead_time, parallel=parallel,
+                           progress_callback=progress_range(progress_callback, 30, 100))
+    return {**result, 'notices': notices}
+
+def find_multi_sku_groups(df):
+    """返回包含多於一個 Article 的 Group No.。"""
+    group_sku_counts = df.groupby('Group No.')['Article'].nunique()
+    return group_sku_counts[group_sku_counts > 1].index
+
+def demand_rows(df, lead_time, multi_sku_groups=None, progress_callback=None):
+    """逐行計算需求及派貨建議 (calculate_demand 的第 1-8 步)，返回新的數據框。
+
+    multi_sku_groups 為 None 時按 df 本身判斷多 SKU 組；分批計算時應傳入以全部數據
+    判斷的組別，並確保同一 (Group No., Site) 的所有行位於同一批次。
+    """
+    # 複製數據框以避免修改原始數據
+    report_progress(progress_callback, 5, "準備計算...")
+    df_calc = df.copy()
+
+    # 1. 計算每日銷售率；合併數據帶有銷售歷史的滾動日均銷量時優先使用 (沒有歷史的行仍按上月銷量)
+    df_calc['Daily Sales Rate'] = (df_calc['Last Month Sold Qty'] / 30).apply(lambda x: max(0, x))
+    if HISTORY_RATE_COLUMN in df_calc.columns:
+        history_rate = df_calc[HISTORY_RATE_COLUMN]
+        df_calc['Daily Sales Rate'] = history_rate.where(history_rate.notna(), df_calc['Daily Sales Rate'])
+        df_calc['Notes'] += np.where(history_rate.notna(), '日均銷量取自銷售歷史; ', '')
+
+    # 2. 確定推廣目標係數
+    df_calc['Site Target %'] = df_calc.apply(
+        lambda row: row['Shop Target(HK)'] if row['Target Type'] == 'HK'
+        else (row['Shop Target(MO)'] if row['Target Type'] == 'MO'
+              else (row['Shop Target(ALL)'] if row['Target Type'] == 'ALL' else 0)),
+        axis=1
+    )
+
+    report_progress(progress_callback, 25, "計算日常及推廣需求...")
+    # 3. 計算日常銷售需求
+    df_calc['Regular Demand'] = df_calc['Daily Sales Rate'] * (df_calc['Target Cover Days'] + lead_time)
+
+    # 4. 計算推廣特定需求
+    df_calc['Promo Demand'] = df_calc['SKU Target'] * df_calc['Site Target %']
+
+    # 5. 計算總需求
+    report_progress(progress_callback, 40, "聚合多 SKU 組需求...")
+    # 對於多 SKU 組，需要先聚合
+    if multi_sku_groups is None:
+        multi_sku_groups = find_multi_sku_groups(df_calc)
+    multi_sku_groups = pd.Index(multi_sku_groups)
+
+    # 初始化 Total Demand (浮點數，以容納非整數的需求值)
+    df_calc['Total Demand'] = 0.0
+
+    # 單 SKU 組
+    single_sku_mask = ~df_calc['Group No.'].isin(multi_sku_groups)
+    df_calc.loc[single_sku_mask, 'Total Demand'] = df_calc.loc[single_sku_mask, 'Regular Demand'] + df_calc.loc[single_sku_mask, 'Promo Demand']
+
+    # 多 SKU 組
+    if not multi_sku_groups.empty:
+        # 按 Group No. 和 Site 聚合 Regular Demand
+        agg_regular_demand = df_calc[df_calc['Group No.'].isin(multi_sku_groups)].groupby(['Group No.', 'Site'])['Regular Demand'].sum().reset_index()
+        agg_regular_demand.rename(columns={'Regular Demand': 'Aggregated Regular Demand'}, inplace=True)
+
+        # 將聚合後的需求合併回主數據框
+        df_calc = pd.merge(df_calc, agg_regular_demand, on=['Group No.', 'Site'], how='left')
+        df_calc['Aggregated Regular Demand'] = df_calc['Aggregated Regular Demand'].fillna(0)
+
+        # 計算多 SKU 組的 Total Demand
+        multi_sku_mask = df_calc['Group No.'].isin(multi_sku_groups)
+        df_calc.loc[multi_sku_mask, 'Total Demand'] = df_calc.loc[multi_sku_mask, 'Aggregated Regular Demand'] + df_calc.loc[multi_sku_mask, 'Promo Demand']
+        df_calc.drop(columns=['Aggregated Regular Demand'], inplace=True)
+
+
+    # 6. 計算淨需求
+    report_progress(progress_callback, 55, "計算淨需求及派貨建議...")
+    df_calc['Net Demand'] = df_calc['Total Demand'] - (df_calc['SaSa Net Stock'] + df_calc['Pending Received']) + df_calc['Safety Stock']
+
+    # 7. 計算派貨建議
+    # 新邏輯: 派貨數量需為 MOQ 的倍數，且不小於 MOQ
+    
+    # 步驟 1: 確定基礎派貨量，至少為 Net Demand 和 MOQ 中的較大者
+    base_dispatch_qty = np.maximum(df_calc['Net Demand'], df_calc['MOQ'])
+    
+    # 步驟 2: 將基礎派貨量向上取整至 MOQ 的最接近倍數
+    moq = df_calc['MOQ']
+    # 為避免除以零的錯誤，只在 MOQ > 0 時執行計算
+    final_dispatch_qty = np.where(
+        moq > 0,
+        np.ceil(base_dispatch_qty / moq) * moq,
+        base_dispatch_qty # 若 MOQ 為 0，則回退到基礎派貨量
+    )
+    
+    # 步驟 3: 僅對 RP Type 為 'RF' 的項目應用此邏輯
+    df_calc['Suggested Dispatch Qty'] = np.where(
+        df_calc['RP Type'] == 'RF',
+        final_dispatch_qty,
+        0
+    )
+    
+    # 步驟 4: 清理數據，確保為非負整數
+    df_calc['Suggested Dispatch Qty'] = df_calc['Suggested Dispatch Qty'].clip(lower=0).fillna(0).astype(int)
+
+    # 8. 確定派貨類型
+    df_calc['Dispatch Type'] = np.where(
+        df_calc['Site'] == 'D001',
+        'D001',
+        np.where(
+            df_calc['RP Type'] == 'ND',
+            'ND',
             np.where(
-                df_calc['RP Type'] == 'ND',
-                'ND',
-                np.where(
-                    df_calc['Supply source'].isin([1, 4]),
-                    'Buyer需要訂貨',
-                    np.where(df_calc['Supply source'] == 2, '需生成 DN', '')
-                )
+                df_calc['Supply source'].isin([1, 4]),
+                'Buyer需要訂貨',
+                np.where(df_calc['Supply source'] == 2, '需生成 DN', '')
             )
         )
+    )
+    
+    # 更新 Notes
+    df_calc['Notes'] += f'Lead Time={lead_time}日; '
+    return df_calc
+
+def summarize_demand(df_calc):
+    """按 Group No. 及 SKU 聚合總結表 (calculate_demand 的第 9 步)。
+
+    同一 (Group No., Article) 的所有行須位於同一個 df_calc 中。
+    """
+    # 9. 聚合摘要表 (按 Group No. 和 SKU)
+    # 1. 分離 D001 和非 D001 數據
+    df_non_d001 = df_calc[df_calc['Site'] != 'D001'].copy()
+    df_d001 = df_calc[df_calc['Site'] == 'D001'].copy()
+
+    # 2. 從非 D001 數據創建基礎總結
+    summary_base = df_non_d001.groupby(['Group No.', 'Article']).agg(
+        Total_Demand=('Total Demand', 'sum'),
+        Total_Stock=('SaSa Net Stock', 'sum'),
+        Total_Pending=('Pending Received', 'sum'),
+        Total_Dispatch=('Suggested Dispatch Qty', 'sum')
+    ).reset_index()
+
+    # 3. 創建 D001 庫存總結
+    if not df_d001.empty:
+        d001_stock_cols = ['SaSa Net Stock', 'In Quality Insp.', 'Blocked', 'Pending Received']
+        for col in d001_stock_cols:
+            if col not in df_d001.columns:
+                df_d001[col] = 0
         
-        # 更新 Notes
-        df_calc['Notes'] += f'Lead Time={lead_time}日; '
-
-        # 9. 聚合摘要表 (按 Group No. 和 SKU)
-        # 1. 分離 D001 和非 D001 數據
-        df_non_d001 = df_calc[df_calc['Site'] != 'D001'].copy()
-        df_d001 = df_calc[df_calc['Site'] == 'D001'].copy()
-
-        # 2. 從非 D001 數據創建基礎總結
-        summary_base = df_non_d001.groupby(['Group No.', 'Article']).agg(
-            Total_Demand=('Total Demand', 'sum'),
-            Total_Stock=('SaSa Net Stock', 'sum'),
-            Total_Pending=('Pending Received', 'sum'),
-            Total_Dispatch=('Suggested Dispatch Qty', 'sum')
+        d001_summary = df_d001.groupby(['Group No.', 'Article']).agg(
+            D001_SaSa_Net_Stock=('SaSa Net Stock', 'sum'),
+            D001_In_Quality_Insp=('In Quality Insp.', 'sum'),
+            D001_Blocked=('Blocked', 'sum'),
+            D001_Pending_Received=('Pending Received', 'sum')
         ).reset_index()
+    else:
+        d001_summary = pd.DataFrame(columns=['Group No.', 'Article', 'D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received'])
 
-        # 3. 創建 D001 庫存總結
-        if not df_d001.empty:
-            d001_stock_cols = ['SaSa Net Stock', 'In Quality Insp.', 'Blocked', 'Pending Received']
-            for col in d001_stock_cols:
-                if col not in df_d001.columns:
-                    df_d001[col] = 0
-            
-            d001_summary = df_d001.groupby(['Group No.', 'Article']).agg(
-                D001_SaSa_Net_Stock=('SaSa Net Stock', 'sum'),
-                D001_In_Quality_Insp=('In Quality Insp.', 'sum'),
-                D001_Blocked=('Blocked', 'sum'),
-                D001_Pending_Received=('Pending Received', 'sum')
-            ).reset_index()
-        else:
-            d001_summary = pd.DataFrame(columns=['Group No.', 'Article', 'D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received'])
-
-        # 4. 合併基礎總結和 D001 庫存
-        summary_final = pd.merge(summary_base, d001_summary, on=['Group No.', 'Article'], how='left')
+    # 4. 合併基礎總結和 D001 庫存
+    summary_final = pd.merge(summary_base, d001_summary, on=['Group No.', 'Article'], how='left')
 
-        # 5. 填充 NaN 並設置數據類型
-        fill_cols = ['D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received']
-        for col in fill_cols:
-            summary_final[col] = summary_final[col].fillna(0).astype(int)
+    # 5. 填充 NaN 並設置數據類型
+    fill_cols = ['D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received']
+    for col in fill_cols:
+        summary_final[col] = summary_final[col].fillna(0).astype(int)
 
-        # 6. 添加計算欄位
-        summary_final['Total_Stock_Available'] = summary_final['Total_Stock'] + summary_final['Total_Pending']
-        
-        # 更新 Out_of_Stock_Warning 邏輯
-        # 優先級 1: 檢查 D001 是否有足夠的庫存來應對總派貨量
-        # 優先級 2: 如果 D001 庫存充足，再檢查非 D001 門市的庫存是否滿足其需求
-        summary_final['Out_of_Stock_Warning'] = np.where(
-            summary_final['Total_Dispatch'] > summary_final['D001_SaSa_Net_Stock'],
-            'D001 缺貨',
-            np.where(summary_final['Total_Demand'] > summary_final['Total_Stock_Available'], 'Y', 'N')
-        )
+    # 6. 添加計算欄位
+    summary_final['Total_Stock_Available'] = summary_final['Total_Stock'] + summary_final['Total_Pending']
+    
+    # 更新 Out_of_Stock_Warning 邏輯
+    # 優先級 1: 檢查 D001 是否有足夠的庫存來應對總派貨量
+    # 優先級 2: 如果 D001 庫存充足，再檢查非 D001 門市的庫存是否滿足其需求
+    summary_final['Out_of_Stock_Warning'] = np.where(
+        summary_final['Total_Dispatch'] > summary_final['D001_SaSa_Net_Stock'],
+        'D001 缺貨',
+        np.where(summary_final['Total_Demand'] > summary_final['Total_Stock_Available'], 'Y', 'N')
+    )
+
+    # 將 'Article' 重命名為 'SKU'
+    summary_final.rename(columns={'Article': 'SKU'}, inplace=True)
+
+    # 重新排序欄位
+    final_cols = [
+        'Group No.', 'SKU', 'Total_Demand', 'Total_Stock', 'Total_Pending', 'Total_Stock_Available', 'Total_Dispatch',
+        'D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received', 'Out_of_Stock_Warning'
+    ]
+    summary_final = summary_final[final_cols]
+    return summary_final
+
+def calculate_demand(df, lead_time, progress_callback=None):
+    """計算推廣貨量需求。"""
+    try:
+        if df is None or df.empty:
+            return pd.DataFrame(), pd.DataFrame()
 
-        # 將 'Article' 重命名為 'SKU'
-        summary_final.rename(columns={'Article': 'SKU'}, inplace=True)
+        df_calc = demand_rows(df, lead_time, progress_callback=progress_callback)
 
-        # 重新排序欄位
-        final_cols = [
-            'Group No.', 'SKU', 'Total_Demand', 'Total_Stock', 'Total_Pending', 'Total_Stock_Available', 'Total_Dispatch',
-            'D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received', 'Out_of_Stock_Warning'
-        ]
-        summary_final = summary_final[final_cols]
+        report_progress(progress_callback, 75, "生成總結報告...")
+        summary_final = summarize_demand(df_calc)
 
+        report_progress(progress_callback, 100, "計算完成")
         return df_calc, summary_final
     except Exception as e:
         st.error(f"計算需求時發生錯誤：{e}")
         logging.error(f"Demand calculation error: {e}", exc_info=True)
         return pd.DataFrame(), pd.DataFrame()
 
+def run_analysis(df_merged, lead_time, parallel=False, delta=False, run_store=None, store_info=None,
+                 sales_history=None, progress_callback=None):
+    """背景作業入口：執行需求計算並保存記錄，失敗時拋出例外讓作業標記為失敗。
+
+    delta 模式以記錄庫中相同檔案 B 及 Lead Time 的最近一次運行為基準，只重新計算受影響的組別。
+    提供 sales_history 時，按 (Article, Site) 查詢其滾動日均銷量作為每日銷售率。
+    """
+    if sales_history is not None and df_merged is not None:
+        report_progress(progress_callback, 1, "查詢銷售歷史...")
+        df_merged = sales_history.attach_rates(df_merged)
+    delta_report = None
+    durations = {}
+    file_b_hash = file_hash((store_info or {}).get('file_b')) if delta and run_store is not None else None
+    with log_stage(durations, 'calculate'):
+        if delta and run_store is not None:
+            report_progress(progress_callback, 2, "載入基準運行...")
+            baseline = [None, None, None]
+            baseline_id = run_store.find_latest_run(file_b_hash=file_b_hash, lead_time=lead_time)
+            if baseline_id is not None:
+                baseline = [run_store.load_frame(baseline_id, kind) for kind in ('merged', 'results', 'summary')]
+            results, summary, delta_report = calculate_demand_delta(*baseline, lead_time, df_merged, lead_time,
+                                                                    progress_callback=progress_callback)
+        elif parallel:
+            results, summary = calculate_demand_parallel(df_merged, lead_time, progress_callback=progress_callback)
+        else:
+            results, summary = calculate_demand(df_merged, lead_time, progress_callback=progress_callback)
+    mode = 'delta' if delta_report is not None else ('parallel' if parallel else 'sequential')
+    if results.empty and df_merged is not None and not df_merged.empty:
+        metrics.inc('analysis_errors_total')
+        raise RuntimeError("計算需求時發生錯誤，詳情請查看 app.log。")
+    metrics.observe('calculate_duration_seconds', durations['calculate'], mode=mode)
+    metrics.inc('calculate_rows_total', 0 if df_merged is None else len(df_merged), mode=mode)
+
+    run_id = None
+    run_info = {}
+    if run_store is not None:
+        report_progress(progress_callback, 100, "儲存分析記錄...")
+        try:
+            with log_stage(durations, 'save'):
+                run_id = run_store.save_run(df_merged, results, summary, lead_time, **(store_info or {}))
+            run_info = run_store.get_run(run_id) or {}
+        except Exception as e:
+            logging.error(f"Run store error: {e}", exc_info=True)
+
+    logging.info("Analysis completed", extra={
+        'run_id': run_id,
+        'mode': mode,
+        'lead_time': lead_time,
+        'file_a_hash': run_info.get('file_a_hash'),
+        'file_b_hash': run_info.get('file_b_hash', file_b_hash),
+        'merged_rows': 0 if df_merged is None else len(df_merged),
+        'result_rows': len(results),
+        'summary_rows': len(summary),
+        'recomputed_rows': delta_report.recomputed_rows if delta_report is not None else None,
+        'stage_durations': durations,
+    })
+    return {'results': results, 'summary': summary, 'run_id': run_id, 'delta_report': delta_report}
+
+@st.cache_resource
+def get_job_manager():
+    """返回伺服器共用的作業管理器，以限制所有會話的並行分析數量。"""
+    return JobManager()
+
+@st.cache_resource
+def get_run_store():
+    """返回伺服器共用的分析記錄庫。"""
+    return RunStore()
+
+@st.cache_resource
+def get_sales_history():
+    return SalesHistory()
+
+@st.cache_resource
+def get_dataset_store():
+    """返回本進程的數據快照存儲；快照檔案本身由主機上的所有伺服器進程共用。"""
+    return DatasetStore()
+
+@st.cache_resource
+def start_metrics():
+    """啟用指標收集並在本機端口提供 Prometheus 端點；每個伺服器進程只執行一次。"""
+    registry = metrics.enable()
+    try:
+        metrics.start_http_server(registry)
+    except OSError as e:
+        # 同一主機運行多個進程時端口可能已被佔用，指標仍可在側邊欄查看
+        logging.warning(f"Metrics endpoint not started: {e}")
+    return registry
+
+@st.cache_resource
+def get_session_store():
+    """返回伺服器共用的會話數據存儲，統一管理所有會話的記憶體用量。"""
+    return SessionStore()
+
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else 'local'
+
+def upload_signature(uploaded_file_a, uploaded_file_b):
+    """上傳檔案的識別碼；只有檔案改變時才重新解析。"""
+    files = list(uploaded_file_a or []) + ([uploaded_file_b] if uploaded_file_b else [])
+    return tuple((f.file_id, f.name, f.size) for f in files)
+
+def restore_evicted_session(session_store, session_id):
+    """會話數據被釋放後，從分析記錄庫重新載入最近一次的分析結果。"""
+    run_id = st.session_state.run_id
+    if run_id is None or not Config.RUN_STORE_ENABLED:
+        st.warning("伺服器記憶體不足，此會話的數據已被釋放，請重新上傳檔案並分析。")
+        return
+    run_store = get_run_store()
+    try:
+        session_store.restore(session_id, *(run_store.load_frame(run_id, kind) for kind in ('merged', 'results', 'summary')))
+        st.info(f"伺服器記憶體不足，此會話的數據曾被釋放，已從分析記錄 {run_id} 重新載入。")
+    except Exception as e:
+        logging.error(f"Session restore error: {e}", exc_info=True)
+        st.warning("伺服器記憶體不足，此會話的數據已被釋放，請重新上傳檔案並分析。")
 
-# --- Streamlit UI ---
-st.set_page_config(layout="wide", page_title="零售推廣目標檢視及派貨系統")
-
-# --- 側邊欄 ---
-with st.sidebar:
-    st.header("開發者資訊")
-    st.write("姓名：Ricky")
-    st.write("當前版本：v1.0")
-    
-    st.header("參數設定")
-    lead_time = st.slider("自訂 Lead Time (日)", min_value=2.0, max_value=5.0, value=2.0, step=0.5)
-
-    st.header("檔案上傳注意事項")
-    st.info("請確保上傳的檔案符合以下格式要求：")
-    with st.expander("檔案 A (庫存與銷售) 注意事項", expanded=False):
-        st.markdown("""
-        - **必要欄位**: 必須包含 `Article`, `Site`, `SaSa Net Stock`, `Pending Received`, `MOQ`, `RP Type`, `Last Month Sold Qty` 等。
-        - **資料格式**: 
-            - `Article` 和 `Site` 會自動清除前後空格。
-            - 數值欄位 (如庫存、銷量) 中的非數字或負數會被視為 0。
-        """)
-    with st.expander("檔案 B (推廣目標) 注意事項", expanded=False):
-        st.markdown("""
-        - **工作表**: 必須包含 `Sheet1` 和 `Sheet2`。
-        - **Sheet1 欄位**: 需有 `Group No.`, `Article`, `SKU Target` 等。
-        - **Sheet2 欄位**: 需有 `Site`, `Shop Target(HK)` 等。
-        """)
-
-# --- 主區域 ---
-st.title("零售推廣目標檢視及派貨系統")
-
-# --- 檔案上傳 ---
-uploaded_file_a = st.file_uploader("上傳庫存與銷售檔案 (A)", type=["xlsx"])
-uploaded_file_b = st.file_uploader("上傳推廣目標檔案 (B)", type=["xlsx"])
-
-# 初始化 session state
-if 'data_loaded' not in st.session_state:
-    st.session_state.data_loaded = False
-    st.session_state.df_merged = None
-    st.session_state.results = None
-    st.session_state.summary = None
-
-if uploaded_file_a and uploaded_file_b:
-    df_merged, _ = load_data(uploaded_file_a, uploaded_file_b)
-    if df_merged is not None:
-        st.session_state.df_merged = df_merged
-        st.session_state.data_loaded = True
-
-# --- 資料預覽 ---
-with st.expander("資料預覽 (前 10 行)", expanded=False):
-    if st.session_state.data_loaded:
-        st.dataframe(st.session_state.df_merged.head(10), use_container_width=True)
-    else:
-        st.info("請上傳兩個檔案以預覽資料。")
-
-# --- 分析觸發 ---
-if st.button("開始分析"):
-    if st.session_state.data_loaded:
-        progress_bar = st.progress(0, text="分析中，請稍候...")
-        
-        # 執行計算
-        results, summary = calculate_demand(st.session_state.df_merged, lead_time)
-        st.session_state.results = results
-        st.session_state.summary = summary
-        
-        progress_bar.progress(100, text="分析完成！")
-        st.success("✅ 分析完成！")
-    else:
-        st.error("錯誤：請先上傳兩個必要的 Excel 檔案。")
-
-# --- 結果顯示 ---
-with st.expander("詳細計算結果", expanded=True):
-    if st.session_state.results is not None:
-        st.dataframe(st.session_state.results, use_container_width=True)
-    else:
-        st.info("點擊「開始分析」以生成結果。")
 
-with st.expander("總結報告", expanded=True):
-    if st.session_state.summary is not None:
-        st.dataframe(st.session_state.summary, use_container_width=True)
-    else:
-        st.info("點擊「開始分析」以生成總結報告。")
+def create_visualizations(results_df, summary_df, matrix=None):
+    """根據分析結果創建並顯示多個視覺化圖表。
 
-def create_visualizations(results_df, summary_df):
-    """根據分析結果創建並顯示多個視覺化圖表。"""
+    matrix 為結果的稀疏 Site×Article 矩陣 (SiteArticleMatrix)；未提供時按 results_df 建立。
+    各圖表的篩選及彙總都在稀疏矩陣上進行，不會重新對整個結果做 groupby 或 pivot。
+    """
     st.header("Visualization Analysis")
 
     if results_df.empty:
         st.info("No data available for visualization.")
         return
+    if matrix is None:
+        matrix = SiteArticleMatrix.from_results(results_df)
 
     # --- 過濫器 ---
-    group_options = ["All"] + sorted(results_df['Group No.'].unique().tolist())
+    group_options = ["All"] + matrix.groups.tolist()
     selected_group = st.selectbox("Select Group No. to analyze", options=group_options)
 
-    # 根據選擇過濫數據
-    if selected_group != "All":
-        filtered_results = results_df[results_df['Group No.'] == selected_group]
-        filtered_summary = summary_df[summary_df['Group No.'] == selected_group]
-    else:
-        filtered_results = results_df
-        filtered_summary = summary_df
-
-    if filtered_results.empty:
+    # 根據選擇過濫數據 (不含 D001)
+    selected = matrix.select(group=None if selected_group == "All" else selected_group)
+    if selected.nnz == 0:
         st.warning("No data to display for the selected group.")
         return
+    non_d001 = selected.select(exclude_sites=['D001'])
 
     # --- 圖表生成 ---
     # 1. 柱狀圖 (SKU 需求 vs 庫存, 不含 D001)
     st.subheader("SKU Demand vs. Stock (excluding D001)")
     
-    # 過濫掉 D001
-    chart_data = filtered_results[filtered_results['Site'] != 'D001'].copy()
-    
-    if not chart_data.empty:
+    if non_d001.nnz > 0:
         # 計算每個 SKU 的總需求和總庫存
-        chart_data['Stock Available'] = chart_data['SaSa Net Stock'] + chart_data['Pending Received']
-        sku_plot_data = chart_data.groupby('Article').agg({
-            'Total Demand': 'sum',
-            'Stock Available': 'sum'
-        }).reset_index()
-
-        fig1, ax1 = plt.subplots()
-        sku_plot_data.plot(x='Article', y=['Total Demand', 'Stock Available'], kind='bar', ax=ax1)
-        ax1.set_title(f"Group: {selected_group}")
-        ax1.set_ylabel("Quantity")
-        ax1.tick_params(axis='x', rotation=90)
-        st.pyplot(fig1)
-        st.caption("This chart compares total demand vs. available stock for each SKU (D001 excluded).")
+        sku_plot_data = non_d001.article_totals(['Total Demand', 'SaSa Net Stock', 'Pending Received'])
+        sku_plot_data['Stock Available'] = sku_plot_data.pop('SaSa Net Stock') + sku_plot_data.pop('Pending Received')
+        sku_plot_data = sku_plot_data.reset_index()
+
+        with metrics.timer('chart_duration_seconds', chart='sku_bars'):
+            fig1, aggregated = plot_sku_bars(sku_plot_data, f"Group: {selected_group}")
+            st.pyplot(fig1)
+            plt.close(fig1)
+        caption = "This chart compares total demand vs. available stock for each SKU (D001 excluded)."
+        if aggregated:
+            caption += f" Showing the top {Config.CHART_TOP_N_SKUS} of {len(sku_plot_data)} SKUs by demand; the rest are combined into \"Others\"."
+        st.caption(caption)
     else:
         st.info("No data available for this chart after excluding D001.")
 
     # 2. 淨需求熱圖
     st.subheader("Net Demand Heatmap (by Site and Article, excluding D001)")
-    heatmap_filtered_results = filtered_results[filtered_results['Site'] != 'D001']
-    heatmap_data = heatmap_filtered_results.pivot_table(index='Site', columns='Article', values='Net Demand', aggfunc='sum')
-    if not heatmap_data.empty:
-        # 如果數據點太多，進行抽樣
-        if heatmap_data.size > 1000:
-            st.warning("Data points exceed 1000. Showing a sample of the data.")
-            sampled_cols = np.random.choice(heatmap_data.columns, size=min(50, len(heatmap_data.columns)), replace=False)
-            heatmap_data = heatmap_data[sampled_cols]
-
-        fig3, ax3 = plt.subplots(figsize=(12, max(6, len(heatmap_data.index) * 0.5)))
-        sns.heatmap(heatmap_data, annot=True, fmt=".0f", cmap="viridis", ax=ax3)
-        ax3.set_title(f"Group: {selected_group}")
-        st.pyplot(fig3)
+    if non_d001.nnz > 0:
+        matrix_data, site_labels, article_labels = non_d001.bin('Net Demand')
+        num_sites = len(np.unique(non_d001.site_codes))
+        num_articles = len(np.unique(non_d001.article_codes))
+        if matrix_data.shape != (num_sites, num_articles):
+            st.info(f"{num_sites} sites × {num_articles} articles are binned into a {matrix_data.shape[0]} × "
+                    f"{matrix_data.shape[1]} grid; each cell shows the summed net demand of its bin.")
+
+        with metrics.timer('chart_duration_seconds', chart='heatmap'):
+            fig3 = plot_heatmap(matrix_data, site_labels, article_labels, f"Group: {selected_group}")
+            st.pyplot(fig3)
+            plt.close(fig3)
         st.caption("This heatmap shows the net demand for each article at each site (D001 excluded). Higher values indicate greater demand.")
     else:
         st.info("No net demand data available to generate a heatmap for this group (D001 excluded).")
 
+    # 3. 店舖合計及 SKU 派貨分配
+    st.subheader("Site Totals and Article Allocation")
+    totals_col, allocation_col = st.columns(2)
+    with totals_col:
+        st.dataframe(selected.site_totals(['Net Demand', 'SaSa Net Stock', 'Suggested Dispatch Qty']),
+                     use_container_width=True)
+    with allocation_col:
+        articles = selected.articles[np.unique(selected.article_codes)].tolist()
+        article = st.selectbox("Article", options=articles, key="allocation_article")
+        st.dataframe(selected.allocation(article)[['Net Demand', 'SaSa Net Stock', 'Suggested Dispatch Qty']],
+                     use_container_width=True)
+
 def export_to_excel(raw_df, results_df, summary_df):
     """將數據導出到一個多工作表的 Excel 檔案中。"""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        raw_df.to_excel(writer, sheet_name='Raw Data', index=False)
-        results_df.to_excel(writer, sheet_name='Calculation Results', index=False)
-        summary_df.to_excel(writer, sheet_name='Summary', index=False)
+    with metrics.timer('export_duration_seconds'):
+        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+            raw_df.to_excel(writer, sheet_name='Raw Data', index=False)
+            results_df.to_excel(writer, sheet_name='Calculation Results', index=False)
+            summary_df.to_excel(writer, sheet_name='Summary', index=False)
     
     processed_data = output.getvalue()
+    metrics.observe('export_bytes', len(processed_data))
     return processed_data
 
-# --- 視覺化圖表 ---
-with st.expander("視覺化圖表", expanded=True):
-    if st.session_state.results is not None:
-        create_visualizations(st.session_state.results, st.session_state.summary)
+def clamp_page(key, num_pages):
+    """過濾條件改變後，確保分頁輸入框保存的頁數不超過新的總頁數。"""
+    if st.session_state.get(key, 1) > num_pages:
+        st.session_state[key] = num_pages
+
+def show_results_grid(grid):
+    """以伺服器端分頁顯示計算結果，只把當前頁傳送到瀏覽器。"""
+    col1, col2, col3 = st.columns(3)
+    filters = {
+        'Group No.': col1.multiselect("Group No.", grid.options('Group No.'), key="grid_group"),
+        'Dispatch Type': col2.multiselect("Dispatch Type", grid.options('Dispatch Type'), key="grid_dispatch"),
+        'Out_of_Stock_Warning': col3.multiselect("缺貨警告", grid.options('Out_of_Stock_Warning'), key="grid_warning"),
+    }
+    # Article / Site 的可選值可能上萬個，改用逗號分隔的文字輸入
+    col1, col2 = st.columns(2)
+    for column, container in (('Article', col1), ('Site', col2)):
+        text = container.text_input(f"{column} (以逗號分隔)", key=f"grid_{column.lower()}")
+        filters[column] = [value.strip() for value in text.split(',') if value.strip()]
+
+    col1, col2, col3, col4 = st.columns(4)
+    sort_by = col1.selectbox("排序欄位", ["(原始順序)"] + grid.sort_columns(), key="grid_sort")
+    ascending = col2.radio("排序方向", ["遞增", "遞減"], horizontal=True, key="grid_order") == "遞增"
+    page_size = col3.selectbox("每頁行數", Config.RESULTS_GRID_PAGE_SIZES, index=1, key="grid_page_size")
+
+    positions = grid.query(filters, sort_by=sort_by, ascending=ascending)
+    num_pages = max(1, -(-len(positions) // page_size))
+    clamp_page("grid_page", num_pages)
+    page = col4.number_input("頁數", min_value=1, max_value=num_pages, value=1, step=1, key="grid_page")
+    st.dataframe(grid.page(positions, page, page_size), use_container_width=True, hide_index=True)
+    st.caption(f"符合條件 {len(positions)} / {len(grid)} 行，第 {page}/{num_pages} 頁")
+
+def show_run_history(run_store):
+    """列出已保存的分析記錄，並分頁顯示跨運行的查詢結果。"""
+    runs = run_store.list_runs()
+    if runs.empty:
+        st.info("尚未有已保存的分析記錄。")
+        return
+    st.dataframe(runs, use_container_width=True, hide_index=True)
+
+    col1, col2, col3 = st.columns(3)
+    group_no = col1.text_input("Group No.", key="history_group").strip() or None
+    article = col2.text_input("Article", key="history_article").strip() or None
+    site = col3.text_input("Site", key="history_site").strip() or None
+    run_ids = st.multiselect("分析記錄 (留空表示全部)", options=runs['run_id'].tolist(), key="history_runs")
+
+    total = run_store.count_results(group_no, article, site, run_ids)
+    page_size = Config.RUN_HISTORY_PAGE_SIZE
+    num_pages = max(1, -(-total // page_size))
+    clamp_page("history_page", num_pages)
+    page = st.number_input("頁數", min_value=1, max_value=num_pages, value=1, step=1, key="history_page")
+    page_df = run_store.query_results(group_no, article, site, run_ids,
+                                      offset=(page - 1) * page_size, limit=page_size)
+    if page_df.empty:
+        st.info("沒有符合條件的記錄。")
     else:
-        st.info("點擊「開始分析」以生成圖表。")
-
-# --- 匯出功能 ---
-with st.expander("匯出分析結果", expanded=False):
-    if st.session_state.results is not None:
+        st.dataframe(page_df, use_container_width=True, hide_index=True)
+    st.caption(f"共 {total} 行，第 {page}/{num_pages} 頁")
+
+
+# --- 頁面區塊 ---
+# 以下區塊均為 fragment：區塊內的控件只重新執行該區塊，不會重新渲染其他表格或重建匯出檔案
+@st.fragment
+def parameter_panel():
+    """側邊欄參數設定；分析時從 session_state 讀取最新的參數。"""
+    with metrics.timer('section_duration_seconds', section='parameters'):
+        st.header("參數設定")
+        st.slider("自訂 Lead Time (日)", min_value=2.0, max_value=5.0, value=2.0, step=0.5, key="lead_time")
+        st.toggle("平行計算模式", value=Config.PARALLEL_ENABLED, key="parallel_mode",
+                  help="按 Group No. 分區並使用多個 CPU 核心計算，適用於大型檔案。")
+        st.toggle("增量計算模式", value=False, disabled=not Config.RUN_STORE_ENABLED, key="delta_mode",
+                  help="以相同檔案 B 及 Lead Time 的最近一次分析記錄為基準，只重新計算檔案 A 有變更的組別。")
+        st.toggle("使用銷售歷史日均銷量", value=False, key="history_rates",
+                  help=f"以銷售歷史最近 {Config.SALES_HISTORY_WINDOW_MONTHS} 個月的日均銷量取代上月銷量 / 30；"
+                       "沒有歷史的 (Article, Site) 仍使用上月銷量。")
+
+@st.fragment
+def sales_history_panel():
+    """側邊欄的銷售歷史管理：每月上傳一份檔案 A 快照，只加入該月銷量。"""
+    with metrics.timer('section_duration_seconds', section='sales_history'):
+        sales_history = get_sales_history()
+        with st.expander("銷售歷史", expanded=False):
+            history_file = st.file_uploader("檔案 A 快照", type=Config.SUPPORTED_FILE_TYPES, key="history_file")
+            default_month = (pd.Timestamp.today().to_period('M') - 1).strftime('%Y-%m')
+            month = st.text_input("銷售月份 (YYYY-MM)", value=default_month, key="history_month",
+                                  help="快照中 Last Month Sold Qty 所屬的月份。")
+            replace = st.checkbox("覆蓋已存在的月份", key="history_replace")
+            if st.button("加入銷售歷史", disabled=history_file is None):
+                try:
+                    df_a = pd.read_excel(history_file, sheet_name=0, dtype={'Article': str, 'Site': str})
+                    rows = sales_history.ingest(df_a, month, source_name=history_file.name, replace=replace)
+                    st.success(f"已加入 {month} 的 {rows} 個 (Article, Site) 銷量。")
+                except ValueError as e:
+                    st.error(str(e))
+            months = sales_history.list_months()
+            if months.empty:
+                st.caption("尚未加入任何月份。")
+            else:
+                st.dataframe(months[['month', 'rows', 'sold_qty', 'in_window']], use_container_width=True,
+                             hide_index=True)
+
+@st.fragment
+def results_grid_panel(session_store, session_id):
+    with metrics.timer('section_duration_seconds', section='results_grid'):
+        show_results_grid(session_store.results_grid(session_id, ResultsGrid))
+
+@st.fragment
+def visualization_panel(session_store, session_id):
+    with metrics.timer('section_duration_seconds', section='visualization'):
+        results, summary = session_store.get_results(session_id)
+        matrix = session_store.site_article_matrix(
+            session_id, lambda results, _: SiteArticleMatrix.from_results(results))
+        create_visualizations(results, summary, matrix)
+
+@st.fragment
+def export_panel(df_merged, results, summary):
+    """下載按鈕；Excel 報告在點擊時才於背景執行緒生成，頁面重新執行時不會重建。"""
+    with metrics.timer('section_duration_seconds', section='export'):
         current_date = datetime.now().strftime("%Y%m%d")
-        file_name = f"Promotion_Demand_Report_{current_date}.xlsx"
-        
-        excel_data = export_to_excel(
-            st.session_state.df_merged,
-            st.session_state.results,
-            st.session_state.summary
-        )
-        
         st.download_button(
             label="📥 下載 Excel 報告",
-            data=excel_data,
-            file_name=file_name,
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            data=lambda: export_to_excel(df_merged, results, summary),
+            file_name=f"Promotion_Demand_Report_{current_date}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore",
         )
-    else:
-        st.info("點擊「開始分析」以生成可匯出的報告。")
-
-# --- 依賴檢查 ---
-try:
-    import openpyxl
-    import matplotlib
-    import seaborn
-except ImportError:
-    st.error("缺少必要套件，請根據 requirements.txt 檔案安裝。")
\ No newline at end of file
+        st.download_button(
+            label="📦 下載各店舖 DN 及 Buyer 訂貨檔案 (ZIP)",
+            data=lambda: dispatch_archive_bytes(results),
+            file_name=f"Dispatch_Files_{current_date}.zip",
+            mime="application/zip",
+            on_click="ignore",
+        )
+
+
+@st.fragment
+def campaign_panel(uploaded_file_a):
+    """以同一庫存快照比較多個推廣方案 (檔案 B)；檔案 A 只解析一次，計算在背景作業執行。"""
+    with metrics.timer('section_duration_seconds', section='campaigns'):
+        job_manager = get_job_manager()
+        files_b = st.file_uploader("上傳多個推廣方案檔案 (B)", type=Config.SUPPORTED_FILE_TYPES,
+                                   accept_multiple_files=True, key='campaign_files',
+                                   help="每個檔案 B 視為一個推廣方案，與上方的檔案 A 一起計算。")
+        job_running = st.session_state.get('campaign_job_id') is not None
+
+        if st.button("比較推廣方案", disabled=job_running):
+            if not uploaded_file_a or not files_b:
+                st.error("錯誤：請先上傳檔案 A 及至少一個推廣方案檔案 (B)。")
+            else:
+                try:
+                    job = job_manager.submit(run_campaign_comparison, uploaded_file_a, files_b,
+                                             st.session_state.lead_time, parallel=st.session_state.parallel_mode,
+                                             name="compare_campaigns")
+                    st.session_state.campaign_job_id = job.job_id
+                    st.session_state.campaign_result = None
+                    job_running = True
+                except JobLimitError:
+                    st.error("伺服器目前的分析作業已滿，請稍後再試。")
+
+        @st.fragment(run_every=Config.JOB_POLL_INTERVAL)
+        def show_campaign_job_status():
+            job = job_manager.get(st.session_state.campaign_job_id)
+            if job is not None and not job.done:
+                status = job.snapshot()
+                st.progress(status['progress'], text=f"{status['message']} ({status['elapsed']:.1f} 秒)")
+                if st.button("取消比較"):
+                    job_manager.cancel(job.job_id)
+                return
+            if job is not None and job.status == Job.COMPLETED:
+                # 只保留比較表、總結及載入警告，逐行結果佔用記憶體較多且不在此區塊顯示
+                st.session_state.campaign_result = {key: job.result[key]
+                                                    for key in ('comparison', 'summary', 'notices')}
+            elif job is not None and job.status == Job.FAILED:
+                st.session_state.campaign_result = {'error': job.snapshot()['error']}
+            elif job is not None and job.status == Job.CANCELLED:
+                st.session_state.campaign_result = None
+            st.session_state.campaign_job_id = None
+            st.rerun()
+
+        if job_running:
+            show_campaign_job_status()
+            return
+
+        result = st.session_state.get('campaign_result')
+        if not result:
+            st.info("上傳推廣方案檔案後點擊「比較推廣方案」。")
+        elif 'error' in result:
+            st.error(f"比較失敗：{result['error']}")
+        else:
+            for level, message in result['notices']:
+                getattr(st, level)(message)
+            st.dataframe(result['comparison'], use_container_width=True, hide_index=True)
+            st.download_button(
+                label="📥 下載方案比較 (Excel)",
+                data=lambda: export_campaign_comparison(result['comparison'], result['summary']),
+                file_name=f"Campaign_Comparison_{datetime.now().strftime('%Y%m%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore",
+            )
+
+
+@st.fragment
+def run_history_panel(run_store):
+    with metrics.timer('section_duration_seconds', section='run_history'):
+        show_run_history(run_store)
+
+
+# --- Streamlit UI ---
+def main():
+    """Streamlit 頁面入口。"""
+    st.set_page_config(layout="wide", page_title="零售推廣目標檢視及派貨系統")
+    page_start = time.perf_counter()
+    setup_logging()
+    # 會話存儲的計算結果與合併數據共用欄位 (session_store.join_results)；pandas 3 預設開啟
+    # Copy-on-Write，pandas 2 在此開啟，使修改結果不會改動合併數據。只在應用入口設定，不影響其他引擎
+    if int(pd.__version__.split('.')[0]) < 3:
+        pd.set_option('mode.copy_on_write', True)
+    if Config.METRICS_ENABLED:
+        start_metrics()
+
+    # --- 側邊欄 ---
+    with st.sidebar:
+        st.header("開發者資訊")
+        st.write("姓名：Ricky")
+        st.write("當前版本：v1.0")
+
+        parameter_panel()
+        sales_history_panel()
+
+        st.header("檔案上傳注意事項")
+        st.info("請確保上傳的檔案符合以下格式要求：")
+        with st.expander("檔案 A (庫存與銷售) 注意事項", expanded=False):
+            st.markdown("""
+            - **必要欄位**: 必須包含 `Article`, `Site`, `SaSa Net Stock`, `Pending Received`, `MOQ`, `RP Type`, `Last Month Sold Qty` 等。
+            - **資料格式**: 
+                - `Article` 和 `Site` 會自動清除前後空格。
+                - 數值欄位 (如庫存、銷量) 中的非數字或負數會被視為 0。
+            """)
+        with st.expander("檔案 B (推廣目標) 注意事項", expanded=False):
+            st.markdown("""
+            - **工作表**: 必須包含 `Sheet1` 和 `Sheet2`。
+            - **Sheet1 欄位**: 需有 `Group No.`, `Article`, `SKU Target` 等。
+            - **Sheet2 欄位**: 需有 `Site`, `Shop Target(HK)` 等。
+            """)
+
+    # --- 主區域 ---
+    st.title("零售推廣目標檢視及派貨系統")
+
+    # --- 檔案上傳 ---
+    uploaded_file_a = st.file_uploader("上傳庫存與銷售檔案 (A)", type=Config.SUPPORTED_FILE_TYPES,
+                                       accept_multiple_files=True,
+                                       help="可同時上傳多個地區 (例如 HK、MO) 的庫存檔案，系統會自動合併。")
+    uploaded_file_b = st.file_uploader("上傳推廣目標檔案 (B)", type=Config.SUPPORTED_FILE_TYPES)
+
+    # 初始化 session state；數據框本身保存在伺服器共用的 SessionStore
+    session_store = get_session_store()
+    session_id = current_session_id()
+    if 'run_id' not in st.session_state:
+        st.session_state.run_id = None
+        st.session_state.upload_signature = None
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = None
+        st.session_state.job_notice = None
+    if 'load_job_id' not in st.session_state:
+        st.session_state.load_job_id = None
+        st.session_state.load_signature = None
+        st.session_state.load_notices = []
+
+    if session_store.is_evicted(session_id):
+        st.session_state.upload_signature = None
+        st.session_state.load_signature = None
+        restore_evicted_session(session_store, session_id)
+
+    # --- 載入上傳檔案 (背景作業) ---
+    job_manager = get_job_manager()
+    signature = upload_signature(uploaded_file_a, uploaded_file_b)
+    if uploaded_file_a and uploaded_file_b:
+        reuse = signature == st.session_state.upload_signature
+        # 同一組檔案正在載入 (或已載入失敗) 時不重複提交
+        pending = not reuse and signature == st.session_state.load_signature
+        if not pending:
+            metrics.inc('cache_requests_total', cache='upload', result='hit' if reuse else 'miss')
+        if not reuse and not pending:
+            # 載入中途更換了檔案時，取消舊檔案的載入作業
+            if st.session_state.load_job_id is not None:
+                job_manager.cancel(st.session_state.load_job_id)
+                st.session_state.load_job_id = None
+            try:
+                job = job_manager.submit(run_load, uploaded_file_a, uploaded_file_b, name="load_data")
+                st.session_state.load_job_id = job.job_id
+                st.session_state.load_signature = signature
+                st.session_state.load_notices = []
+            except JobLimitError:
+                st.error("伺服器目前的作業已滿，請稍後再試。")
+
+    @st.fragment(run_every=Config.JOB_POLL_INTERVAL)
+    def show_load_status():
+        """輪詢檔案載入作業，顯示各階段進度並提供取消按鈕。"""
+        job = job_manager.get(st.session_state.load_job_id)
+        if job is None:
+            st.session_state.load_job_id = None
+            st.rerun()
+
+        status = job.snapshot()
+        if not job.done:
+            st.progress(status['progress'], text=f"{status['message']} ({status['elapsed']:.1f} 秒)")
+            if st.button("取消載入"):
+                job_manager.cancel(job.job_id)
+            return
+
+        if job.status == Job.COMPLETED:
+            session_store.set_merged(session_id, job.result['merged'])
+            st.session_state.upload_signature = st.session_state.load_signature
+            st.session_state.load_notices = job.result['notices']
+        elif job.status == Job.CANCELLED:
+            st.session_state.load_notices = [("warning", "檔案載入已取消，請重新上傳檔案。")]
+        else:
+            st.session_state.load_notices = [("error", message) for message in status['error'].splitlines()]
+        st.session_state.load_job_id = None
+        st.rerun()
+
+    loading = st.session_state.load_job_id is not None
+    if loading:
+        show_load_status()
+    elif signature == st.session_state.load_signature:
+        for level, message in st.session_state.load_notices:
+            getattr(st, level)(message)
+
+    df_merged = session_store.get_merged(session_id)
+    data_loaded = df_merged is not None and not loading
+
+    # --- 資料預覽 ---
+    with st.expander("資料預覽 (前 10 行)", expanded=False):
+        if data_loaded:
+            st.dataframe(df_merged.head(10), use_container_width=True)
+        else:
+            st.info("請上傳兩個檔案以預覽資料。")
+
+    # --- 分析觸發 ---
+    job_running = st.session_state.job_id is not None
+
+    if st.button("開始分析", disabled=job_running or loading):
+        if data_loaded:
+            try:
+                store_info = {
+                    'file_a': uploaded_file_a, 'file_a_name': ', '.join(f.name for f in uploaded_file_a),
+                    'file_b': uploaded_file_b, 'file_b_name': uploaded_file_b.name,
+                } if uploaded_file_a and uploaded_file_b else None
+                job = job_manager.submit(run_analysis, df_merged, st.session_state.lead_time,
+                                         parallel=st.session_state.parallel_mode,
+                                         delta=st.session_state.delta_mode,
+                                         run_store=get_run_store() if Config.RUN_STORE_ENABLED else None,
+                                         store_info=store_info,
+                                         sales_history=get_sales_history() if st.session_state.history_rates
+                                         else None,
+                                         name="calculate_demand")
+                st.session_state.job_id = job.job_id
+                st.session_state.job_notice = None
+                job_running = True
+            except JobLimitError:
+                st.error("伺服器目前的分析作業已滿，請稍後再試。")
+        else:
+            st.error("錯誤：請先上傳兩個必要的 Excel 檔案。")
+
+    @st.fragment(run_every=Config.JOB_POLL_INTERVAL)
+    def show_job_status():
+        """輪詢背景作業狀態，顯示進度並提供取消按鈕。"""
+        job = job_manager.get(st.session_state.job_id)
+        if job is None:
+            st.session_state.job_id = None
+            st.rerun()
+
+        status = job.snapshot()
+        if not job.done:
+            st.progress(status['progress'], text=f"{status['message']} ({status['elapsed']:.1f} 秒)")
+            if st.button("取消分析"):
+                job_manager.cancel(job.job_id)
+            return
+
+        if job.status == Job.COMPLETED:
+            session_store.set_results(session_id, job.result['results'], job.result['summary'])
+            st.session_state.run_id = job.result['run_id']
+            st.session_state.delta_report = job.result['delta_report']
+            st.session_state.job_notice = ("success", f"✅ 分析完成！耗時 {status['elapsed']:.1f} 秒")
+        elif job.status == Job.CANCELLED:
+            st.session_state.job_notice = ("warning", "分析已取消。")
+        else:
+            st.session_state.job_notice = ("error", f"分析失敗：{status['error']}")
+        st.session_state.job_id = None
+        st.rerun()
+
+    if job_running:
+        show_job_status()
+    elif st.session_state.job_notice:
+        level, message = st.session_state.job_notice
+        getattr(st, level)(message)
+        delta_report = st.session_state.get('delta_report')
+        if delta_report is not None:
+            st.info(delta_report.describe())
+            if not delta_report.changes.empty:
+                with st.expander("檔案 A 變更明細", expanded=False):
+                    st.dataframe(delta_report.changes, use_container_width=True, hide_index=True)
+
+    # --- 結果顯示 ---
+    results, summary = session_store.get_results(session_id)
+    with st.expander("詳細計算結果", expanded=True):
+        if results is not None:
+            results_grid_panel(session_store, session_id)
+        else:
+            st.info("點擊「開始分析」以生成結果。")
+
+    with st.expander("總結報告", expanded=True):
+        if summary is not None:
+            st.dataframe(summary, use_container_width=True)
+        else:
+            st.info("點擊「開始分析」以生成總結報告。")
+
+    # --- 視覺化圖表 ---
+    with st.expander("視覺化圖表", expanded=True):
+        if results is not None:
+            visualization_panel(session_store, session_id)
+        else:
+            st.info("點擊「開始分析」以生成圖表。")
+
+    # --- 匯出功能 ---
+    with st.expander("匯出分析結果", expanded=False):
+        if results is not None:
+            export_panel(df_merged, results, summary)
+        else:
+            st.info("點擊「開始分析」以生成可匯出的報告。")
+
+    # --- 多推廣方案比較 ---
+    with st.expander("多推廣方案比較", expanded=False):
+        campaign_panel(uploaded_file_a)
+
+    # --- 歷史記錄 ---
+    if Config.RUN_STORE_ENABLED:
+        with st.expander("歷史分析記錄", expanded=False):
+            run_history_panel(get_run_store())
+
+    with st.sidebar:
+        st.header("記憶體用量")
+        st.caption(f"本會話數據：{session_store.session_bytes(session_id) / 1024 ** 2:.1f} MB ／ "
+                   f"伺服器總計：{session_store.total_bytes() / 1024 ** 2:.1f} MB "
+                   f"(上限 {Config.SESSION_MEMORY_CAP_BYTES / 1024 ** 2:.0f} MB)")
+        registry = metrics.get_registry()
+        if registry is not None:
+            metrics.set_gauge('session_memory_bytes', session_store.total_bytes())
+            with st.expander("效能指標 (除錯)", expanded=False):
+                st.caption(f"Prometheus 端點：http://{Config.METRICS_HOST}:{Config.METRICS_PORT}/metrics")
+                st.dataframe(registry.snapshot(), use_container_width=True, hide_index=True)
+
+    metrics.observe('section_duration_seconds', time.perf_counter() - page_start, section='page')
+
+    # --- 依賴檢查 ---
+    try:
+        import openpyxl
+        import matplotlib
+        import seaborn
+    except ImportError:
+        st.error("缺少必要套件，請根據 requirements.txt 檔案安裝。")
+
+
+if __name__ == "__main__":
+    main()
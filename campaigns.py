@@ -0,0 +1,131 @@
+import io
+import logging
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+CAMPAIGN_COLUMN = 'Campaign'
+# 方案編號與 Group No. 之間的分隔符，不會出現在檔案內容中
+_KEY_SEPARATOR = '\x1f'
+COMPARISON_COLUMNS = [
+    CAMPAIGN_COLUMN, 'Groups', 'Total_Demand', 'Total_Dispatch', 'DN_Dispatch', 'Buyer_Order_Qty',
+    'D001_Shortfall', 'D001_Shortfall_SKUs'
+]
+
+
+def _report(progress_callback, progress, message):
+    if progress_callback is not None:
+        progress_callback(progress, message)
+
+
+def stack_campaigns(df_a, campaigns):
+    """把已清理的檔案 A 分別與每個方案的檔案 B 合併，按方案順序疊加並加上 Campaign 欄位。
+
+    campaigns 為 [(方案名稱, df_b1, df_b2)]，方案名稱不可重複。
+    """
+    from app import merge_data
+
+    labels = [label for label, _, _ in campaigns]
+    if len(set(labels)) != len(labels):
+        raise ValueError(f"推廣方案名稱重複：{labels}")
+    frames = [merge_data(df_a, df_b1, df_b2).assign(**{CAMPAIGN_COLUMN: label})
+              for label, df_b1, df_b2 in campaigns]
+    return pd.concat(frames, ignore_index=True)
+
+
+def calculate_campaigns(df_stacked, lead_time, parallel=False, progress_callback=None):
+    """對 stack_campaigns() 的結果一次計算所有方案，返回帶 Campaign 欄位的 (results, summary)。
+
+    Group No. 暫時加上方案編號，使多 SKU 組判斷、按 (Group No., Site) 聚合及總結都只在
+    同一方案內進行；每個方案的結果與單獨調用 calculate_demand 相同。
+    """
+    from app import calculate_demand
+    from parallel_demand import calculate_demand_parallel
+
+    if df_stacked is None or df_stacked.empty:
+        return pd.DataFrame(), pd.DataFrame()
+    campaigns = pd.Index(df_stacked[CAMPAIGN_COLUMN].unique())
+    codes = campaigns.get_indexer(df_stacked[CAMPAIGN_COLUMN])
+    keys = pd.Series(codes.astype(str), index=df_stacked.index) + _KEY_SEPARATOR + df_stacked['Group No.'].astype(str)
+
+    df = df_stacked.drop(columns=CAMPAIGN_COLUMN).assign(**{'Group No.': keys})
+    if parallel:
+        results, summary = calculate_demand_parallel(df, lead_time, progress_callback=progress_callback)
+    else:
+        results, summary = calculate_demand(df, lead_time, progress_callback=progress_callback)
+    if results.empty:
+        return results, summary
+
+    # 還原原始的 Group No. (保留其數據類型) 並加上方案名稱；結果行順序與輸入相同
+    results['Group No.'] = df_stacked['Group No.'].to_numpy()
+    results.insert(0, CAMPAIGN_COLUMN, df_stacked[CAMPAIGN_COLUMN].to_numpy())
+
+    lookup = pd.DataFrame({'key': keys, 'code': codes, 'group': df_stacked['Group No.']}).drop_duplicates('key')
+    summary = summary.merge(lookup, left_on='Group No.', right_on='key', how='left', validate='many_to_one')
+    summary['Group No.'] = summary.pop('group')
+    summary.insert(0, CAMPAIGN_COLUMN, campaigns[summary['code'].to_numpy()])
+    # 各方案的總結按方案順序排列，方案內與 calculate_demand 相同按 (Group No., SKU) 排序
+    summary = pd.concat(
+        [part.sort_values(['Group No.', 'SKU'], kind='stable') for _, part in summary.groupby('code', sort=True)],
+        ignore_index=True,
+    ).drop(columns=['key', 'code'])
+    return results, summary
+
+
+def compare_campaigns(results, summary):
+    """每個方案一行的比較表：推廣組別數 (不含未匹配行)、總需求、總派貨量、DN 派貨量、
+    Buyer 訂貨量及 D001 缺口。
+
+    D001_Shortfall 為各 (Group No., SKU) 的總派貨量超出 D001 庫存的部分之和，
+    D001_Shortfall_SKUs 為標記「D001 缺貨」的行數。
+    """
+    if summary is None or summary.empty:
+        return pd.DataFrame(columns=COMPARISON_COLUMNS)
+    campaigns = pd.Index(summary[CAMPAIGN_COLUMN].unique())
+    shortfall = (summary['Total_Dispatch'] - summary['D001_SaSa_Net_Stock']).clip(lower=0)
+    by_campaign = summary.assign(Shortfall=shortfall).groupby(CAMPAIGN_COLUMN, sort=False)
+    comparison = pd.DataFrame({
+        'Groups': by_campaign['Group No.'].agg(lambda groups: groups[groups.astype(str) != ''].nunique()),
+        'Total_Demand': by_campaign['Total_Demand'].sum(),
+        'Total_Dispatch': by_campaign['Total_Dispatch'].sum(),
+        'D001_Shortfall': by_campaign['Shortfall'].sum(),
+        'D001_Shortfall_SKUs': by_campaign['Out_of_Stock_Warning'].agg(lambda s: int((s == 'D001 缺貨').sum())),
+    })
+
+    qty = results['Suggested Dispatch Qty'].where(results['Site'] != 'D001', 0)
+    by_type = qty.groupby([results[CAMPAIGN_COLUMN], results['Dispatch Type']]).sum().unstack(fill_value=0)
+    comparison['DN_Dispatch'] = by_type.get('需生成 DN', 0)
+    comparison['Buyer_Order_Qty'] = by_type.get('Buyer需要訂貨', 0)
+    comparison = comparison.reindex(campaigns).fillna(0)
+    int_cols = ['Groups', 'Total_Dispatch', 'DN_Dispatch', 'Buyer_Order_Qty', 'D001_Shortfall', 'D001_Shortfall_SKUs']
+    comparison[int_cols] = comparison[int_cols].astype(np.int64)
+    return comparison.rename_axis(CAMPAIGN_COLUMN).reset_index()[COMPARISON_COLUMNS]
+
+
+def run_campaigns(df_a, campaigns, lead_time, parallel=False, progress_callback=None):
+    """背景作業入口：合併、計算並比較所有推廣方案，失敗時拋出例外讓作業標記為失敗。"""
+    _report(progress_callback, 2, f"合併 {len(campaigns)} 個推廣方案...")
+    df_stacked = stack_campaigns(df_a, campaigns)
+    with metrics.timer('calculate_duration_seconds', mode='campaigns'):
+        results, summary = calculate_campaigns(df_stacked, lead_time, parallel=parallel,
+                                               progress_callback=progress_callback)
+    metrics.inc('calculate_rows_total', len(df_stacked), mode='campaigns')
+    if results.empty and not df_stacked.empty:
+        raise RuntimeError("計算需求時發生錯誤，詳情請查看 app.log。")
+    comparison = compare_campaigns(results, summary)
+    logging.info("Campaign comparison completed", extra={
+        'stage': 'campaigns', 'campaigns': len(campaigns), 'file_a_rows': len(df_a),
+        'result_rows': len(results), 'lead_time': lead_time,
+    })
+    return {'results': results, 'summary': summary, 'comparison': comparison}
+
+
+def export_campaign_comparison(comparison, summary):
+    """把比較表及各方案的總結匯出為 Excel (bytes)。"""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        comparison.to_excel(writer, sheet_name='Campaign Comparison', index=False)
+        summary.to_excel(writer, sheet_name='Campaign Summary', index=False)
+    return buffer.getvalue()
@@ -0,0 +1,124 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import seaborn as sns
+
+from config import Config
+
+MAX_TICK_LABELS = 20
+
+
+def top_n_with_others(sku_data, n, sort_by='Total Demand', label_column='Article'):
+    """保留 sort_by 最大的 n 個 SKU，其餘合併為一個 "Others" 行。
+
+    SKU 數量不超過 n 時原樣返回，圖表與逐 SKU 繪製時相同。
+    """
+    if len(sku_data) <= n:
+        return sku_data
+    ordered = sku_data.sort_values(sort_by, ascending=False, kind='stable')
+    top, rest = ordered.iloc[:n], ordered.iloc[n:]
+    # 逐列求和建立 Others 行，使數值列保持原有 dtype (Series.to_frame().T 會變成 object)
+    others = {column: [rest[column].sum()] for column in top.columns if column != label_column}
+    others[label_column] = [f"Others ({len(rest)} SKUs)"]
+    return pd.concat([top, pd.DataFrame(others, columns=top.columns)], ignore_index=True)
+
+
+def _bin_labels(labels, bins):
+    """每個分箱以「首個…末個」標籤表示；單一成員的分箱直接用其標籤。"""
+    result = []
+    for members in bins:
+        if len(members) == 1:
+            result.append(str(labels[members[0]]))
+        else:
+            result.append(f"{labels[members[0]]}…{labels[members[-1]]} ({len(members)})")
+    return result
+
+
+def bin_matrix(df, index='Site', columns='Article', values='Net Demand', max_rows=None, max_columns=None):
+    """把 index×columns 的數值矩陣按行列分箱求和，返回 (矩陣, 行標籤, 列標籤)。
+
+    行列數未超過上限時每個分箱只有一個成員，結果等同 pivot_table(aggfunc='sum')。
+    超過上限時，行按名稱排序後等分；列按總值由高至低排序後等分，使需求相近的
+    Article 落在同一分箱。沒有任何數據的格子為 NaN。
+    """
+    data = df[[index, columns, values]].dropna(subset=[index, columns])
+    row_codes, row_labels = pd.factorize(data[index], sort=True)
+    col_codes, col_labels = pd.factorize(data[columns], sort=True)
+    weights = data[values].fillna(0).to_numpy(dtype=float)
+    return bin_codes(row_codes, row_labels, col_codes, col_labels, weights, max_rows, max_columns)
+
+
+def bin_codes(row_codes, row_labels, col_codes, col_labels, weights, max_rows=None, max_columns=None):
+    """bin_matrix 的核心：行列已編碼為整數 (每個標籤至少出現一次)，只處理非空格子。"""
+    max_rows = max_rows or Config.HEATMAP_MAX_ROWS
+    max_columns = max_columns or Config.HEATMAP_MAX_COLUMNS
+    if len(col_labels) > max_columns:
+        totals = np.bincount(col_codes, weights=weights, minlength=len(col_labels))
+        order = np.argsort(-totals, kind='stable')
+    else:
+        order = np.arange(len(col_labels))
+    row_bins = np.array_split(np.arange(len(row_labels)), min(len(row_labels), max_rows))
+    col_bins = np.array_split(order, min(len(col_labels), max_columns))
+
+    row_bin_of = np.empty(len(row_labels), dtype=int)
+    for i, members in enumerate(row_bins):
+        row_bin_of[members] = i
+    col_bin_of = np.empty(len(col_labels), dtype=int)
+    for j, members in enumerate(col_bins):
+        col_bin_of[members] = j
+
+    shape = (len(row_bins), len(col_bins))
+    flat = row_bin_of[row_codes] * shape[1] + col_bin_of[col_codes]
+    sums = np.bincount(flat, weights=weights, minlength=shape[0] * shape[1])
+    counts = np.bincount(flat, minlength=shape[0] * shape[1])
+    matrix = np.where(counts > 0, sums, np.nan).reshape(shape)
+    return matrix, _bin_labels(row_labels, row_bins), _bin_labels(col_labels, col_bins)
+
+
+def _sparse_ticks(labels):
+    step = max(1, int(np.ceil(len(labels) / MAX_TICK_LABELS)))
+    positions = np.arange(0, len(labels), step)
+    return positions, [labels[i] for i in positions]
+
+
+def plot_sku_bars(sku_data, title, top_n=None):
+    """繪製 SKU 需求 vs 庫存柱狀圖；SKU 過多時只畫前 top_n 個及 "Others"。"""
+    top_n = top_n or Config.CHART_TOP_N_SKUS
+    plot_data = top_n_with_others(sku_data, top_n)
+    fig, ax = plt.subplots()
+    plot_data.plot(x='Article', y=['Total Demand', 'Stock Available'], kind='bar', ax=ax)
+    ax.set_title(title)
+    ax.set_ylabel("Quantity")
+    ax.set_xlabel("Article")
+    ax.tick_params(axis='x', rotation=90)
+    fig.tight_layout()
+    return fig, len(plot_data) < len(sku_data)
+
+
+def plot_heatmap(matrix, row_labels, col_labels, title):
+    """繪製淨需求熱圖。
+
+    格子不多於 Config.HEATMAP_ANNOTATE_MAX_CELLS 時沿用逐格標註的 seaborn
+    熱圖；否則以單張光柵圖像繪製，不畫逐格文字，繪圖時間與格子數基本無關。
+    """
+    if matrix.size <= Config.HEATMAP_ANNOTATE_MAX_CELLS:
+        frame = pd.DataFrame(matrix, index=row_labels, columns=col_labels)
+        fig, ax = plt.subplots(figsize=(12, max(6, len(row_labels) * 0.5)))
+        sns.heatmap(frame, annot=True, fmt=".0f", cmap=Config.HEATMAP_COLORMAP, ax=ax)
+    else:
+        fig, ax = plt.subplots(figsize=(12, 8))
+        image = ax.imshow(np.ma.masked_invalid(matrix), aspect='auto', interpolation='nearest',
+                          cmap=Config.HEATMAP_COLORMAP, rasterized=True)
+        fig.colorbar(image, ax=ax)
+        for axis, labels, set_ticks, set_labels in (
+            ('x', col_labels, ax.set_xticks, ax.set_xticklabels),
+            ('y', row_labels, ax.set_yticks, ax.set_yticklabels),
+        ):
+            positions, tick_labels = _sparse_ticks(labels)
+            set_ticks(positions)
+            set_labels(tick_labels, fontsize=8, rotation=90 if axis == 'x' else 0)
+        ax.set_xlabel("Article")
+        ax.set_ylabel("Site")
+    ax.set_title(title)
+    fig.tight_layout()
+    return fig
@@ -19,6 +19,17 @@ class Config:
     MAX_FILE_SIZE_MB = 50
     MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
     
+    # 必要欄位及工作表配置
+    REQUIRED_COLUMNS_A = [
+        'Article', 'Article Description', 'RP Type', 'Site', 'MOQ',
+        'SaSa Net Stock', 'Pending Received', 'Safety Stock',
+        'Last Month Sold Qty', 'MTD Sold Qty', 'Supply source', 'Description p. group'
+    ]
+    REQUIRED_COLUMNS_B1 = ['Group No.', 'Article', 'SKU Target', 'Target Type', 'Promotion Days', 'Target Cover Days']
+    REQUIRED_COLUMNS_B2 = ['Site', 'Shop Target(HK)', 'Shop Target(MO)', 'Shop Target(ALL)']
+    SHEET1_CANDIDATES = ['Sheet1', 'Sheet 1']
+    SHEET2_CANDIDATES = ['Sheet2', 'Sheet 2']
+    
     # 數據處理配置
     MAX_ABNORMAL_VALUE = 100000
     DEFAULT_LEAD_TIME = 2.5
@@ -46,6 +57,13 @@ class Config:
     LOG_FILE = "app.log"
     LOG_LEVEL = "INFO"
     LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+    LOG_JSON = True  # 另外把每條記錄輸出為一行 JSON，附帶 run_id、檔案雜湊、行數及各階段耗時
+    LOG_JSON_FILE = "app.jsonl"  # JSON 日誌檔 (不納入版本控制)；app.log 保持純文字
+    LOG_ROTATION = 'size'  # 'size' 按大小輪替，'time' 按時間輪替
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_ROTATION_WHEN = 'midnight'  # LOG_ROTATION 為 'time' 時的輪替時間點
+    LOG_BACKUP_COUNT = 5
+    LOG_QUEUE_SIZE = 10000  # 寫入佇列上限，佇列已滿時丟棄記錄而不阻塞分析
     
     # 匯出配置
     EXPORT_FILE_PREFIX = "Promotion_Demand_Report"
@@ -64,6 +82,13 @@ class Config:
     PIE_CHART_COLORS = ['#ff9999', '#66b3ff', '#99ff99', '#ffcc99', '#ff99cc', '#c2c2f0']
     HEATMAP_COLORMAP = "viridis"
     MAX_HEATMAP_DATA_POINTS = 20
+    CHART_TOP_N_SKUS = 30  # 柱狀圖最多顯示的 SKU 數，其餘合併為 "Others"
+    HEATMAP_MAX_ROWS = 60  # 熱圖的 Site 分箱上限
+    HEATMAP_MAX_COLUMNS = 120  # 熱圖的 Article 分箱上限
+    HEATMAP_ANNOTATE_MAX_CELLS = 400  # 不多於此格子數時才逐格標註數值
+    # 稀疏 Site×Article 矩陣保存的數值欄位 (sparse_matrix.py)
+    SPARSE_MATRIX_VALUES = ['Net Demand', 'Total Demand', 'SaSa Net Stock', 'Pending Received',
+                            'Suggested Dispatch Qty']
     MAX_SCATTER_POINTS = 100
     SCATTER_ALPHA = 0.6
     SCATTER_COLOR = '#1f77b4'
@@ -74,6 +99,92 @@ class Config:
     # 快取配置
     CACHE_TTL = 3600  # 1小時
     
+    # 背景作業配置
+    MAX_CONCURRENT_JOBS = 2  # 每個伺服器同時執行的分析作業數
+    MAX_QUEUED_JOBS = 4  # 超出並行數後允許排隊的作業數
+    JOB_POLL_INTERVAL = 0.5  # UI 輪詢作業狀態的間隔 (秒)
+    JOB_RETENTION_SECONDS = 3600  # 已結束作業的保留時間
+    
+    # 平行計算配置
+    PARALLEL_ENABLED = False  # 側邊欄「平行計算模式」的預設值
+    PARALLEL_MAX_WORKERS = None  # None 表示使用全部 CPU 核心
+    PARALLEL_MIN_ROWS = 50000  # 少於此行數時直接單進程計算
+    PARALLEL_PARTITIONS_PER_WORKER = 4  # 每個子進程分配的分區數，用於平衡負載
+    PARALLEL_TRANSFER = 'arrow'  # 分區傳輸格式：'arrow' 或 'pickle'
+    PARALLEL_START_METHOD = 'spawn'  # 子進程啟動方式，避免在多執行緒伺服器中 fork
+    INGEST_PARALLEL_MIN_BYTES = 2 * 1024 * 1024  # 多個檔案 A 總大小超過此值時才使用進程池解析
+    
+    # 分析記錄庫配置
+    RUN_STORE_ENABLED = True  # 分析完成後自動保存到本地記錄庫
+    RUN_STORE_DIR = "run_store"
+    RUN_STORE_MAX_RUNS = 50  # 最多保留的運行數，超出時刪除最舊的運行 (0 表示不限)
+    RUN_STORE_MAX_AGE_DAYS = 30  # 刪除早於此天數的運行 (0 表示不限)；最近一次運行一律保留
+    RUN_STORE_ROW_GROUP_SIZE = 10000  # Parquet 行組大小，決定分頁查詢的最小讀取單位
+    RUN_HISTORY_PAGE_SIZE = 100
+    
+    # 結果表格配置
+    RESULTS_GRID_FILTER_COLUMNS = ['Group No.', 'Article', 'Site', 'Dispatch Type', 'Out_of_Stock_Warning']
+    RESULTS_GRID_SORT_COLUMNS = ['Group No.', 'Article', 'Site', 'Dispatch Type', 'Out_of_Stock_Warning', 'Total Demand',
+                                 'Net Demand', 'Suggested Dispatch Qty']
+    RESULTS_GRID_PAGE_SIZES = [50, 100, 200, 500]
+    
+    # 數據快照配置 (多個伺服器進程共用已清理的檔案)
+    DATASET_STORE_ENABLED = False  # 在同一主機運行多個 Streamlit 進程時啟用
+    DATASET_STORE_DIR = "dataset_store"
+    DATASET_STORE_MAX_IDLE_SECONDS = 24 * 3600  # 沒有引用且閒置超過此秒數的快照會被刪除
+    
+    # 銷售歷史配置 (sales_history.py)
+    SALES_HISTORY_DIR = "sales_history"
+    SALES_HISTORY_WINDOW_MONTHS = 3  # 滾動日均銷量涵蓋的最近月數
+    SALES_HISTORY_MIN_MONTHS = 1  # 少於此月數的 (Article, Site) 仍使用 Last Month Sold Qty / 30
+    
+    # 批量派貨檔案配置 (dispatch_files.py)
+    BULK_EXPORT_FORMAT = 'xlsx'  # 各收件人檔案的格式：'xlsx' 或 'csv'
+    BULK_EXPORT_SKIP_ZERO_QTY = True  # 略過建議派貨量為 0 的行
+    BULK_EXPORT_BATCH_FILES = 25  # 每個子進程任務生成的檔案數
+    BULK_EXPORT_PARALLEL_MIN_FILES = 50  # 少於此檔案數時在本進程依序生成
+    DN_FILE_COLUMNS = [
+        'Site', 'Article', 'Article Description', 'Group No.', 'Suggested Dispatch Qty', 'MOQ',
+        'SaSa Net Stock', 'Pending Received', 'Net Demand', 'Notes'
+    ]
+    BUYER_ORDER_FILE_COLUMNS = [
+        'Description p. group', 'Article', 'Article Description', 'Site', 'Supply source', 'Group No.',
+        'Suggested Dispatch Qty', 'MOQ', 'Net Demand', 'Notes'
+    ]
+    
+    # 效能指標配置
+    METRICS_ENABLED = False  # 關閉時所有埋點只檢查一次全域變數，不收集數據
+    METRICS_HOST = "127.0.0.1"
+    METRICS_PORT = 9464  # Prometheus 文字格式端點 http://127.0.0.1:9464/metrics；0 表示由系統分配
+    METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # 秒
+    METRICS_SIZE_BUCKETS = tuple(2 ** power for power in range(16, 29, 2))  # 64 KB 至 256 MB
+    
+    # 負載測試配置 (load_test.py)
+    LOAD_TEST_LEVELS = [1, 2, 4, 8]  # 依次測試的並行會話數
+    LOAD_TEST_ROWS = 2000  # 每個模擬會話上傳的檔案 A 行數
+    LOAD_TEST_MAX_P95_SECONDS = 2.0  # 可接受的 p95 重新執行延遲
+    LOAD_TEST_TIMEOUT = 120  # 每次重新執行及等待分析完成的上限 (秒)
+    
+    # 外存計算配置 (out_of_core.py，處理超出記憶體的檔案 A)
+    OUT_OF_CORE_BATCH_ROWS = 500000  # 每次讀入及寫出的行數
+    OUT_OF_CORE_BUCKETS = 64  # 磁碟分桶數；每個桶須能完整載入記憶體
+    OUT_OF_CORE_WORK_DIR = None  # 暫存分桶檔案的目錄，None 表示系統臨時目錄
+    
+    # 會話數據配置
+    SESSION_MEMORY_CAP_BYTES = 2 * 1024 ** 3  # 所有會話數據的總上限，超出時按 LRU 釋放其他會話
+    SESSION_IDLE_SECONDS = 300  # 閒置超過此秒數的會話壓縮為 Arrow IPC
+    SESSION_RETENTION_SECONDS = 24 * 3600  # 閒置超過此秒數的會話直接移除
+    SESSION_COMPRESSION = 'zstd'  # Arrow IPC 壓縮：'zstd'、'lz4' 或 None
+    
+    # 本地 HTTP API 配置
+    API_HOST = "127.0.0.1"  # 只綁定本機
+    API_PORT = 8600
+    API_WORKERS = 2  # 預熱的子進程數
+    API_MAX_QUEUE = 8  # 超出子進程數後允許排隊的請求數，再多則返回 503
+    API_FILE_B_CACHE_SIZE = 8  # 每個子進程快取的檔案 B 數量
+    API_LATENCY_WINDOW = 1000  # 計算延遲百分位數的最近請求數
+    API_MAX_REQUEST_BYTES = 4 * MAX_FILE_SIZE_BYTES  # base64 編碼後兩個檔案的上限
+    
     # 資料處理配置
     QUANTITY_COLUMNS = ['SaSa Net Stock', 'Pending Received', 'Safety Stock', 'Last Month Sold Qty', 'MTD Sold Qty', 'SKU Target', 'Shop Target(HK)', 'Shop Target(MO)', 'Shop Target(ALL)']
     OUTLIER_THRESHOLD = 10000
@@ -247,7 +358,7 @@ SUCCESS_MESSAGES = {
 
 # 依賴包配置
 REQUIRED_PACKAGES = {
-    'streamlit': 'streamlit>=1.28.0',
+    'streamlit': 'streamlit>=1.52.0',
     'pandas': 'pandas>=2.0.0',
     'numpy': 'numpy>=1.24.0',
     'openpyxl': 'openpyxl>=3.1.0',
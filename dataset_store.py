@@ -0,0 +1,223 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+
+import pyarrow as pa
+
+import metrics
+from config import Config
+from run_store import _to_arrow
+
+# 清理邏輯 (clean_file_a / clean_file_b) 改變時遞增，使舊的快照失效
+CLEANING_VERSION = 1
+
+
+def dataset_key(kind, content_hash):
+    """由數據類型 (例如 'file_a'、'file_b1') 及原始檔案的內容雜湊組成快照鍵。"""
+    return f"{kind}-{content_hash}-v{CLEANING_VERSION}"
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name != 'posix':
+        # Windows 上 os.kill(pid, 0) 會結束目標進程，無法安全探測，視為存活
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class DatasetHandle:
+    """已開啟的快照；table 直接映射磁碟檔案。
+
+    引用在 close() 之後、且 to_pandas() 返回的所有數據框都被回收後才釋放，
+    使 cleanup() 不會刪除仍在使用中的快照。
+    """
+
+    def __init__(self, store, key, table, ref_path):
+        self.store = store
+        self.key = key
+        self.table = table
+        self._ref_path = ref_path
+        self._closed = False
+        self._frames = 0
+        self._lock = threading.Lock()
+
+    def to_pandas(self):
+        """轉為 pandas；數值欄位盡量沿用映射的緩衝區而不複製。"""
+        df = self.table.to_pandas(split_blocks=True)
+        with self._lock:
+            if self._ref_path is not None:
+                self._frames += 1
+                weakref.finalize(df, self._frame_released)
+        return df
+
+    def _frame_released(self):
+        with self._lock:
+            self._frames -= 1
+            self._release_if_unused()
+
+    def _release_if_unused(self):
+        if self._closed and not self._frames and self._ref_path is not None:
+            self.store._release(self._ref_path)
+            self._ref_path = None
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._release_if_unused()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class DatasetStore:
+    """同一主機上多個進程共用的已清理數據快照。
+
+    每個快照以 Arrow IPC 檔案格式寫入 `<root>/<key>.arrow` 一次 (寫入臨時檔後
+    原子改名)，任何進程都可用記憶體映射零複製開啟，共用作業系統的頁面快取。
+    每次開啟在 `<root>/<key>.refs/` 下建立一個以 pid 命名的引用檔，關閉時刪除；
+    cleanup() 只會刪除沒有存活引用且閒置超過時限的快照。
+    """
+
+    def __init__(self, root_dir=None, max_idle_seconds=None):
+        self.root_dir = root_dir or Config.DATASET_STORE_DIR
+        self.max_idle_seconds = max_idle_seconds if max_idle_seconds is not None \
+            else Config.DATASET_STORE_MAX_IDLE_SECONDS
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _data_path(self, key):
+        return os.path.join(self.root_dir, f'{key}.arrow')
+
+    def _refs_dir(self, key):
+        return os.path.join(self.root_dir, f'{key}.refs')
+
+    def contains(self, key):
+        return os.path.exists(self._data_path(key))
+
+    def put(self, key, df):
+        """寫入快照 (已存在時不重寫)，返回檔案路徑。"""
+        path = self._data_path(key)
+        if os.path.exists(path):
+            return path
+        table = _to_arrow(df)
+        tmp_path = f'{path}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp'
+        try:
+            with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logging.info(f"Dataset {key} stored: {table.num_rows} rows, {os.path.getsize(path)} bytes")
+        return path
+
+    def open(self, key):
+        """以記憶體映射開啟快照並登記引用；快照不存在時返回 None。"""
+        if not self.contains(key):
+            metrics.inc('cache_requests_total', cache='dataset_store', result='miss')
+            return None
+        metrics.inc('cache_requests_total', cache='dataset_store', result='hit')
+        refs_dir = self._refs_dir(key)
+        os.makedirs(refs_dir, exist_ok=True)
+        ref_path = os.path.join(refs_dir, f'{os.getpid()}-{uuid.uuid4().hex[:8]}')
+        open(ref_path, 'w').close()
+        try:
+            source = pa.memory_map(self._data_path(key), 'r')
+        except FileNotFoundError:
+            self._release(ref_path)
+            return None
+        table = pa.ipc.open_file(source).read_all()
+        return DatasetHandle(self, key, table, ref_path)
+
+    def load_or_build(self, keys, build):
+        """返回 keys 對應的數據框元組；任一快照不存在時調用 build() 生成並寫入。
+
+        build() 返回與 keys 等長的數據框元組，返回 None (例如驗證失敗) 時不寫入
+        並返回 None。
+        """
+        handles = [self.open(key) for key in keys]
+        try:
+            if all(handle is not None for handle in handles):
+                return tuple(handle.to_pandas() for handle in handles)
+        finally:
+            # 已轉出的數據框在被回收前仍持有引用
+            for handle in handles:
+                if handle is not None:
+                    handle.close()
+        frames = build()
+        if frames is None:
+            return None
+        for key, df in zip(keys, frames):
+            self.put(key, df)
+        self.cleanup()
+        return frames
+
+    def _release(self, ref_path):
+        try:
+            os.remove(ref_path)
+        except FileNotFoundError:
+            pass
+        # 引用目錄的修改時間即最後使用時間
+        try:
+            os.utime(os.path.dirname(ref_path))
+        except FileNotFoundError:
+            pass
+
+    def refcount(self, key):
+        """存活進程持有的引用數；已結束進程遺留的引用檔會被移除。"""
+        refs_dir = self._refs_dir(key)
+        if not os.path.isdir(refs_dir):
+            return 0
+        count = 0
+        for name in os.listdir(refs_dir):
+            pid = int(name.split('-', 1)[0])
+            if _pid_alive(pid):
+                count += 1
+            else:
+                self._release(os.path.join(refs_dir, name))
+        return count
+
+    def _last_used(self, key):
+        paths = [self._data_path(key), self._refs_dir(key)]
+        return max(os.path.getmtime(path) for path in paths if os.path.exists(path))
+
+    def keys(self):
+        return sorted(name[:-len('.arrow')] for name in os.listdir(self.root_dir) if name.endswith('.arrow'))
+
+    def cleanup(self, max_idle_seconds=None):
+        """刪除沒有引用且閒置超過 max_idle_seconds 的快照，返回被刪除的鍵。"""
+        max_idle_seconds = self.max_idle_seconds if max_idle_seconds is None else max_idle_seconds
+        now = time.time()
+        removed = []
+        for key in self.keys():
+            if self.refcount(key) or now - self._last_used(key) < max_idle_seconds:
+                continue
+            # 在 POSIX 上，已映射該檔案的進程在刪除後仍可繼續讀取
+            try:
+                os.remove(self._data_path(key))
+            except FileNotFoundError:
+                continue
+            except PermissionError:
+                # Windows 上仍被映射的檔案無法刪除，留待下次清理
+                continue
+            shutil.rmtree(self._refs_dir(key), ignore_errors=True)
+            removed.append(key)
+        if removed:
+            logging.info(f"Dataset store cleanup removed {len(removed)} snapshots")
+        return removed
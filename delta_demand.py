@@ -0,0 +1,143 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from parallel_demand import ROW_ID_COLUMN, merge_partition_results
+
+KEY_COLUMNS = ['Article', 'Site']
+
+
+class DeltaReport:
+    """增量計算的變更報告。"""
+
+    def __init__(self, total_rows, added=0, removed=0, changed=0, affected_groups=None,
+                 recomputed_rows=0, full_recompute=False, reason='', changes=None):
+        self.total_rows = total_rows
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.affected_groups = affected_groups or []
+        self.recomputed_rows = recomputed_rows
+        self.full_recompute = full_recompute
+        self.reason = reason
+        self.changes = changes if changes is not None else pd.DataFrame(columns=KEY_COLUMNS + ['Change'])
+
+    def describe(self):
+        """返回供 UI 顯示的一行摘要。"""
+        if self.full_recompute:
+            return f"已完整重新計算 {self.total_rows} 行 ({self.reason})"
+        return (f"增量計算：新增 {self.added}、移除 {self.removed}、變更 {self.changed} 行；"
+                f"重新計算 {len(self.affected_groups)} 個組別共 {self.recomputed_rows}/{self.total_rows} 行")
+
+
+def _row_hashes(df, columns):
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+def _key_index(df):
+    return pd.MultiIndex.from_frame(df[KEY_COLUMNS].astype(str))
+
+
+def _group_keys(df):
+    """Group No. 的分區鍵；未匹配的行 (空白或缺失) 歸入同一個鍵。"""
+    return df['Group No.'].where(df['Group No.'].notna(), '').astype(str)
+
+
+def diff_merged(previous, current):
+    """按 (Article, Site) 比對前後兩次的合併數據，返回 (新增, 移除, 變更) 的布林遮罩。
+
+    返回的新增及變更遮罩對齊 current 的行，移除遮罩對齊 previous 的行。
+    """
+    columns = list(current.columns)
+    prev_keys, curr_keys = _key_index(previous), _key_index(current)
+    prev_hash = pd.Series(_row_hashes(previous, columns), index=prev_keys)
+    curr_hash = _row_hashes(current, columns)
+
+    matched = curr_keys.isin(prev_keys)
+    added = ~matched
+    changed = np.zeros(len(current), dtype=bool)
+    changed[matched] = prev_hash.reindex(curr_keys[matched]).to_numpy() != curr_hash[matched]
+    removed = ~prev_keys.isin(curr_keys)
+    return added, removed, changed
+
+
+def calculate_demand_delta(prev_merged, prev_results, prev_summary, prev_lead_time,
+                           new_merged, lead_time, progress_callback=None):
+    """以上一次運行為基準，只重新計算受影響組別的需求。
+
+    File B 不變時，某行的計算結果只取決於其 Group No. 內的行，因此只需對
+    包含新增、移除或變更行的組別重新執行 calculate_demand，其餘行直接沿用
+    上一次的結果。返回 (results, summary, DeltaReport)；無法安全增量計算時
+    (例如 Lead Time 或欄位不同、鍵重複) 會退回完整計算。
+    """
+    from app import calculate_demand, report_progress
+
+    def full(reason):
+        logging.info(f"Delta recompute fell back to full calculation: {reason}")
+        results, summary = calculate_demand(new_merged, lead_time, progress_callback=progress_callback)
+        return results, summary, DeltaReport(len(new_merged), full_recompute=True, reason=reason,
+                                             recomputed_rows=len(new_merged))
+
+    if new_merged is None or new_merged.empty:
+        return full("沒有數據")
+    if prev_merged is None or prev_results is None or prev_summary is None:
+        return full("沒有可用的基準運行")
+    if float(prev_lead_time) != float(lead_time):
+        return full("Lead Time 與基準運行不同")
+    if list(prev_merged.columns) != list(new_merged.columns):
+        return full("欄位與基準運行不同")
+    if len(prev_merged) != len(prev_results):
+        return full("基準運行的結果與合併數據不對應")
+    if prev_merged.duplicated(KEY_COLUMNS).any() or new_merged.duplicated(KEY_COLUMNS).any():
+        return full("存在重複的 (Article, Site) 鍵")
+
+    report_progress(progress_callback, 10, "比對檔案 A 的變更...")
+    prev_merged = prev_merged.reset_index(drop=True)
+    new_merged = new_merged.reset_index(drop=True)
+    added, removed, changed = diff_merged(prev_merged, new_merged)
+
+    prev_groups, new_groups = _group_keys(prev_merged), _group_keys(new_merged)
+    affected = set(new_groups[added | changed]) | set(prev_groups[removed])
+    # 變更的行可能改變了所屬組別，其原組別同樣受影響
+    changed_keys = _key_index(new_merged)[changed]
+    affected |= set(prev_groups[_key_index(prev_merged).isin(changed_keys)])
+
+    changes = pd.concat([
+        new_merged.loc[added, KEY_COLUMNS].assign(Change='新增'),
+        prev_merged.loc[removed, KEY_COLUMNS].assign(Change='移除'),
+        new_merged.loc[changed, KEY_COLUMNS].assign(Change='變更'),
+    ], ignore_index=True)
+
+    recompute_mask = new_groups.isin(affected).to_numpy()
+    report = DeltaReport(len(new_merged), added=int(added.sum()), removed=int(removed.sum()),
+                         changed=int(changed.sum()), affected_groups=sorted(affected),
+                         recomputed_rows=int(recompute_mask.sum()), changes=changes)
+
+    parts = []
+    keep_positions = np.flatnonzero(~recompute_mask)
+    if len(keep_positions):
+        # 未受影響的行：按鍵找回上一次運行中對應的結果行
+        prev_position = pd.Series(np.arange(len(prev_merged)), index=_key_index(prev_merged))
+        source = prev_position.reindex(_key_index(new_merged)[keep_positions]).to_numpy()
+        kept = prev_results.iloc[source].reset_index(drop=True)
+        kept[ROW_ID_COLUMN] = keep_positions
+        kept_summary = prev_summary[~prev_summary['Group No.'].astype(str).isin(affected)]
+        parts.append((kept, kept_summary))
+
+    if recompute_mask.any():
+        report_progress(progress_callback, 30, f"重新計算 {len(affected)} 個受影響的組別...")
+        subset = new_merged[recompute_mask].copy()
+        subset[ROW_ID_COLUMN] = np.flatnonzero(recompute_mask)
+        results, summary = calculate_demand(subset, lead_time)
+        if results.empty:
+            raise RuntimeError("計算需求時發生錯誤，詳情請查看 app.log。")
+        parts.append((results, summary))
+
+    report_progress(progress_callback, 90, "合併增量結果...")
+    results, summary = merge_partition_results(parts)
+    results = results[list(prev_results.columns)]
+    summary = summary[list(prev_summary.columns)]
+    report_progress(progress_callback, 100, "計算完成")
+    logging.info(f"Delta recompute: {report.describe()}")
+    return results, summary, report
@@ -6,12 +6,49 @@ Version: 1.0
 """
 
 import os
+import re
 import sys
+import json
+import compileall
 import subprocess
 import logging
+import tempfile
 from pathlib import Path
 import shutil
 
+SAMPLE_INVENTORY_FILE = 'sample_inventory_data.xlsx'
+SAMPLE_PROMOTION_FILE = 'sample_promotion_data.xlsx'
+
+# Runs in a fresh interpreter: times the app import and one end-to-end
+# analysis (load, calculate, render charts, export) on the sample files.
+ANALYSIS_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import app
+from charts import bin_matrix, plot_heatmap, plot_sku_bars
+timings = {"startup": time.perf_counter() - start}
+
+start = time.perf_counter()
+df_merged, _ = app.load_data(sys.argv[1], sys.argv[2])
+results, summary = app.calculate_demand(df_merged, 2.5)
+if results.empty:
+    raise SystemExit("sample analysis produced no results")
+chart_data = results[results["Site"] != "D001"].copy()
+chart_data["Stock Available"] = chart_data["SaSa Net Stock"] + chart_data["Pending Received"]
+sku_data = chart_data.groupby("Article")[["Total Demand", "Stock Available"]].sum().reset_index()
+figures = [plot_sku_bars(sku_data, "warm-up")[0], plot_heatmap(*bin_matrix(chart_data), "warm-up")]
+for figure in figures:
+    figure.canvas.draw()
+    plt.close(figure)
+app.export_to_excel(df_merged, results, summary)
+timings["first_analysis"] = time.perf_counter() - start
+timings["rows"] = len(results)
+print(json.dumps(timings))
+'''
+
 def setup_logging():
     """Setup logging configuration"""
     logging.basicConfig(
@@ -71,6 +108,64 @@ def create_sample_data():
         logger.error(f"Error creating sample data: {e}")
         return False
 
+def measure_startup(env=None):
+    """Time app import and the first analysis in a fresh interpreter"""
+    result = subprocess.run(
+        [sys.executable, '-c', ANALYSIS_PROBE, SAMPLE_INVENTORY_FILE, SAMPLE_PROMOTION_FILE],
+        capture_output=True, text=True, env=env
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'probe failed')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def prebuild_font_cache():
+    """Build matplotlib's font cache so the first chart does not scan system fonts"""
+    # Importing font_manager loads the cache, scanning system fonts if it is missing
+    subprocess.check_call([sys.executable, '-c', 'import matplotlib.font_manager'])
+
+def compile_bytecode():
+    """Compile application modules to bytecode ahead of the first import"""
+    return compileall.compile_dir('.', quiet=1, rx=re.compile(r'deployment_package|run_store|[/\\]\.'))
+
+def remove_bytecode(path='.'):
+    """Delete the application's __pycache__ so the next import compiles from source"""
+    shutil.rmtree(Path(path) / '__pycache__', ignore_errors=True)
+
+def measure_cold_startup():
+    """Time the probe with no application bytecode and an empty matplotlib cache directory"""
+    # run_tests() and earlier steps have already imported the app, so drop their bytecode first;
+    # a temporary MPLCONFIGDIR makes matplotlib rebuild its font cache as on a fresh host
+    remove_bytecode()
+    with tempfile.TemporaryDirectory() as mpl_dir:
+        return measure_startup(dict(os.environ, MPLCONFIGDIR=mpl_dir))
+
+def warm_up():
+    """Warm caches on this host before the first user and log cold vs warm latencies
+
+    The matplotlib font cache is written to the current user's matplotlib config
+    directory, so this must run on the target host as the user that runs the app.
+    """
+    try:
+        logger.info("Warming up application...")
+        if not (os.path.exists(SAMPLE_INVENTORY_FILE) and os.path.exists(SAMPLE_PROMOTION_FILE)):
+            create_sample_data()
+
+        cold = measure_cold_startup()
+        prebuild_font_cache()
+        if not compile_bytecode():
+            logger.warning("Some modules failed to compile")
+        # The end-to-end run on sample data populates the remaining caches
+        warm = measure_startup()
+
+        for stage in ('startup', 'first_analysis'):
+            logger.info(f"Warm-up {stage}: cold {cold[stage]:.2f}s, warm {warm[stage]:.2f}s "
+                        f"({cold[stage] / max(warm[stage], 1e-6):.1f}x)")
+        logger.info(f"Warm-up analysis processed {warm['rows']} rows")
+        return True
+    except Exception as e:
+        logger.error(f"Error during warm-up: {e}")
+        return False
+
 def validate_environment():
     """Validate deployment environment"""
     required_files = ['app.py', 'requirements.txt', 'config.py']
@@ -99,7 +194,10 @@ def create_deployment_package():
         # Copy essential files
         essential_files = [
             'app.py', 'requirements.txt', 'config.py', 'VERSION.md', 'README.md',
-            'DEPLOYMENT.md', 'sample_data_generator.py'
+            'DEPLOYMENT.md', 'sample_data_generator.py', 'api_server.py', 'campaigns.py', 'charts.py',
+            'dataset_store.py', 'delta_demand.py', 'dispatch_files.py', 'ingest.py', 'jobs.py',
+            'logging_setup.py', 'metrics.py', 'parallel_demand.py', 'out_of_core.py', 'results_grid.py',
+            'run_store.py', 'sales_history.py', 'session_store.py', 'sparse_matrix.py'
         ]
         
         for file in essential_files:
@@ -107,11 +205,16 @@ def create_deployment_package():
                 shutil.copy2(file, deploy_dir)
         
         # Copy sample data if exists
-        sample_files = ['sample_inventory.xlsx', 'sample_promotion.xlsx']
+        sample_files = [SAMPLE_INVENTORY_FILE, SAMPLE_PROMOTION_FILE]
         for file in sample_files:
             if os.path.exists(file):
                 shutil.copy2(file, deploy_dir)
         
+        # Ship bytecode for this interpreter version; the font cache is per user and built by warm_up()
+        remove_bytecode(deploy_dir)
+        if not compileall.compile_dir(deploy_dir, quiet=1, maxlevels=0):
+            logger.warning("Some packaged modules failed to compile")
+        
         logger.info(f"Deployment package created in {deploy_dir}")
         return True
     except Exception as e:
@@ -145,7 +248,11 @@ def main():
     if not run_tests():
         logger.warning("Some tests failed, continuing...")
     
-    # Step 6: Create deployment package
+    # Step 6: Warm up caches
+    if not warm_up():
+        logger.warning("Warm-up failed, the first user may see cold-start latency")
+    
+    # Step 7: Create deployment package
     if not create_deployment_package():
         return False
     
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Bulk dispatch note and buyer order file generation
+Author: Ricky
+
+Splits analysis results in one pass into one dispatch note (DN) file per
+site for rows marked 需生成 DN and one order file per buyer group
+(Description p. group) for rows marked Buyer需要訂貨, renders the files in
+parallel and streams them into a single zip archive with a manifest.
+Only a bounded window of rendered files is held in memory at any time.
+
+Usage:
+    python dispatch_files.py --run-id 20240101120000-abcd1234 --output dispatch.zip
+    python dispatch_files.py --results results.parquet --output dispatch.zip --format csv
+"""
+
+import argparse
+import io
+import logging
+import os
+import re
+import tempfile
+import zipfile
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+from parallel_demand import decode_frame, encode_frame, get_executor
+
+DN_TYPE = '需生成 DN'
+BUYER_TYPE = 'Buyer需要訂貨'
+# (檔案類型, zip 內資料夾, 工作表名稱, 欄位的 Config 屬性)
+FILE_KINDS = {
+    'DN': ('DN', 'Dispatch Note', 'DN_FILE_COLUMNS'),
+    'PO': ('Buyer', 'Buyer Order', 'BUYER_ORDER_FILE_COLUMNS'),
+}
+MANIFEST_COLUMNS = ['file', 'kind', 'recipient', 'rows', 'total_qty']
+
+
+def _report(progress_callback, progress, message):
+    if progress_callback is not None:
+        progress_callback(progress, message)
+
+
+def _safe_name(value):
+    name = re.sub(r'[\\/:*?"<>|\s]+', '_', str(value)).strip('_.')
+    return name or 'blank'
+
+
+def plan_files(results, skip_zero_qty=None):
+    """一次分組 results，返回每個收件人的檔案：[(zip 內路徑, 類型, 收件人, 行位置)]。
+
+    需生成 DN 的行按 Site 分組，Buyer需要訂貨 的行按 Description p. group 分組；
+    skip_zero_qty 為真時略過建議派貨量為 0 的行。檔案按 (類型, 收件人) 排序。
+    """
+    skip_zero_qty = Config.BULK_EXPORT_SKIP_ZERO_QTY if skip_zero_qty is None else skip_zero_qty
+    if results is None or results.empty:
+        return []
+    dispatch_type = results['Dispatch Type'].to_numpy()
+    is_dn = dispatch_type == DN_TYPE
+    mask = is_dn | (dispatch_type == BUYER_TYPE)
+    if skip_zero_qty:
+        mask &= results['Suggested Dispatch Qty'].to_numpy() > 0
+    positions = np.flatnonzero(mask)
+
+    # 檔案 A 沒有 Description p. group 時，全部 Buyer 訂貨行歸入同一檔案
+    buyer_group = results['Description p. group'] if 'Description p. group' in results.columns else ''
+    recipient = results['Site'].where(pd.Series(is_dn, index=results.index), buyer_group)
+    keys = pd.DataFrame({
+        'kind': np.where(is_dn[positions], 'DN', 'PO'),
+        'recipient': recipient.iloc[positions].fillna('').astype(str).to_numpy(),
+    })
+    files = []
+    used_paths = set()
+    for (kind, recipient), rows in sorted(keys.groupby(['kind', 'recipient']).indices.items()):
+        folder = FILE_KINDS[kind][0]
+        path = f"{folder}/{kind}_{_safe_name(recipient)}"
+        # 不同收件人在清理檔名後可能相同，加上序號區分
+        suffix = 1
+        while path in used_paths:
+            suffix += 1
+            path = f"{folder}/{kind}_{_safe_name(recipient)}_{suffix}"
+        used_paths.add(path)
+        files.append((path, kind, recipient, positions[rows]))
+    return files
+
+
+def render_file(df, kind, fmt):
+    """生成一個收件人的檔案內容 (bytes)。"""
+    if fmt == 'csv':
+        return df.to_csv(index=False).encode('utf-8-sig')
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name=FILE_KINDS[kind][1], index=False)
+    return buffer.getvalue()
+
+
+def _render_batch(payload, slices, fmt):
+    """子進程入口：frame 包含一批檔案的行，slices 為各檔案的 (類型, 起始, 結束)。"""
+    frame = decode_frame(payload)
+    return [render_file(frame.iloc[start:end][_columns(kind, frame)], kind, fmt) for kind, start, end in slices]
+
+
+def _columns(kind, df):
+    return [col for col in getattr(Config, FILE_KINDS[kind][2]) if col in df.columns]
+
+
+def _batches(results, files, batch_files):
+    """把檔案按順序分批，每批返回 (檔案列表, 該批的行, 各檔案在該批中的切片)。"""
+    columns = list(dict.fromkeys(_columns('DN', results) + _columns('PO', results)))
+    for start in range(0, len(files), batch_files):
+        batch = files[start:start + batch_files]
+        frame = results.iloc[np.concatenate([rows for _, _, _, rows in batch])][columns].reset_index(drop=True)
+        bounds = np.cumsum([0] + [len(rows) for _, _, _, rows in batch])
+        slices = [(kind, int(bounds[i]), int(bounds[i + 1])) for i, (_, kind, _, _) in enumerate(batch)]
+        yield batch, frame, slices
+
+
+def _render_all(results, files, fmt, max_workers):
+    """按順序產生 (檔案列表, 檔案內容列表)；平行時最多同時有 2 × max_workers 批在處理中。"""
+    batches = _batches(results, files, Config.BULK_EXPORT_BATCH_FILES)
+    if max_workers <= 1 or len(files) < Config.BULK_EXPORT_PARALLEL_MIN_FILES:
+        for batch, frame, slices in batches:
+            yield batch, [render_file(frame.iloc[start:end][_columns(kind, frame)], kind, fmt)
+                          for kind, start, end in slices]
+        return
+
+    executor = get_executor(max_workers)
+    pending = deque()
+    try:
+        for batch, frame, slices in batches:
+            pending.append((batch, executor.submit(_render_batch, encode_frame(frame), slices, fmt)))
+            if len(pending) >= 2 * max_workers:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+        while pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+    except BaseException:
+        for _, future in pending:
+            future.cancel()
+        raise
+
+
+def write_dispatch_zip(results, output, fmt=None, max_workers=None, progress_callback=None):
+    """生成各店舖 DN 及各 Buyer 組訂貨檔案，逐個寫入 zip 並返回檔案清單。
+
+    output 為路徑或可寫入的檔案物件 (可以不支援 seek，例如 HTTP 回應串流)。
+    zip 內另附 manifest.csv，列出每個檔案的收件人、行數及建議派貨總量。
+    """
+    fmt = fmt or Config.BULK_EXPORT_FORMAT
+    if fmt not in ('xlsx', 'csv'):
+        raise ValueError(f"不支援的檔案格式：{fmt}")
+    max_workers = max_workers or Config.PARALLEL_MAX_WORKERS or os.cpu_count() or 1
+    # xlsx 本身已是壓縮格式，不再重複壓縮
+    compression = zipfile.ZIP_STORED if fmt == 'xlsx' else zipfile.ZIP_DEFLATED
+
+    _report(progress_callback, 5, "按店舖及 Buyer 組別分拆...")
+    files = plan_files(results)
+    manifest = []
+    with zipfile.ZipFile(output, 'w', compression=compression) as archive:
+        for batch, contents in _render_all(results, files, fmt, max_workers):
+            for (path, kind, recipient, rows), content in zip(batch, contents):
+                archive.writestr(f"{path}.{fmt}", content)
+                manifest.append({
+                    'file': f"{path}.{fmt}", 'kind': kind, 'recipient': recipient, 'rows': len(rows),
+                    'total_qty': int(results['Suggested Dispatch Qty'].iloc[rows].sum()),
+                })
+            _report(progress_callback, 5 + int(90 * len(manifest) / len(files)),
+                    f"已生成 {len(manifest)}/{len(files)} 個檔案...")
+        manifest = pd.DataFrame(manifest, columns=MANIFEST_COLUMNS)
+        archive.writestr('manifest.csv', manifest.to_csv(index=False).encode('utf-8-sig'),
+                         compress_type=zipfile.ZIP_DEFLATED)
+    logging.info(f"Dispatch archive written: {len(manifest)} files ({fmt}), {max_workers} workers")
+    _report(progress_callback, 100, "派貨檔案已生成")
+    return manifest
+
+
+@contextmanager
+def build_dispatch_archive(results, fmt=None):
+    """把 zip 生成到磁碟上的臨時檔案，並以已定位到開頭的檔案對象進入 with 區塊；離開時關閉並刪除臨時檔案。
+
+    生成期間記憶體只保存正在處理的檔案批次。更大的匯出請使用命令行或 api_server 的
+    /runs/<run_id>/dispatch.zip，兩者都直接寫出而不保存整個 zip。
+    """
+    with tempfile.TemporaryFile() as spool:
+        write_dispatch_zip(results, spool, fmt=fmt)
+        spool.seek(0)
+        yield spool
+
+
+def dispatch_archive_bytes(results, fmt=None):
+    """供 st.download_button 在點擊時調用：Streamlit 送出下載時本來就會把 zip 讀入記憶體，
+    因此在這裡讀出並隨即關閉臨時檔案，不留下未關閉的檔案。"""
+    with build_dispatch_archive(results, fmt=fmt) as archive:
+        return archive.read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk dispatch note and buyer order files')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--run-id', help='analysis run saved in the run store')
+    source.add_argument('--results', help='results file (.parquet or .xlsx)')
+    parser.add_argument('--output', required=True, help='zip archive path')
+    parser.add_argument('--format', choices=['xlsx', 'csv'], default=Config.BULK_EXPORT_FORMAT)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format=Config.LOG_FORMAT)
+    if args.run_id:
+        from run_store import RunStore
+        results = RunStore().load_frame(args.run_id, 'results')
+    elif args.results.lower().endswith('.parquet'):
+        results = pd.read_parquet(args.results)
+    else:
+        results = pd.read_excel(args.results, sheet_name='Calculation Results', dtype={'Article': str, 'Site': str})
+    manifest = write_dispatch_zip(results, args.output, fmt=args.format, max_workers=args.workers)
+    counts = manifest['kind'].value_counts()
+    logging.info(f"Wrote {counts.get('DN', 0)} dispatch notes and {counts.get('PO', 0)} buyer order files "
+                 f"to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
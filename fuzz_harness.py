@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+Differential fuzz harness for the demand calculation
+Author: Ricky
+
+Keeps a frozen copy of calculate_demand as the reference implementation,
+generates randomized File A / File B inputs that go through the same
+cleaning and merge steps as load_data, and checks that alternate engines
+(parallel, delta, out-of-core, or any future vectorized rewrite) produce identical
+results and summaries. Each check reports the engine's speedup over the
+reference.
+
+Usage:
+    python fuzz_harness.py [--cases 20] [--seed 0] [--engines current parallel delta out_of_core]
+"""
+
+import argparse
+import time
+import traceback
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+
+
+# --- 參考實現 ---
+def reference_calculate_demand(df, lead_time):
+    """calculate_demand 的凍結參考實現 (不含進度回報及錯誤處理)。
+
+    請勿修改：優化後的引擎均以此函數的輸出為準。
+    """
+    if df is None or df.empty:
+        return pd.DataFrame(), pd.DataFrame()
+
+    # 複製數據框以避免修改原始數據
+    df_calc = df.copy()
+
+    # 1. 計算每日銷售率
+    df_calc['Daily Sales Rate'] = (df_calc['Last Month Sold Qty'] / 30).apply(lambda x: max(0, x))
+
+    # 2. 確定推廣目標係數
+    df_calc['Site Target %'] = df_calc.apply(
+        lambda row: row['Shop Target(HK)'] if row['Target Type'] == 'HK'
+        else (row['Shop Target(MO)'] if row['Target Type'] == 'MO'
+              else (row['Shop Target(ALL)'] if row['Target Type'] == 'ALL' else 0)),
+        axis=1
+    )
+
+    # 3. 計算日常銷售需求
+    df_calc['Regular Demand'] = df_calc['Daily Sales Rate'] * (df_calc['Target Cover Days'] + lead_time)
+
+    # 4. 計算推廣特定需求
+    df_calc['Promo Demand'] = df_calc['SKU Target'] * df_calc['Site Target %']
+
+    # 5. 計算總需求
+    # 對於多 SKU 組，需要先聚合
+    group_sku_counts = df_calc.groupby('Group No.')['Article'].nunique()
+    multi_sku_groups = group_sku_counts[group_sku_counts > 1].index
+
+    # 初始化 Total Demand (浮點數，以容納非整數的需求值)
+    df_calc['Total Demand'] = 0.0
+
+    # 單 SKU 組
+    single_sku_mask = ~df_calc['Group No.'].isin(multi_sku_groups)
+    df_calc.loc[single_sku_mask, 'Total Demand'] = df_calc.loc[single_sku_mask, 'Regular Demand'] + df_calc.loc[single_sku_mask, 'Promo Demand']
+
+    # 多 SKU 組
+    if not multi_sku_groups.empty:
+        # 按 Group No. 和 Site 聚合 Regular Demand
+        agg_regular_demand = df_calc[df_calc['Group No.'].isin(multi_sku_groups)].groupby(['Group No.', 'Site'])['Regular Demand'].sum().reset_index()
+        agg_regular_demand.rename(columns={'Regular Demand': 'Aggregated Regular Demand'}, inplace=True)
+
+        # 將聚合後的需求合併回主數據框
+        df_calc = pd.merge(df_calc, agg_regular_demand, on=['Group No.', 'Site'], how='left')
+        df_calc['Aggregated Regular Demand'] = df_calc['Aggregated Regular Demand'].fillna(0)
+
+        # 計算多 SKU 組的 Total Demand
+        multi_sku_mask = df_calc['Group No.'].isin(multi_sku_groups)
+        df_calc.loc[multi_sku_mask, 'Total Demand'] = df_calc.loc[multi_sku_mask, 'Aggregated Regular Demand'] + df_calc.loc[multi_sku_mask, 'Promo Demand']
+        df_calc.drop(columns=['Aggregated Regular Demand'], inplace=True)
+
+
+    # 6. 計算淨需求
+    df_calc['Net Demand'] = df_calc['Total Demand'] - (df_calc['SaSa Net Stock'] + df_calc['Pending Received']) + df_calc['Safety Stock']
+
+    # 7. 計算派貨建議
+    # 新邏輯: 派貨數量需為 MOQ 的倍數，且不小於 MOQ
+    
+    # 步驟 1: 確定基礎派貨量，至少為 Net Demand 和 MOQ 中的較大者
+    base_dispatch_qty = np.maximum(df_calc['Net Demand'], df_calc['MOQ'])
+    
+    # 步驟 2: 將基礎派貨量向上取整至 MOQ 的最接近倍數
+    moq = df_calc['MOQ']
+    # 為避免除以零的錯誤，只在 MOQ > 0 時執行計算
+    final_dispatch_qty = np.where(
+        moq > 0,
+        np.ceil(base_dispatch_qty / moq) * moq,
+        base_dispatch_qty # 若 MOQ 為 0，則回退到基礎派貨量
+    )
+    
+    # 步驟 3: 僅對 RP Type 為 'RF' 的項目應用此邏輯
+    df_calc['Suggested Dispatch Qty'] = np.where(
+        df_calc['RP Type'] == 'RF',
+        final_dispatch_qty,
+        0
+    )
+    
+    # 步驟 4: 清理數據，確保為非負整數
+    df_calc['Suggested Dispatch Qty'] = df_calc['Suggested Dispatch Qty'].clip(lower=0).fillna(0).astype(int)
+
+    # 8. 確定派貨類型
+    df_calc['Dispatch Type'] = np.where(
+        df_calc['Site'] == 'D001',
+        'D001',
+        np.where(
+            df_calc['RP Type'] == 'ND',
+            'ND',
+            np.where(
+                df_calc['Supply source'].isin([1, 4]),
+                'Buyer需要訂貨',
+                np.where(df_calc['Supply source'] == 2, '需生成 DN', '')
+            )
+        )
+    )
+    
+    # 更新 Notes
+    df_calc['Notes'] += f'Lead Time={lead_time}日; '
+
+    # 9. 聚合摘要表 (按 Group No. 和 SKU)
+    # 1. 分離 D001 和非 D001 數據
+    df_non_d001 = df_calc[df_calc['Site'] != 'D001'].copy()
+    df_d001 = df_calc[df_calc['Site'] == 'D001'].copy()
+
+    # 2. 從非 D001 數據創建基礎總結
+    summary_base = df_non_d001.groupby(['Group No.', 'Article']).agg(
+        Total_Demand=('Total Demand', 'sum'),
+        Total_Stock=('SaSa Net Stock', 'sum'),
+        Total_Pending=('Pending Received', 'sum'),
+        Total_Dispatch=('Suggested Dispatch Qty', 'sum')
+    ).reset_index()
+
+    # 3. 創建 D001 庫存總結
+    if not df_d001.empty:
+        d001_stock_cols = ['SaSa Net Stock', 'In Quality Insp.', 'Blocked', 'Pending Received']
+        for col in d001_stock_cols:
+            if col not in df_d001.columns:
+                df_d001[col] = 0
+        
+        d001_summary = df_d001.groupby(['Group No.', 'Article']).agg(
+            D001_SaSa_Net_Stock=('SaSa Net Stock', 'sum'),
+            D001_In_Quality_Insp=('In Quality Insp.', 'sum'),
+            D001_Blocked=('Blocked', 'sum'),
+            D001_Pending_Received=('Pending Received', 'sum')
+        ).reset_index()
+    else:
+        d001_summary = pd.DataFrame(columns=['Group No.', 'Article', 'D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received'])
+
+    # 4. 合併基礎總結和 D001 庫存
+    summary_final = pd.merge(summary_base, d001_summary, on=['Group No.', 'Article'], how='left')
+
+    # 5. 填充 NaN 並設置數據類型
+    fill_cols = ['D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received']
+    for col in fill_cols:
+        summary_final[col] = summary_final[col].fillna(0).astype(int)
+
+    # 6. 添加計算欄位
+    summary_final['Total_Stock_Available'] = summary_final['Total_Stock'] + summary_final['Total_Pending']
+    
+    # 更新 Out_of_Stock_Warning 邏輯
+    # 優先級 1: 檢查 D001 是否有足夠的庫存來應對總派貨量
+    # 優先級 2: 如果 D001 庫存充足，再檢查非 D001 門市的庫存是否滿足其需求
+    summary_final['Out_of_Stock_Warning'] = np.where(
+        summary_final['Total_Dispatch'] > summary_final['D001_SaSa_Net_Stock'],
+        'D001 缺貨',
+        np.where(summary_final['Total_Demand'] > summary_final['Total_Stock_Available'], 'Y', 'N')
+    )
+
+    # 將 'Article' 重命名為 'SKU'
+    summary_final.rename(columns={'Article': 'SKU'}, inplace=True)
+
+    # 重新排序欄位
+    final_cols = [
+        'Group No.', 'SKU', 'Total_Demand', 'Total_Stock', 'Total_Pending', 'Total_Stock_Available', 'Total_Dispatch',
+        'D001_SaSa_Net_Stock', 'D001_In_Quality_Insp', 'D001_Blocked', 'D001_Pending_Received', 'Out_of_Stock_Warning'
+    ]
+    summary_final = summary_final[final_cols]
+
+    return df_calc, summary_final
+
+
+# --- 隨機輸入 ---
+TARGET_TYPES = ['HK', 'MO', 'ALL', '', 'XX']
+
+
+def _dirty_numbers(rng, values, invalid_rate=0.03):
+    """把部分數值換成負數或無效字串，以覆蓋 clean_file_a 的修正邏輯。"""
+    values = values.astype(object)
+    values[rng.random(len(values)) < invalid_rate] = -5
+    values[rng.random(len(values)) < invalid_rate] = 'N/A'
+    return values
+
+
+def _padded(rng, values):
+    """隨機為鍵值加上首尾空格 (clean_file_a / clean_file_b 會去除)。"""
+    values = np.asarray(values, dtype=object)
+    pad = rng.random(len(values)) < 0.1
+    values[pad] = [f' {value} ' for value in values[pad]]
+    return values
+
+
+def generate_raw_inputs(rng, num_rows=None):
+    """生成未清理的檔案 A 及檔案 B 兩個工作表，返回 (df_a, df_b1, df_b2)。
+
+    覆蓋多 SKU 及單 SKU 組別、D001 行、MOQ 為 0、ND/RF 混合、未匹配的
+    Article 及 Site、無效的 Target Type 以及負數、無效和異常的數值。
+    約三分之一的案例使用數值 Group No. (合併後因未匹配行變為 float64)。
+    每個 (Article, Site) 只出現一次，與實際的庫存報表一致。
+    """
+    num_rows = num_rows or int(rng.integers(1, 600))
+    num_sites = int(rng.integers(1, 30))
+    # 指定行數較大時增加 Article 數量，確保有足夠不重複的 (Article, Site)
+    num_articles = max(int(rng.integers(1, 40)), -(-num_rows // (num_sites + 1)))
+    articles = np.array([f'A{i:04d}' for i in range(num_articles)])
+    sites = np.array(['D001'] + [f'S{i:03d}' for i in range(num_sites)])
+
+    keys = rng.choice(len(articles) * len(sites), size=min(num_rows, len(articles) * len(sites)), replace=False)
+    article, site = articles[keys // len(sites)], sites[keys % len(sites)]
+    n = len(keys)
+
+    df_a = pd.DataFrame({
+        'Article': _padded(rng, article),
+        'Article Description': [f'Item {a}' for a in article],
+        'RP Type': rng.choice(['RF', 'ND'], n, p=[0.7, 0.3]),
+        'Site': _padded(rng, site),
+        'MOQ': _dirty_numbers(rng, rng.choice([0, 1, 6, 12, 24], n)),
+        'SaSa Net Stock': _dirty_numbers(rng, rng.integers(0, 300, n)),
+        'Pending Received': _dirty_numbers(rng, rng.integers(0, 50, n)),
+        'Safety Stock': _dirty_numbers(rng, rng.integers(0, 20, n)),
+        'Last Month Sold Qty': _dirty_numbers(rng, rng.choice([0, 3, 30, 450, 150000], n, p=[.2, .3, .3, .17, .03])),
+        'MTD Sold Qty': _dirty_numbers(rng, rng.integers(0, 200, n)),
+        'Supply source': rng.choice([1, 2, 3, 4], n),
+        'Description p. group': rng.choice(['Skin Care', 'Make Up', 'Fragrance'], n),
+    })
+    if rng.random() < 0.5:
+        df_a['In Quality Insp.'] = rng.integers(0, 10, n)
+        df_a['Blocked'] = rng.integers(0, 5, n)
+
+    # 約八成 Article 有推廣目標；組別大小 1-4，同時產生單 SKU 及多 SKU 組
+    promoted = rng.permutation(articles)[:max(1, int(num_articles * 0.8))]
+    # 是否使用數值組別按店舖數決定，不額外抽取隨機數，既有 seed 的其餘數據保持不變
+    numeric_groups = num_sites % 3 == 0
+    group_ids, group_no = [], 0
+    while len(group_ids) < len(promoted):
+        group_ids.extend([1001 + group_no if numeric_groups else f'G{group_no:03d}'] * int(rng.integers(1, 5)))
+        group_no += 1
+    m = len(promoted)
+    df_b1 = pd.DataFrame({
+        'Group No.': group_ids[:m],
+        'Article': _padded(rng, promoted),
+        'SKU Target': rng.integers(0, 500, m),
+        'Target Type': rng.choice(TARGET_TYPES, m),
+        'Promotion Days': rng.integers(1, 30, m),
+        'Target Cover Days': rng.integers(0, 21, m),
+    })
+
+    # 部分 Site 沒有門市目標
+    targeted = rng.permutation(sites)[:max(1, int(len(sites) * 0.9))]
+    k = len(targeted)
+    df_b2 = pd.DataFrame({
+        'Site': _padded(rng, targeted),
+        'Shop Target(HK)': rng.random(k).round(3),
+        'Shop Target(MO)': rng.random(k).round(3),
+        'Shop Target(ALL)': rng.random(k).round(3),
+    })
+    return df_a, df_b1, df_b2
+
+
+def generate_case(rng, num_rows=None):
+    """生成一個經 clean_file_a / clean_file_b / merge_data 處理的合併數據框。"""
+    from app import clean_file_a, clean_file_b, merge_data
+
+    df_a, df_b1, df_b2 = generate_raw_inputs(rng, num_rows)
+    return merge_data(clean_file_a(df_a), *clean_file_b(df_b1, df_b2))
+
+
+def perturb(rng, df, rate=0.1):
+    """模擬前一天的檔案 A：移除、修改部分行，供增量引擎作為基準運行。"""
+    keep = rng.random(len(df)) >= rate
+    previous = df[keep].reset_index(drop=True)
+    changed = rng.random(len(previous)) < rate
+    previous.loc[changed, 'SaSa Net Stock'] = previous.loc[changed, 'SaSa Net Stock'] + 7
+    return previous
+
+
+# --- 引擎適配器 ---
+# 每個引擎接受 (df, lead_time, rng)，返回 (results, summary)。rng 供需要額外
+# 準備 (例如增量引擎的基準運行) 的引擎使用，準備工作不計入計時。
+
+def _current_engine(df, lead_time, rng):
+    from app import calculate_demand
+    return lambda: calculate_demand(df, lead_time)
+
+
+def _parallel_engine(df, lead_time, rng, max_workers=2):
+    from parallel_demand import calculate_demand_parallel
+
+    def run():
+        with mock.patch.object(Config, 'PARALLEL_MIN_ROWS', 0):
+            return calculate_demand_parallel(df, lead_time, max_workers=max_workers)
+    return run
+
+
+def _delta_engine(df, lead_time, rng):
+    from delta_demand import calculate_demand_delta
+
+    previous = perturb(rng, df)
+    prev_results, prev_summary = reference_calculate_demand(previous, lead_time)
+
+    def run():
+        results, summary, _ = calculate_demand_delta(previous, prev_results, prev_summary, lead_time, df, lead_time)
+        return results, summary
+    return run
+
+
+def _as_merged_batch(batch):
+    """模擬 stream_merged 逐批合併：merge_data 把未匹配行的數值 Group No. 填為 0.0，
+    因此只有含未匹配行的批次為 float64，其餘批次為 int64，同一個組別在不同批次的 dtype 不同。"""
+    group = batch['Group No.']
+    if pd.api.types.is_float_dtype(group) and not group.eq(0).any():
+        batch = batch.assign(**{'Group No.': group.astype('int64')})
+    return batch
+
+
+def _out_of_core_engine(df, lead_time, rng):
+    import os
+    import tempfile
+
+    from out_of_core import calculate_demand_out_of_core
+
+    batch_rows = int(rng.integers(1, max(len(df), 1) + 1))
+    num_buckets = int(rng.integers(1, 8))
+
+    def run():
+        batches = (_as_merged_batch(df.iloc[start:start + batch_rows]) for start in range(0, len(df), batch_rows))
+        with tempfile.TemporaryDirectory() as work_dir:
+            output_path = os.path.join(work_dir, 'results.parquet')
+            rows, summary = calculate_demand_out_of_core(batches, lead_time, output_path, work_dir=work_dir,
+                                                         num_buckets=num_buckets)
+            results = pd.read_parquet(output_path) if rows else pd.DataFrame()
+        return results, summary
+    return run
+
+
+ENGINES = {
+    'current': _current_engine,
+    'parallel': _parallel_engine,
+    'delta': _delta_engine,
+    'out_of_core': _out_of_core_engine,
+}
+
+
+# --- 差分檢查 ---
+def _timed(func):
+    start = time.perf_counter()
+    value = func()
+    return value, time.perf_counter() - start
+
+
+def check_engine(engine, cases=20, seed=0, lead_times=(0, 1.5, 2.5, 7), num_rows=None):
+    """對 engine 執行 cases 個隨機案例，逐一與參考實現比對。
+
+    engine 可為 ENGINES 中的名稱或同樣簽名的適配函數。返回每個案例的結果字典
+    (seed、行數、是否一致、差異描述、參考及引擎耗時、加速比)；案例 i 使用
+    seed + i，失敗時可單獨重現。引擎拋出的例外記錄為該案例失敗 (crashed 為 True，
+    error 為完整的 traceback)，其餘案例繼續執行。
+    """
+    adapter = ENGINES[engine] if isinstance(engine, str) else engine
+    report = []
+    for i in range(cases):
+        case_seed = seed + i
+        rng = np.random.default_rng(case_seed)
+        df = generate_case(rng, num_rows)
+        lead_time = lead_times[case_seed % len(lead_times)]
+
+        (expected_results, expected_summary), reference_seconds = _timed(
+            lambda: reference_calculate_demand(df, lead_time))
+        crashed = False
+        try:
+            run = adapter(df, lead_time, rng)
+            (results, summary), engine_seconds = _timed(run)
+            pd.testing.assert_frame_equal(results, expected_results)
+            pd.testing.assert_frame_equal(summary, expected_summary)
+            error = ''
+        except AssertionError as e:
+            engine_seconds, error = float('nan'), str(e)
+        except Exception:
+            engine_seconds, error, crashed = float('nan'), traceback.format_exc(), True
+        report.append({
+            'seed': case_seed,
+            'rows': len(df),
+            'lead_time': lead_time,
+            'ok': not error,
+            'crashed': crashed,
+            'error': error,
+            'reference_seconds': reference_seconds,
+            'engine_seconds': engine_seconds,
+            'speedup': reference_seconds / engine_seconds if engine_seconds else float('nan'),
+        })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Differential fuzz harness for demand engines')
+    parser.add_argument('--cases', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rows', type=int, default=None, help='rows per case (default: random)')
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    args = parser.parse_args(argv)
+
+    failed = False
+    try:
+        for name in args.engines:
+            report = check_engine(name, cases=args.cases, seed=args.seed, num_rows=args.rows)
+            for case in report:
+                status = 'ok' if case['ok'] else ('ERROR' if case['crashed'] else 'MISMATCH')
+                print(f"{name:<9} seed={case['seed']:<5} rows={case['rows']:<6} lead_time={case['lead_time']:<4} "
+                      f"{status:<8} speedup={case['speedup']:.2f}x")
+                if not case['ok']:
+                    print(case['error'])
+            ok = [case for case in report if case['ok']]
+            total_ref = sum(case['reference_seconds'] for case in ok)
+            total_engine = sum(case['engine_seconds'] for case in ok)
+            speedup = total_ref / total_engine if total_engine else float('nan')
+            crashed = sum(case['crashed'] for case in report)
+            print(f"{name}: {len(ok)}/{len(report)} cases identical ({crashed} raised), "
+                  f"overall speedup {speedup:.2f}x\n")
+            failed |= len(ok) != len(report)
+    finally:
+        from parallel_demand import shutdown_executor
+        shutdown_executor()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,110 @@
+import hashlib
+import io
+import logging
+import os
+
+import pandas as pd
+
+from config import Config
+from dataset_store import dataset_key
+from parallel_demand import decode_frame, encode_frame, get_executor
+
+KEY_COLUMNS = ['Article', 'Site']
+
+
+def _file_bytes(file):
+    if isinstance(file, (bytes, bytearray)):
+        return bytes(file)
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            return f.read()
+    if hasattr(file, 'getvalue'):
+        return file.getvalue()
+    file.seek(0)
+    return file.read()
+
+
+def parse_file_a(content, label="檔案 A"):
+    """解析並清理單一檔案 A 的內容；缺少必要欄位時拋出 ValueError。"""
+    from app import clean_file_a
+
+    df_a = pd.read_excel(io.BytesIO(content), sheet_name=0, dtype={'Article': str, 'Site': str})
+    missing_cols = [col for col in Config.REQUIRED_COLUMNS_A if col not in df_a.columns]
+    if missing_cols:
+        raise ValueError(f"{label} 缺少必要欄位：{', '.join(missing_cols)}")
+    return clean_file_a(df_a)
+
+
+def _parse_file_a_worker(content, label):
+    """子進程入口：解析後以 Arrow IPC 傳回主進程。"""
+    return encode_frame(parse_file_a(content, label))
+
+
+def combine_files_a(frames):
+    """按上傳順序合併多個已清理的檔案 A，移除與先前檔案重疊的 (Article, Site) 行。
+
+    重疊行在合併前從各檔案中剔除，只在最後做一次拼接，避免產生中間的完整副本。
+    返回 (合併後的數據框, 移除的重複行數)。
+    """
+    seen = None
+    parts = []
+    duplicates = 0
+    for df in frames:
+        keys = pd.MultiIndex.from_frame(df[KEY_COLUMNS])
+        if seen is not None:
+            overlap = keys.isin(seen)
+            if overlap.any():
+                duplicates += int(overlap.sum())
+                df = df[~overlap]
+                keys = keys[~overlap]
+            seen = seen.append(keys)
+        else:
+            seen = keys
+        parts.append(df)
+    return pd.concat(parts, ignore_index=True), duplicates
+
+
+def read_files_a(files, labels=None, max_workers=None, dataset_store=None):
+    """平行解析多個地區的檔案 A 並合併，返回 (df_a, 重複行數)。
+
+    檔案總大小少於 Config.INGEST_PARALLEL_MIN_BYTES 時在本進程依序解析，
+    避免啟動子進程的開銷超過解析本身。提供 dataset_store 時，已有快照的檔案
+    直接映射開啟，新解析的檔案會寫入快照。
+    """
+    labels = labels or [f"檔案 A ({i + 1})" for i in range(len(files))]
+    contents = [_file_bytes(file) for file in files]
+    frames = [None] * len(files)
+
+    keys = [None] * len(files)
+    if dataset_store is not None:
+        keys = [dataset_key('file_a', hashlib.sha256(content).hexdigest()) for content in contents]
+        for i, key in enumerate(keys):
+            handle = dataset_store.open(key)
+            if handle is not None:
+                with handle:
+                    frames[i] = handle.to_pandas()
+    pending = [i for i, frame in enumerate(frames) if frame is None]
+
+    if sum(len(contents[i]) for i in pending) < Config.INGEST_PARALLEL_MIN_BYTES:
+        for i in pending:
+            frames[i] = parse_file_a(contents[i], labels[i])
+    else:
+        max_workers = max_workers or Config.PARALLEL_MAX_WORKERS or os.cpu_count() or 1
+        executor = get_executor(max_workers)
+        futures = [executor.submit(_parse_file_a_worker, contents[i], labels[i]) for i in pending]
+        try:
+            for i, future in zip(pending, futures):
+                frames[i] = decode_frame(future.result())
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    if dataset_store is not None and pending:
+        for i in pending:
+            dataset_store.put(keys[i], frames[i])
+        dataset_store.cleanup()
+
+    df_a, duplicates = combine_files_a(frames)
+    logging.info(f"Loaded {len(files)} File A workbooks: {len(df_a)} rows, {duplicates} duplicates removed")
+    return df_a, duplicates
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+
+
+class JobCancelled(BaseException):
+    """作業已被使用者取消。
+
+    繼承 BaseException 而非 Exception，使其能穿透 load_data / calculate_demand
+    中的 `except Exception` 區塊，直接中止計算。
+    """
+
+
+class JobLimitError(Exception):
+    """伺服器的分析作業數量已達上限。"""
+
+
+class Job:
+    """單一背景分析作業的狀態。"""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, name):
+        self.job_id = uuid.uuid4().hex
+        self.name = name
+        self.status = Job.QUEUED
+        self.progress = 0
+        self.message = '排隊中，請稍候...'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def done(self):
+        return self.status in (Job.COMPLETED, Job.FAILED, Job.CANCELLED)
+
+    def cancel(self):
+        """請求取消作業；正在執行的作業會在下一個進度回報點中止。"""
+        self._cancel_event.set()
+
+    def report(self, progress, message):
+        """由計算函數回報階段進度 (0-100)，並在此檢查取消請求。"""
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+        with self._lock:
+            self.progress = max(0, min(100, int(progress)))
+            self.message = message
+
+    def snapshot(self):
+        """返回作業狀態的一致快照，供 UI 輪詢使用。"""
+        with self._lock:
+            return {
+                'job_id': self.job_id,
+                'name': self.name,
+                'status': self.status,
+                'progress': self.progress,
+                'message': self.message,
+                'error': self.error,
+                'elapsed': (self.finished_at or time.time()) - (self.started_at or self.created_at),
+            }
+
+    def _set_state(self, status, **fields):
+        with self._lock:
+            self.status = status
+            for key, value in fields.items():
+                setattr(self, key, value)
+
+
+class JobManager:
+    """以有界執行緒池執行分析作業的管理器 (每個伺服器進程一個)。"""
+
+    def __init__(self, max_workers=None, max_queued=None):
+        self.max_workers = max_workers or Config.MAX_CONCURRENT_JOBS
+        self.max_queued = Config.MAX_QUEUED_JOBS if max_queued is None else max_queued
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='analysis-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, name='analysis', **kwargs):
+        """提交作業；func 需接受 `progress_callback` 關鍵字參數。"""
+        with self._lock:
+            self._prune()
+            if self.active_count() >= self.max_workers + self.max_queued:
+                raise JobLimitError(f'同時進行的分析作業已達上限 ({self.max_workers + self.max_queued})')
+            job = Job(name)
+            self._jobs[job.job_id] = job
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None and not job.done:
+            job.cancel()
+            if job.status == Job.QUEUED:
+                job._set_state(Job.CANCELLED, message='已取消', finished_at=time.time())
+        return job
+
+    def active_count(self):
+        return sum(1 for job in list(self._jobs.values()) if not job.done)
+
+    def shutdown(self):
+        for job in list(self._jobs.values()):
+            job.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _prune(self):
+        # 移除已結束且超過保留時間的作業，避免長時間運行的伺服器累積結果
+        cutoff = time.time() - Config.JOB_RETENTION_SECONDS
+        for job_id, job in list(self._jobs.items()):
+            if job.done and job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+    def _run(self, job, func, args, kwargs):
+        if job.cancel_requested:
+            job._set_state(Job.CANCELLED, message='已取消', finished_at=time.time())
+            return
+        job._set_state(Job.RUNNING, started_at=time.time(), message='分析中...')
+        try:
+            result = func(*args, progress_callback=job.report, **kwargs)
+        except JobCancelled:
+            job._set_state(Job.CANCELLED, message='已取消', finished_at=time.time())
+            logging.info(f"Job {job.job_id} cancelled")
+        except Exception as e:
+            job._set_state(Job.FAILED, error=str(e), message='分析失敗', finished_at=time.time())
+            logging.error(f"Job {job.job_id} failed: {e}", exc_info=True)
+        else:
+            job._set_state(Job.COMPLETED, result=result, progress=100, message='分析完成！',
+                           finished_at=time.time())
+            logging.info(f"Job {job.job_id} completed in {job.finished_at - job.started_at:.2f}s")
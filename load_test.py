@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Concurrent-session load test for the Streamlit app
+Author: Ricky
+
+Drives simulated planner sessions through app.py with Streamlit's headless
+AppTest: upload generated File A / File B workbooks, wait for the background
+load job, click 開始分析, wait for the analysis job, pick a Group No. in the
+chart selector and click the Excel report download button. Sessions share one process (and so the
+server-wide job manager, session store and caches), like a real Streamlit
+server. The download click runs the button's deferred callable
+(export_to_excel) the way the server does on a download request.
+
+This is NOT a measurement of concurrent script execution. AppTest swaps a
+process-wide runtime on every run, so script reruns are serialized across
+sessions behind one lock; only the background load/analysis jobs and the
+download callables overlap. The reported rerun latencies are per-session
+timings that include the time spent queued behind other sessions' reruns
+(reported separately as the lock wait), and the capacity is the highest
+level whose serialized rerun latency stays acceptable. To measure true
+parallel reruns, point several browsers or HTTP clients at a running
+`streamlit run app.py` server instead.
+
+For each concurrency level it reports per-step latency percentiles, the
+render time of the full page and of each fragment section, memory growth
+per session and completed sessions per minute; the highest level whose p95
+rerun latency stays under --max-p95 is reported as the capacity. AppTest
+always reruns the whole script, so fragment section times are render costs
+measured inside full reruns, not the latency of a fragment-only rerun.
+
+Usage:
+    python load_test.py [--sessions 1 2 4 8] [--rows 2000] [--seed 0] [--max-p95 2.0]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from config import Config
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+STEPS = ('open', 'upload', 'analyze', 'poll', 'select_group', 'export', 'download')
+EXPORT_BUTTON_LABEL = '📥 下載 Excel 報告'
+
+# AppTest 每次運行都會替換及清除進程全域的 Runtime 實例，不能在多個執行緒中同時運行；
+# 各會話的重新執行因此輪流進行 (背景分析作業仍然並行)，等待時間計入該次延遲。
+# 報告中的延遲是逐個會話串行執行的時間加上排隊時間，並非腳本並行執行時的量度
+_run_lock = threading.Lock()
+
+
+def _rss_bytes():
+    """本進程目前的常駐記憶體 (Linux)；其他平台退回為峰值常駐記憶體。"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        try:
+            import resource
+        except ImportError:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def generate_workbooks(seed, num_rows):
+    """生成一對上傳用的 Excel 檔案 (檔案 A、檔案 B)，返回兩個 bytes。"""
+    from fuzz_harness import generate_raw_inputs
+
+    df_a, df_b1, df_b2 = generate_raw_inputs(np.random.default_rng(seed), num_rows)
+    file_a = io.BytesIO()
+    df_a.to_excel(file_a, index=False)
+    file_b = io.BytesIO()
+    with pd.ExcelWriter(file_b, engine='openpyxl') as writer:
+        df_b1.to_excel(writer, sheet_name='Sheet1', index=False)
+        df_b2.to_excel(writer, sheet_name='Sheet2', index=False)
+    return file_a.getvalue(), file_b.getvalue()
+
+
+# --- 模擬會話 ---
+def _timed_run(at, step, timings, context=contextlib.nullcontext):
+    start = time.perf_counter()
+    with _run_lock, context():
+        script_start = time.perf_counter()
+        at.run()
+    end = time.perf_counter()
+    timings.append((step, end - start, end - script_start))
+    if at.exception:
+        raise RuntimeError(f"{step}: {at.exception[0].value}")
+
+
+def _wait_for_job(at, key, timeout, timings):
+    """重新執行頁面直至 session_state[key] 指向的背景作業 (載入或分析) 完成。"""
+    deadline = time.monotonic() + timeout
+    while at.session_state[key] is not None:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"background job {key} did not finish")
+        time.sleep(Config.JOB_POLL_INTERVAL)
+        _timed_run(at, 'poll', timings)
+
+
+def _find(at, elements, label, step):
+    for element in elements:
+        if element.label == label:
+            return element
+    messages = [element.value for element in list(at.error) + list(at.warning) + list(at.info)]
+    raise RuntimeError(f"{step}: '{label}' not rendered ({'; '.join(messages)})")
+
+
+def _click_download(at, label, timings):
+    """重新執行頁面並點擊下載按鈕：執行按鈕登記的延遲生成函數，如同伺服器收到下載請求。
+
+    AppTest 每次運行都使用新的 MediaFileManager 並在運行後丟棄，因此在運行期間
+    記錄登記延遲函數的 manager，運行結束後再以按鈕的 deferred_file_id 執行。
+    """
+    from streamlit.runtime.media_file_manager import MediaFileManager
+
+    managers = {}
+    add_deferred = MediaFileManager.add_deferred
+
+    def record(manager, *args, **kwargs):
+        file_id = add_deferred(manager, *args, **kwargs)
+        managers[file_id] = manager
+        return file_id
+
+    _timed_run(at, 'export', timings, lambda: mock.patch.object(MediaFileManager, 'add_deferred', record))
+    buttons = [element.proto for element in at.get('download_button') if element.proto.label == label]
+    if not buttons or buttons[0].deferred_file_id not in managers:
+        raise RuntimeError(f"export: download button '{label}' not rendered")
+    file_id = buttons[0].deferred_file_id
+    start = time.perf_counter()
+    managers[file_id].execute_deferred(file_id)
+    elapsed = time.perf_counter() - start
+    timings.append(('download', elapsed, elapsed))
+
+
+def run_session(file_a, file_b, timeout=None):
+    """以一個 AppTest 會話走完上傳、分析、選擇組別及下載報告，返回 [(步驟, 延遲, 腳本執行耗時)]。"""
+    from streamlit.testing.v1 import AppTest
+
+    timeout = timeout or Config.LOAD_TEST_TIMEOUT
+    timings = []
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    _timed_run(at, 'open', timings)
+
+    at.file_uploader[0].set_value(('file_a.xlsx', file_a, XLSX_MIME))
+    at.file_uploader[1].set_value(('file_b.xlsx', file_b, XLSX_MIME))
+    _timed_run(at, 'upload', timings)
+    _wait_for_job(at, 'load_job_id', timeout, timings)
+    if at.error:
+        raise RuntimeError(f"upload: {at.error[0].value}")
+
+    _find(at, at.button, '開始分析', 'analyze').click()
+    _timed_run(at, 'analyze', timings)
+    _wait_for_job(at, 'job_id', timeout, timings)
+    if at.error:
+        raise RuntimeError(f"analyze: {at.error[0].value}")
+
+    selector = _find(at, at.selectbox, 'Select Group No. to analyze', 'select_group')
+    if len(selector.options) > 1:
+        selector.set_value(selector.options[1])
+    _timed_run(at, 'select_group', timings)
+
+    _click_download(at, EXPORT_BUTTON_LABEL, timings)
+    return timings
+
+
+def run_level(concurrency, num_rows=None, seed=0, timeout=None):
+    """同時運行 concurrency 個會話，返回該並行數下的延遲、記憶體及吞吐量統計。"""
+    workbooks = [generate_workbooks(seed + i, num_rows or Config.LOAD_TEST_ROWS) for i in range(concurrency)]
+    errors = []
+    timings = []
+    lock = threading.Lock()
+
+    def session(index):
+        try:
+            result = run_session(*workbooks[index], timeout=timeout)
+            with lock:
+                timings.extend(result)
+        except Exception as e:
+            with lock:
+                errors.append(f"session {index}: {type(e).__name__}: {e}")
+
+    # 每個並行數使用新的指標登錄表，收集各頁面區塊 (整頁或單個 fragment) 的渲染時間
+    metrics.disable()
+    registry = metrics.enable()
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load-session') as pool:
+        list(pool.map(session, range(concurrency)))
+    wall = time.perf_counter() - start
+    rss_after = _rss_bytes()
+
+    metrics.disable()
+
+    completed = concurrency - len(errors)
+    sections = registry.snapshot()
+    sections = sections[sections['metric'] == f'{metrics.NAMESPACE}_section_duration_seconds']
+    sections = sections.assign(section=sections['labels'].str.removeprefix('section='))
+    latencies = pd.DataFrame(timings, columns=['step', 'seconds', 'script_seconds'])
+    reruns = latencies[latencies['step'] != 'download']
+    steps = latencies.groupby('step')['seconds'].describe(percentiles=[0.5, 0.95, 0.99]) if timings else None
+    return {
+        'concurrency': concurrency,
+        'completed': completed,
+        'errors': errors,
+        'wall_seconds': wall,
+        'sessions_per_minute': completed / wall * 60 if wall else 0.0,
+        'rerun_p50': float(reruns['seconds'].quantile(0.5)) if timings else float('nan'),
+        'rerun_p95': float(reruns['seconds'].quantile(0.95)) if timings else float('nan'),
+        'rerun_wait_p95': float((reruns['seconds'] - reruns['script_seconds']).quantile(0.95))
+        if timings else float('nan'),
+        'script_seconds_per_session': latencies['script_seconds'].sum() / completed if completed else float('nan'),
+        'steps': None if steps is None else steps.reindex([s for s in STEPS if s in steps.index]),
+        'rss_growth_per_session': (rss_after - rss_before) / concurrency,
+        'sections': sections.set_index('section')[['value', 'mean', 'p50', 'p95']].rename(columns={'value': 'count'}),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Concurrent-session load test for app.py')
+    parser.add_argument('--sessions', type=int, nargs='+', default=Config.LOAD_TEST_LEVELS,
+                        help='concurrency levels to run, in order')
+    parser.add_argument('--rows', type=int, default=Config.LOAD_TEST_ROWS, help='File A rows per session')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-p95', type=float, default=Config.LOAD_TEST_MAX_P95_SECONDS,
+                        help='p95 rerun latency (seconds) that still counts as acceptable')
+    parser.add_argument('--work-dir', default=None, help='directory for app.log and run_store (default: temporary)')
+    args = parser.parse_args(argv)
+
+    # 分析記錄庫及日誌寫入工作目錄，不影響正式數據
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='load-test-')
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    print(f"Working directory: {work_dir}")
+    print("Note: script reruns are serialized across sessions (AppTest shares one runtime); latencies are "
+          "per-session timings including the wait for other sessions' reruns, not concurrent rerun throughput.")
+
+    capacity = None
+    failed = False
+    for level, concurrency in enumerate(args.sessions):
+        report = run_level(concurrency, args.rows, seed=args.seed + 1000 * level)
+        print(f"\n=== {concurrency} concurrent session(s): {report['completed']}/{concurrency} completed in "
+              f"{report['wall_seconds']:.1f}s ({report['sessions_per_minute']:.1f} sessions/min) ===")
+        if report['steps'] is not None:
+            print(report['steps'][['count', 'mean', '50%', '95%', '99%', 'max']].round(3).to_string())
+        print(f"serialized rerun latency p50 {report['rerun_p50']:.3f}s, p95 {report['rerun_p95']:.3f}s "
+              f"(p95 waiting for other sessions' reruns {report['rerun_wait_p95']:.3f}s); "
+              f"{report['script_seconds_per_session']:.2f}s of script time per session")
+        if not report['sections'].empty:
+            print("render time by section (page = full rerun; others = that section inside a full rerun):")
+            print(report['sections'].round(3).to_string())
+        print(f"memory growth {report['rss_growth_per_session'] / 1024 ** 2:.1f} MB/session")
+        for error in report['errors']:
+            print(f"ERROR {error}")
+        failed |= bool(report['errors'])
+        if not report['errors'] and report['rerun_p95'] <= args.max_p95:
+            capacity = concurrency
+
+    if capacity is None:
+        print(f"\nNo tested level kept p95 serialized rerun latency under {args.max_p95}s")
+    else:
+        print(f"\nCapacity: {capacity} concurrent session(s) with p95 serialized rerun latency "
+              f"under {args.max_p95}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from config import Config
+
+# LogRecord 的標準屬性；其餘屬性 (經 extra= 傳入) 視為結構化欄位
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener = None
+_queue_handler = None
+_worker_queues = {}
+_worker_listeners = []
+_setup_lock = threading.Lock()
+
+
+def record_fields(record):
+    """返回經 extra= 附加到記錄上的結構化欄位。"""
+    return {key: value for key, value in vars(record).items() if key not in _RESERVED_ATTRS}
+
+
+class JsonFormatter(logging.Formatter):
+    """每條記錄輸出為一行 JSON，包含 extra= 傳入的欄位 (如 run_id、行數、耗時)。"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        entry.update(record_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """把記錄放入有界佇列後立即返回；佇列已滿時丟棄記錄並計數，不阻塞調用方。"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 在調用方執行緒中展開訊息參數及例外堆疊，保留 extra 欄位供寫入執行緒格式化
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _file_handler(log_file, formatter):
+    if Config.LOG_ROTATION == 'time':
+        handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=Config.LOG_ROTATION_WHEN, backupCount=Config.LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=Config.LOG_MAX_BYTES, backupCount=Config.LOG_BACKUP_COUNT, encoding='utf-8')
+    handler.setFormatter(formatter)
+    return handler
+
+
+def setup_logging(log_file=None, json_file=None):
+    """設定根日誌記錄器：調用方只把記錄放入佇列，由背景執行緒寫入輪替的日誌檔。
+
+    純文字記錄寫入 log_file (預設 Config.LOG_FILE)；啟用 Config.LOG_JSON 時，
+    JSON 記錄另外寫入 json_file (預設 Config.LOG_JSON_FILE)。
+    可重複調用 (Streamlit 每次重新執行腳本都會調用)，只有第一次生效。
+    返回使用中的 QueueListener。
+    """
+    global _listener, _queue_handler
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
+        handlers = [_file_handler(log_file or Config.LOG_FILE, logging.Formatter(Config.LOG_FORMAT))]
+        if Config.LOG_JSON:
+            handlers.append(_file_handler(json_file or Config.LOG_JSON_FILE, JsonFormatter()))
+        log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+        _queue_handler = NonBlockingQueueHandler(log_queue)
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+        root = logging.getLogger()
+        root.setLevel(Config.LOG_LEVEL)
+        root.addHandler(_queue_handler)
+        atexit.register(shutdown_logging)
+        return _listener
+
+
+def worker_log_queue(context):
+    """返回子進程回傳日誌記錄的跨進程佇列 (按進程啟動方式各一個)；日誌尚未設定時返回 None。
+
+    佇列中的記錄由本進程的背景執行緒寫入與主進程相同的日誌檔。
+    """
+    with _setup_lock:
+        if _listener is None:
+            return None
+        method = context.get_start_method()
+        if method not in _worker_queues:
+            log_queue = context.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+            listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+            listener.start()
+            _worker_queues[method] = log_queue
+            _worker_listeners.append(listener)
+        return _worker_queues[method]
+
+
+def init_worker_logging(log_queue, initializer=None):
+    """進程池子進程的 initializer：根記錄器的記錄經佇列送回主進程寫入日誌檔。
+
+    initializer 為子進程額外的初始化函數 (例如預熱)，在設定日誌後執行。
+    """
+    if log_queue is not None:
+        root = logging.getLogger()
+        # fork 啟動的子進程繼承了主進程的佇列處理器，但其寫入執行緒不在子進程中
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.setLevel(Config.LOG_LEVEL)
+        root.addHandler(NonBlockingQueueHandler(log_queue))
+    if initializer is not None:
+        initializer()
+
+
+def shutdown_logging():
+    """停止寫入執行緒，寫出佇列中剩餘的記錄並關閉日誌檔。"""
+    global _listener, _queue_handler
+    with _setup_lock:
+        if _listener is None:
+            return
+        logging.getLogger().removeHandler(_queue_handler)
+        for listener in _worker_listeners:
+            listener.stop()
+        for log_queue in _worker_queues.values():
+            log_queue.close()
+        _worker_listeners.clear()
+        _worker_queues.clear()
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        if _queue_handler.dropped:
+            logging.getLogger().warning(f"{_queue_handler.dropped} log records were dropped (queue full)")
+        _listener = _queue_handler = None
+
+
+@contextmanager
+def log_stage(durations, stage):
+    """記錄一個處理階段的耗時 (秒) 到 durations[stage]。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        durations[stage] = round(time.perf_counter() - start, 3)
@@ -0,0 +1,275 @@
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from config import Config
+
+NAMESPACE = 'promo'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 全部指標的定義：(類型, 名稱, 說明, 標籤, 直方圖分桶的 Config 屬性)
+METRIC_DEFINITIONS = [
+    ('counter', 'load_rows_total', 'Rows parsed from uploaded files', ('file',), None),
+    ('counter', 'load_errors_total', 'load_data calls that raised an error', (), None),
+    ('histogram', 'load_duration_seconds', 'load_data latency', (), 'METRICS_LATENCY_BUCKETS'),
+    ('gauge', 'load_rows_per_second', 'File A rows parsed per second in the latest load_data call', (), None),
+    ('counter', 'calculate_rows_total', 'Rows processed by the demand calculation', ('mode',), None),
+    ('histogram', 'calculate_duration_seconds', 'Demand calculation latency', ('mode',), 'METRICS_LATENCY_BUCKETS'),
+    ('counter', 'analysis_errors_total', 'Analysis jobs whose calculation failed', (), None),
+    ('histogram', 'chart_duration_seconds', 'Chart rendering latency', ('chart',), 'METRICS_LATENCY_BUCKETS'),
+    ('histogram', 'export_duration_seconds', 'Excel export latency', (), 'METRICS_LATENCY_BUCKETS'),
+    ('histogram', 'export_bytes', 'Excel export size', (), 'METRICS_SIZE_BUCKETS'),
+    ('histogram', 'section_duration_seconds', 'Render time of a full page run or a single fragment rerun',
+     ('section',), 'METRICS_LATENCY_BUCKETS'),
+    ('counter', 'cache_requests_total', 'Cache lookups by cache and result (hit or miss)', ('cache', 'result'), None),
+    ('gauge', 'session_memory_bytes', 'Memory held by all sessions in the session store', (), None),
+]
+
+_registry = None
+_NULL_TIMER = nullcontext()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = f'{NAMESPACE}_{name}'
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames) or any(name not in labels for name in self.labelnames):
+            raise ValueError(f"{self.name} 需要標籤 {self.labelnames}，收到 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _pairs(self, key):
+        return list(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, value, labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, self._pairs(key), value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, labels):
+        self._values[self._key(labels)] = value
+
+    samples = Counter.samples
+
+
+class Histogram(_Metric):
+    """累積分桶直方圖；每個標籤組合保存各桶 (非累積) 計數、總和及次數。"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self._values.items()):
+            pairs = self._pairs(key)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield f'{self.name}_bucket', pairs + [('le', _format_value(bound))], cumulative
+            yield f'{self.name}_sum', pairs, total
+            yield f'{self.name}_count', pairs, count
+
+    def quantile(self, q, key):
+        """與 Prometheus histogram_quantile 相同，在分桶內線性插值估算分位數。"""
+        counts, _, count = self._values[key]
+        rank = q * count
+        cumulative, lower = 0, 0.0
+        for bound, n in zip(self.buckets, counts):
+            if n and cumulative + n >= rank:
+                if math.isinf(bound):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / n
+            cumulative += n
+            lower = bound
+        return lower
+
+
+class MetricsRegistry:
+    """進程內的指標登錄表 (計數器、直方圖、量表)，可輸出 Prometheus 文字格式。"""
+
+    def __init__(self, definitions=METRIC_DEFINITIONS):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        for kind, name, documentation, labelnames, buckets in definitions:
+            if kind == 'histogram':
+                metric = Histogram(name, documentation, labelnames, getattr(Config, buckets))
+            else:
+                metric = {'counter': Counter, 'gauge': Gauge}[kind](name, documentation, labelnames)
+            self._metrics[name] = metric
+
+    def inc(self, name, value=1, labels=None):
+        with self._lock:
+            self._metrics[name].inc(value, labels or {})
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._metrics[name].set(value, labels or {})
+
+    def observe(self, name, value, labels=None):
+        with self._lock:
+            self._metrics[name].observe(value, labels or {})
+
+    def value(self, name, **labels):
+        """計數器或量表的當前值；直方圖返回觀測次數。沒有數據時返回 0。"""
+        metric = self._metrics[name]
+        with self._lock:
+            value = metric._values.get(metric._key(labels), 0)
+        return value[2] if isinstance(metric, Histogram) and value else value
+
+    def render(self):
+        """Prometheus 文字格式 (exposition format 0.0.4)。"""
+        lines = []
+        with self._lock:
+            for metric in self._metrics.values():
+                lines.append(f'# HELP {metric.name} {metric.documentation}')
+                lines.append(f'# TYPE {metric.name} {metric.type}')
+                for sample_name, pairs, value in metric.samples():
+                    lines.append(f'{sample_name}{_format_labels(pairs)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """供側邊欄顯示的摘要：每個指標及標籤組合一行，直方圖附帶次數、平均值及 p50/p95。"""
+        rows = []
+        with self._lock:
+            for metric in self._metrics.values():
+                for key, value in sorted(metric._values.items()):
+                    row = {'metric': metric.name, 'labels': ', '.join(f'{k}={v}' for k, v in metric._pairs(key))}
+                    if isinstance(metric, Histogram):
+                        _, total, count = value
+                        row.update(value=count, mean=total / count if count else None,
+                                   p50=metric.quantile(0.5, key), p95=metric.quantile(0.95, key))
+                    else:
+                        row['value'] = value
+                    rows.append(row)
+        return pd.DataFrame(rows, columns=['metric', 'labels', 'value', 'mean', 'p50', 'p95'])
+
+
+# --- 模組級 API：未啟用時每次調用只檢查一次全域變數 ---
+def enable(registry=None):
+    """啟用指標收集並返回登錄表；重複調用返回同一登錄表。"""
+    global _registry
+    if _registry is None:
+        _registry = registry or MetricsRegistry()
+    return _registry
+
+
+def disable():
+    global _registry
+    _registry = None
+
+
+def get_registry():
+    return _registry
+
+
+def inc(name, value=1, **labels):
+    registry = _registry
+    if registry is not None:
+        registry.inc(name, value, labels)
+
+
+def set_gauge(name, value, **labels):
+    registry = _registry
+    if registry is not None:
+        registry.set(name, value, labels)
+
+
+def observe(name, value, **labels):
+    registry = _registry
+    if registry is not None:
+        registry.observe(name, value, labels)
+
+
+@contextmanager
+def _timer(registry, name, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - start, labels)
+
+
+def timer(name, **labels):
+    """把代碼塊的耗時記入直方圖 name；未啟用時返回共用的空上下文。"""
+    registry = _registry
+    if registry is None:
+        return _NULL_TIMER
+    return _timer(registry, name, labels)
+
+
+# --- Prometheus 端點 ---
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(registry, host=None, port=None):
+    """在背景執行緒中提供 GET /metrics；port 為 0 時由系統分配。"""
+    server = ThreadingHTTPServer((host or Config.METRICS_HOST, Config.METRICS_PORT if port is None else port),
+                                 MetricsRequestHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info(f"Metrics endpoint listening on http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+    return server
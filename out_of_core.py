@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Out-of-core demand calculation for File A snapshots larger than memory
+Author: Ricky
+
+Streams File A (CSV or Parquet; Excel is read whole since a sheet holds at
+most ~1M rows) in batches, cleans and merges each batch with File B, and
+spills the merged rows to Parquet buckets on disk. Each bucket is then
+computed with the same demand_rows / summarize_demand code as the pandas
+path, so results and summary match calculate_demand while peak memory is
+bounded by the batch and bucket sizes rather than the snapshot size.
+
+Usage:
+    python out_of_core.py --file-a snapshot.parquet --file-b targets.xlsx \
+        --lead-time 2.5 --output results.parquet --summary summary.parquet
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import Config
+from parallel_demand import ROW_ID_COLUMN
+from run_store import _to_arrow
+
+KEY_COLUMNS = ['Article', 'Site']
+
+
+def _report(progress_callback, progress, message):
+    if progress_callback is not None:
+        progress_callback(progress, message)
+
+
+# --- 讀取 ---
+def iter_file_a(path, batch_rows=None):
+    """按批次讀取未清理的檔案 A；Article 及 Site 一律為字串。"""
+    batch_rows = batch_rows or Config.OUT_OF_CORE_BATCH_ROWS
+    suffix = os.path.splitext(os.fspath(path))[1].lower()
+    if suffix == '.csv':
+        yield from pd.read_csv(path, dtype={col: str for col in KEY_COLUMNS}, chunksize=batch_rows)
+    elif suffix == '.parquet':
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows):
+            df = batch.to_pandas()
+            for col in KEY_COLUMNS:
+                if col in df.columns:
+                    df[col] = df[col].astype(str).where(df[col].notna())
+            yield df
+    else:
+        df = pd.read_excel(path, sheet_name=0, dtype={col: str for col in KEY_COLUMNS})
+        for start in range(0, len(df), batch_rows):
+            yield df.iloc[start:start + batch_rows].reset_index(drop=True)
+
+
+def stream_merged(files_a, file_b, batch_rows=None):
+    """逐批產生已清理並與檔案 B 合併的數據，結果與 load_data 相同 (按批次切分)。
+
+    files_a 為一個或多個檔案 A 路徑，按順序讀取；多個檔案之間不去除重複行。
+    """
+    from app import clean_file_a, merge_data, read_file_b
+
+    frames = read_file_b(file_b)
+    if frames is None:
+        raise ValueError("檔案 B 格式不正確")
+    df_b1, df_b2 = frames
+    for path in ([files_a] if isinstance(files_a, (str, os.PathLike)) else files_a):
+        for df_a in iter_file_a(path, batch_rows):
+            missing_cols = [col for col in Config.REQUIRED_COLUMNS_A if col not in df_a.columns]
+            if missing_cols:
+                raise ValueError(f"檔案 A 缺少必要欄位：{', '.join(missing_cols)}")
+            yield merge_data(clean_file_a(df_a), df_b1, df_b2)
+
+
+# --- 分桶 ---
+def _canonical_key(values):
+    """把鍵欄位轉為與批次 dtype 無關的字串：同一個鍵在 int64 批次 (1) 及因空值變為
+    float64 的批次 (1.0) 中得到相同的字串，空值為 ''。"""
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        values = values.astype('float64')
+    return values.astype(str).where(values.notna(), '')
+
+
+def _bucket_of(df, columns, num_buckets):
+    keys = pd.DataFrame({col: _canonical_key(df[col]) for col in columns})
+    hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    return (hashes % np.uint64(num_buckets)).astype(np.int64)
+
+
+def _promote(schema, other):
+    """兩個 schema 的共同 schema：數值類型按需擴大 (例如 int64 → double)，無法合併的欄位改為字串。"""
+    fields = []
+    for field in schema:
+        index = other.get_field_index(field.name)
+        if index < 0 or other.field(index).type == field.type:
+            fields.append(field)
+            continue
+        try:
+            fields.append(pa.unify_schemas([pa.schema([field]), pa.schema([other.field(index)])],
+                                           promote_options='permissive').field(0))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            fields.append(field.with_type(pa.string()))
+    fields.extend(field for field in other if schema.get_field_index(field.name) < 0)
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def _conform(table, schema):
+    """把表按 schema 的欄位順序及類型轉換，缺少的欄位補上空值。"""
+    columns = []
+    for field in schema:
+        if field.name not in table.column_names:
+            columns.append(pa.nulls(len(table), field.type))
+            continue
+        column = table.column(field.name)
+        columns.append(column if column.type == field.type else column.cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class _BucketWriter:
+    """把數據框按桶號追加到 `<root>/bucket-XXXX.parquet`；各桶共用同一個 schema。
+
+    schema 由首批數據決定；之後的批次類型不同時 (例如某批的 Site Target % 全為整數、
+    另一批含小數) 擴大為共同 schema，並把已寫入的桶按新 schema 重寫一次。
+    """
+
+    def __init__(self, root, num_buckets):
+        self.root = root
+        self.num_buckets = num_buckets
+        self.schema = None
+        self._writers = {}
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, bucket):
+        return os.path.join(self.root, f'bucket-{bucket:04d}.parquet')
+
+    def _widen(self, schema):
+        for bucket, writer in self._writers.items():
+            writer.close()
+            table = _conform(pq.read_table(self.path(bucket)), schema)
+            writer = self._writers[bucket] = pq.ParquetWriter(self.path(bucket), schema)
+            writer.write_table(table)
+        logging.info(f"Out-of-core buckets widened to a promoted schema ({len(self._writers)} buckets rewritten)")
+        self.schema = schema
+
+    def write(self, df, buckets):
+        table = _to_arrow(df)
+        if self.schema is None:
+            self.schema = table.schema
+        elif not table.schema.equals(self.schema, check_metadata=False):
+            schema = _promote(self.schema, table.schema)
+            if not schema.equals(self.schema, check_metadata=False):
+                self._widen(schema)
+            table = _conform(table, self.schema)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.searchsorted(buckets[order], np.arange(self.num_buckets + 1))
+        for bucket in range(self.num_buckets):
+            start, end = bounds[bucket], bounds[bucket + 1]
+            if start == end:
+                continue
+            writer = self._writers.get(bucket)
+            if writer is None:
+                writer = self._writers[bucket] = pq.ParquetWriter(self.path(bucket), self.schema)
+            writer.write_table(table.take(pa.array(order[start:end])))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        return sorted(self._writers)
+
+
+# --- 計算 ---
+def calculate_demand_out_of_core(batches, lead_time, output_path, work_dir=None, num_buckets=None,
+                                 progress_callback=None):
+    """以有限記憶體計算需求：結果按原始行順序寫入 output_path (Parquet)，返回 (結果行數, summary)。
+
+    batches 為合併後數據框的迭代器 (例如 stream_merged())。流程：
+    1. 逐批把合併數據按 (Group No., Site) 分桶寫入磁碟，同時收集 (Group No., Article)
+       組合以判斷全部數據中的多 SKU 組；
+    2. 每個桶以 demand_rows 計算 (同一 (Group No., Site) 的行都在同一桶)，再按
+       (Group No., Article) 重新分桶；
+    3. 每個桶以 summarize_demand 生成總結 (同一 (Group No., Article) 的行都在同一桶)；
+    4. 按行號區間從各桶讀回結果，恢復原始順序後寫入 output_path。
+    """
+    from app import demand_rows, find_multi_sku_groups, summarize_demand
+
+    num_buckets = num_buckets or Config.OUT_OF_CORE_BUCKETS
+    work_dir = tempfile.mkdtemp(prefix='ooc-', dir=work_dir or Config.OUT_OF_CORE_WORK_DIR)
+    try:
+        # 1. 分桶寫入合併數據
+        merged_writer = _BucketWriter(os.path.join(work_dir, 'merged'), num_buckets)
+        pairs = []
+        total_rows = 0
+        for df in batches:
+            if df.empty:
+                continue
+            df = df.reset_index(drop=True)
+            df[ROW_ID_COLUMN] = np.arange(total_rows, total_rows + len(df))
+            total_rows += len(df)
+            merged_writer.write(df, _bucket_of(df, ['Group No.', 'Site'], num_buckets))
+            pairs.append(df[['Group No.', 'Article']].drop_duplicates())
+            pairs = [pd.concat(pairs, ignore_index=True).drop_duplicates()]
+            _report(progress_callback, 20, f"已分桶 {total_rows} 行...")
+        merged_buckets = merged_writer.close()
+        if total_rows == 0:
+            return 0, pd.DataFrame()
+        multi_sku_groups = find_multi_sku_groups(pairs[0])
+
+        # 2. 逐桶計算需求
+        result_writer = _BucketWriter(os.path.join(work_dir, 'results'), num_buckets)
+        for done, bucket in enumerate(merged_buckets, start=1):
+            df = pq.read_table(merged_writer.path(bucket)).to_pandas()
+            df_calc = demand_rows(df, lead_time, multi_sku_groups=multi_sku_groups)
+            result_writer.write(df_calc, _bucket_of(df_calc, ['Group No.', 'Article'], num_buckets))
+            _report(progress_callback, 20 + int(40 * done / len(merged_buckets)), "逐桶計算需求...")
+        result_buckets = result_writer.close()
+
+        # 3. 逐桶生成總結
+        summaries = []
+        for bucket in result_buckets:
+            df_calc = pq.read_table(result_writer.path(bucket)).to_pandas()
+            df_calc = df_calc.sort_values(ROW_ID_COLUMN, kind='stable').reset_index(drop=True)
+            summary = summarize_demand(df_calc)
+            if not summary.empty:
+                summaries.append(summary)
+        _report(progress_callback, 75, "生成總結報告...")
+        summary = pd.concat(summaries, ignore_index=True) if summaries else summarize_demand(df_calc.iloc[:0])
+        summary = summary.sort_values(['Group No.', 'SKU'], kind='stable').reset_index(drop=True)
+
+        # 4. 按行號區間恢復原始順序
+        paths = [result_writer.path(bucket) for bucket in result_buckets]
+        range_rows = Config.OUT_OF_CORE_BATCH_ROWS
+        with pq.ParquetWriter(output_path, result_writer.schema.remove(
+                result_writer.schema.get_field_index(ROW_ID_COLUMN))) as writer:
+            for start in range(0, total_rows, range_rows):
+                row_filter = [(ROW_ID_COLUMN, '>=', start), (ROW_ID_COLUMN, '<', start + range_rows)]
+                table = pa.concat_tables([pq.read_table(path, filters=row_filter) for path in paths])
+                table = table.sort_by(ROW_ID_COLUMN).drop_columns([ROW_ID_COLUMN])
+                writer.write_table(table)
+                _report(progress_callback, 80 + int(20 * min(start + range_rows, total_rows) / total_rows),
+                        "寫出計算結果...")
+        logging.info(f"Out-of-core demand calculation: {total_rows} rows in {len(merged_buckets)} buckets")
+        return total_rows, summary
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Out-of-core demand calculation')
+    parser.add_argument('--file-a', nargs='+', required=True, help='File A snapshot(s): .csv, .parquet or .xlsx')
+    parser.add_argument('--file-b', required=True, help='File B workbook (.xlsx)')
+    parser.add_argument('--lead-time', type=float, default=Config.DEFAULT_LEAD_TIME)
+    parser.add_argument('--output', required=True, help='results Parquet path')
+    parser.add_argument('--summary', required=True, help='summary path (.parquet or .xlsx)')
+    parser.add_argument('--buckets', type=int, default=None)
+    parser.add_argument('--batch-rows', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format=Config.LOG_FORMAT)
+    rows, summary = calculate_demand_out_of_core(
+        stream_merged(args.file_a, args.file_b, args.batch_rows), args.lead_time, args.output,
+        num_buckets=args.buckets, progress_callback=lambda progress, message: logging.info(f"{progress}% {message}"))
+    if args.summary.lower().endswith('.xlsx'):
+        summary.to_excel(args.summary, index=False)
+    else:
+        summary.to_parquet(args.summary, index=False)
+    logging.info(f"Wrote {rows} result rows to {args.output} and {len(summary)} summary rows to {args.summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import logging
+import os
+import pickle
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+from logging_setup import init_worker_logging, worker_log_queue
+
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow 隨 streamlit 安裝；缺少時退回 pickle 傳輸
+    pa = None
+
+# 用於在合併分區結果時恢復原始行順序的臨時欄位
+ROW_ID_COLUMN = '__row_id__'
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def partition_by_group(df, num_partitions):
+    """將數據按 Group No. 分區，返回各分區的行位置陣列。
+
+    同一 Group No. 的所有行必定位於同一分區；未匹配推廣目標的行 (空白或缺失
+    的 Group No.) 自成一個分區。其餘組別按行數以貪婪法分配到負載最小的分區。
+    """
+    positions = np.arange(len(df))
+    if 'Group No.' not in df.columns:
+        return [positions] if len(df) else []
+
+    groups = df['Group No.']
+    unmatched = (groups.isna() | (groups.astype(str) == '')).to_numpy()
+    codes, uniques = pd.factorize(groups.where(~unmatched))
+
+    partitions = []
+    if unmatched.any():
+        partitions.append(positions[unmatched])
+
+    if len(uniques):
+        matched = codes >= 0
+        sizes = np.bincount(codes[matched], minlength=len(uniques))
+        num_bins = max(1, min(num_partitions, len(uniques)))
+        loads = np.zeros(num_bins, dtype=np.int64)
+        assignment = np.empty(len(uniques), dtype=np.int64)
+        for code in np.argsort(-sizes, kind='stable'):
+            target = int(np.argmin(loads))
+            assignment[code] = target
+            loads[target] += sizes[code]
+
+        row_bins = assignment[codes[matched]]
+        order = np.argsort(row_bins, kind='stable')
+        boundaries = np.cumsum(np.bincount(row_bins, minlength=num_bins))[:-1]
+        partitions.extend(part for part in np.split(positions[matched][order], boundaries) if len(part))
+    return partitions
+
+
+def merge_partition_results(parts):
+    """合併各分區的 (results, summary)，並確定性地恢復順序。
+
+    results 按 ROW_ID_COLUMN 恢復輸入行順序；summary 按 (Group No., SKU) 排序，
+    與單次 groupby 產生的順序一致。
+    """
+    results = pd.concat([r for r, _ in parts], ignore_index=True)
+    results = results.sort_values(ROW_ID_COLUMN, kind='stable').drop(columns=ROW_ID_COLUMN).reset_index(drop=True)
+
+    summaries = [s for _, s in parts if not s.empty] or [parts[0][1]]
+    summary = pd.concat(summaries, ignore_index=True)
+    summary = summary.sort_values(['Group No.', 'SKU'], kind='stable').reset_index(drop=True)
+    return results, summary
+
+
+def encode_frame(df, compression=None):
+    """序列化數據框以傳送至子進程；優先使用 Arrow IPC，無法轉換時退回 pickle。
+
+    compression 為 Arrow IPC 的緩衝區壓縮 ('lz4' 或 'zstd')，None 表示不壓縮。
+    """
+    if pa is not None and Config.PARALLEL_TRANSFER == 'arrow':
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            sink = pa.BufferOutputStream()
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+            return 'arrow', sink.getvalue().to_pybytes()
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            pass
+    return 'pickle', pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_frame(payload):
+    """還原 encode_frame 序列化的數據框。"""
+    fmt, data = payload
+    if fmt == 'arrow':
+        return pa.ipc.open_stream(data).read_all().to_pandas()
+    return pickle.loads(data)
+
+
+def _calculate_partition(payload, lead_time):
+    """子進程入口：對單一分區執行 calculate_demand。"""
+    from app import calculate_demand
+
+    partition = decode_frame(payload)
+    results, summary = calculate_demand(partition, lead_time)
+    if results.empty:
+        raise RuntimeError(f"分區計算失敗 ({len(partition)} 行)，詳情請查看 app.log。")
+    return encode_frame(results), encode_frame(summary)
+
+
+def get_executor(max_workers):
+    """返回常駐的進程池，避免每次分析重新啟動子進程。
+
+    進程池按大小分別保存：分析、檔案 A 解析、派貨檔案及模糊測試可能同時以不同的
+    max_workers 調用，不會關閉或取消其他調用方正在使用的進程池。
+    """
+    with _executor_lock:
+        executor = _executors.get(max_workers)
+        if executor is None:
+            context = multiprocessing.get_context(Config.PARALLEL_START_METHOD)
+            executor = _executors[max_workers] = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=context,
+                initializer=init_worker_logging, initargs=(worker_log_queue(context),))
+        return executor
+
+
+def shutdown_executor():
+    """關閉所有常駐的進程池。"""
+    with _executor_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def calculate_demand_parallel(df, lead_time, max_workers=None, progress_callback=None):
+    """按 Group No. 分區，在進程池上平行執行 calculate_demand 並合併結果。
+
+    結果與 calculate_demand(df, lead_time) 相同；數據量少於
+    Config.PARALLEL_MIN_ROWS 或只有一個分區時直接在本進程計算。
+    """
+    from app import calculate_demand, report_progress
+
+    max_workers = max_workers or Config.PARALLEL_MAX_WORKERS or os.cpu_count() or 1
+    if df is None or df.empty or max_workers <= 1 or len(df) < Config.PARALLEL_MIN_ROWS:
+        return calculate_demand(df, lead_time, progress_callback=progress_callback)
+
+    report_progress(progress_callback, 5, "按 Group No. 分區...")
+    partitions = partition_by_group(df, max_workers * Config.PARALLEL_PARTITIONS_PER_WORKER)
+    if len(partitions) <= 1:
+        return calculate_demand(df, lead_time, progress_callback=progress_callback)
+
+    df_indexed = df.reset_index(drop=True)
+    df_indexed[ROW_ID_COLUMN] = np.arange(len(df_indexed))
+
+    executor = get_executor(max_workers)
+    futures = [
+        executor.submit(_calculate_partition, encode_frame(df_indexed.iloc[part]), lead_time)
+        for part in partitions
+    ]
+    logging.info(f"Parallel demand calculation: {len(df)} rows in {len(partitions)} partitions, {max_workers} workers")
+
+    parts = []
+    try:
+        for done, future in enumerate(as_completed(futures), start=1):
+            results_payload, summary_payload = future.result()
+            parts.append((decode_frame(results_payload), decode_frame(summary_payload)))
+            report_progress(progress_callback, 10 + int(80 * done / len(futures)),
+                            f"已完成 {done}/{len(futures)} 個分區...")
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+    report_progress(progress_callback, 95, "合併分區結果...")
+    results, summary = merge_partition_results(parts)
+    report_progress(progress_callback, 100, "計算完成")
+    return results, summary
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from config import Config
+
+WARNING_COLUMN = 'Out_of_Stock_Warning'
+
+
+class ResultsGrid:
+    """計算結果的伺服器端分頁表格。
+
+    建立時為每個可過濾欄位預先計算「值 -> 行位置」索引，並為可排序欄位預先
+    計算升序及降序的排序順序；每次查詢只需組合索引，再把當前頁的行切片交給瀏覽器。
+    """
+
+    def __init__(self, results, summary=None):
+        self.source = results
+        self.results = results.reset_index(drop=True)
+        self.warnings = self._row_warnings(self.results, summary)
+        self._filter_index = {}
+        for column in Config.RESULTS_GRID_FILTER_COLUMNS:
+            values = self._column(column)
+            if values is not None:
+                self._filter_index[column] = self._build_filter_index(values)
+        self._sort_index = {}
+        for column in Config.RESULTS_GRID_SORT_COLUMNS:
+            values = self.warnings if column == WARNING_COLUMN else self.results.get(column)
+            if values is not None:
+                self._sort_index[column] = self._build_sort_index(values)
+
+    @staticmethod
+    def _row_warnings(results, summary):
+        """把總結表的缺貨警告按 (Group No., Article) 對應到每一行。"""
+        if summary is None or summary.empty or WARNING_COLUMN not in summary.columns:
+            return pd.Series('', index=results.index)
+        lookup = summary.set_index(['Group No.', 'SKU'])[WARNING_COLUMN]
+        lookup = lookup[~lookup.index.duplicated()]
+        keys = pd.MultiIndex.from_frame(results[['Group No.', 'Article']])
+        return pd.Series(lookup.reindex(keys).fillna('').to_numpy(), index=results.index)
+
+    def _column(self, column):
+        if column == WARNING_COLUMN:
+            return self.warnings
+        if column in self.results.columns:
+            return self.results[column].astype(str) if column in Config.RESULTS_GRID_FILTER_COLUMNS \
+                else self.results[column]
+        return None
+
+    @staticmethod
+    def _build_filter_index(values):
+        codes, uniques = pd.factorize(values, sort=True)
+        order = np.argsort(codes, kind='stable')
+        boundaries = np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)))[:-1]
+        return dict(zip(uniques.tolist(), np.split(order[codes[order] >= 0], boundaries)))
+
+    @staticmethod
+    def _build_sort_index(values):
+        """返回 (升序, 降序) 的行位置陣列；兩者都是穩定排序 (相同值保持原有行順序)，缺失值排在最後。
+
+        除空白外全部為數字的文字欄位 (例如以字串保存的 Group No.) 按數值而非字串排序，空白視為缺失值。
+        """
+        if not pd.api.types.is_numeric_dtype(values):
+            numeric = pd.to_numeric(values, errors='coerce')
+            present = values.notna() & values.astype(str).str.strip().ne('')
+            if numeric.notna().sum() == present.sum():
+                values = numeric
+        codes, uniques = pd.factorize(values, sort=True)
+        missing = codes < 0
+        ascending = np.where(missing, len(uniques), codes)
+        descending = np.where(missing, len(uniques), len(uniques) - 1 - codes)
+        return np.argsort(ascending, kind='stable'), np.argsort(descending, kind='stable')
+
+    def __len__(self):
+        return len(self.results)
+
+    def nbytes(self):
+        """索引本身的記憶體用量 (不含與結果共用的數據)。"""
+        arrays = [order for index in self._filter_index.values() for order in index.values()]
+        arrays.extend(order for orders in self._sort_index.values() for order in orders)
+        return sum(array.nbytes for array in arrays) + int(self.warnings.memory_usage(deep=True))
+
+    def filter_columns(self):
+        return list(self._filter_index)
+
+    def sort_columns(self):
+        return list(self._sort_index)
+
+    def options(self, column):
+        """返回某個過濾欄位的所有可選值 (已排序)。"""
+        return list(self._filter_index.get(column, {}))
+
+    def query(self, filters=None, sort_by=None, ascending=True):
+        """返回符合過濾條件、按指定欄位排序後的行位置陣列。
+
+        filters 為 {欄位: 可接受值的列表}；同一欄位內的值為「或」，不同欄位之間為「且」。
+        """
+        mask = np.ones(len(self.results), dtype=bool)
+        for column, values in (filters or {}).items():
+            if not values or column not in self._filter_index:
+                continue
+            index = self._filter_index[column]
+            hits = [index[value] for value in values if value in index]
+            column_mask = np.zeros(len(self.results), dtype=bool)
+            if hits:
+                column_mask[np.concatenate(hits)] = True
+            mask &= column_mask
+
+        if sort_by in self._sort_index:
+            order = self._sort_index[sort_by][0 if ascending else 1]
+            return order[mask[order]]
+        return np.flatnonzero(mask)
+
+    def page(self, positions, page, page_size):
+        """取出第 page 頁 (由 1 開始) 的行，並附上缺貨警告欄位。"""
+        start = max(0, (page - 1) * page_size)
+        selected = positions[start:start + page_size]
+        page_df = self.results.iloc[selected].copy()
+        page_df[WARNING_COLUMN] = self.warnings.iloc[selected].to_numpy()
+        return page_df
@@ -0,0 +1,253 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import Config
+
+FRAME_KINDS = ('merged', 'results', 'summary')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    lead_time REAL,
+    file_a_name TEXT,
+    file_a_hash TEXT,
+    file_b_name TEXT,
+    file_b_hash TEXT,
+    merged_rows INTEGER,
+    result_rows INTEGER,
+    summary_rows INTEGER,
+    note TEXT
+);
+CREATE TABLE IF NOT EXISTS result_index (
+    run_id TEXT NOT NULL,
+    row_no INTEGER NOT NULL,
+    group_no TEXT,
+    article TEXT,
+    site TEXT,
+    PRIMARY KEY (run_id, row_no)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_result_group ON result_index (group_no, run_id);
+CREATE INDEX IF NOT EXISTS idx_result_article ON result_index (article, run_id);
+CREATE INDEX IF NOT EXISTS idx_result_site ON result_index (site, run_id);
+"""
+
+
+def file_hash(file):
+    """計算上傳檔案內容的 SHA-256；file 可為 bytes、路徑、檔案物件或其列表。"""
+    if file is None:
+        return None
+    if isinstance(file, (list, tuple)):
+        if len(file) == 1:
+            return file_hash(file[0])
+        return hashlib.sha256(''.join(file_hash(f) for f in file).encode()).hexdigest()
+    if isinstance(file, (bytes, bytearray)):
+        return hashlib.sha256(file).hexdigest()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    if hasattr(file, 'getvalue'):
+        return hashlib.sha256(file.getvalue()).hexdigest()
+    position = file.tell()
+    file.seek(0)
+    digest = hashlib.sha256(file.read()).hexdigest()
+    file.seek(position)
+    return digest
+
+
+def _to_arrow(df):
+    """將數據框轉為 Arrow 表；含混合類型的 object 欄位會轉為字串。"""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        df = df.copy()
+        for col in df.columns:
+            if df[col].dtype == object:
+                df[col] = df[col].astype(str)
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _key_column(df, col):
+    if col not in df.columns:
+        return [None] * len(df)
+    return df[col].astype(str).where(df[col].notna(), None).tolist()
+
+
+class RunStore:
+    """本地嵌入式分析記錄庫。
+
+    每次分析的 merged / results / summary 以 Parquet (列式，按行組切分) 保存於
+    `<root>/<run_id>/`，運行元數據及 (Group No., Article, Site) 行索引保存於
+    SQLite，使跨運行的查詢只需讀取命中的行組，而不必載入整個運行。
+    """
+
+    def __init__(self, root_dir=None):
+        self.root_dir = root_dir or Config.RUN_STORE_DIR
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.db_path = os.path.join(self.root_dir, 'runs.sqlite')
+        self._write_lock = threading.Lock()
+        self._row_group_offsets = {}
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _frame_path(self, run_id, kind):
+        return os.path.join(self.root_dir, run_id, f'{kind}.parquet')
+
+    # --- 寫入 ---
+    def save_run(self, df_merged, results, summary, lead_time, file_a=None, file_b=None,
+                 file_a_name=None, file_b_name=None, note=None):
+        """保存一次分析並返回 run_id。"""
+        run_id = datetime.now().strftime('%Y%m%d%H%M%S') + '-' + uuid.uuid4().hex[:8]
+        run_dir = os.path.join(self.root_dir, run_id)
+        os.makedirs(run_dir)
+        try:
+            for kind, df in zip(FRAME_KINDS, (df_merged, results, summary)):
+                pq.write_table(_to_arrow(df), self._frame_path(run_id, kind),
+                               row_group_size=Config.RUN_STORE_ROW_GROUP_SIZE)
+
+            index_rows = zip(
+                [run_id] * len(results), range(len(results)),
+                _key_column(results, 'Group No.'), _key_column(results, 'Article'), _key_column(results, 'Site'),
+            )
+            with self._write_lock, self._connect() as conn:
+                conn.execute(
+                    'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (run_id, datetime.now().isoformat(timespec='seconds'), float(lead_time),
+                     file_a_name, file_hash(file_a), file_b_name, file_hash(file_b),
+                     len(df_merged), len(results), len(summary), note),
+                )
+                conn.executemany('INSERT INTO result_index VALUES (?, ?, ?, ?, ?)', index_rows)
+        except Exception:
+            shutil.rmtree(run_dir, ignore_errors=True)
+            raise
+        logging.info(f"Run {run_id} saved: {len(results)} result rows")
+        self.prune()
+        return run_id
+
+    def delete_run(self, run_id):
+        with self._write_lock, self._connect() as conn:
+            conn.execute('DELETE FROM result_index WHERE run_id = ?', (run_id,))
+            conn.execute('DELETE FROM runs WHERE run_id = ?', (run_id,))
+        self._row_group_offsets = {k: v for k, v in self._row_group_offsets.items() if k[0] != run_id}
+        shutil.rmtree(os.path.join(self.root_dir, run_id), ignore_errors=True)
+
+    def prune(self, max_runs=None, max_age_days=None):
+        """刪除超出保留數量或早於保留天數的舊運行，返回被刪除的 run_id；最近一次運行一律保留。"""
+        max_runs = Config.RUN_STORE_MAX_RUNS if max_runs is None else max_runs
+        max_age_days = Config.RUN_STORE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+        with self._connect() as conn:
+            runs = conn.execute('SELECT run_id, created_at FROM runs ORDER BY created_at DESC, rowid DESC').fetchall()
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat(timespec='seconds') if max_age_days else None
+        expired = [run_id for i, (run_id, created_at) in enumerate(runs)
+                   if i > 0 and ((max_runs and i >= max_runs) or (cutoff and created_at < cutoff))]
+        for run_id in expired:
+            self.delete_run(run_id)
+        if expired:
+            logging.info(f"Run store pruned {len(expired)} old runs")
+        return expired
+
+    # --- 讀取 ---
+    def list_runs(self, limit=100):
+        """按時間倒序列出運行元數據。"""
+        with self._connect() as conn:
+            return pd.read_sql_query('SELECT * FROM runs ORDER BY created_at DESC, rowid DESC LIMIT ?',
+                                     conn, params=(limit,))
+
+    def get_run(self, run_id):
+        with self._connect() as conn:
+            runs = pd.read_sql_query('SELECT * FROM runs WHERE run_id = ?', conn, params=(run_id,))
+        return None if runs.empty else runs.iloc[0].to_dict()
+
+    def find_latest_run(self, file_b_hash=None, lead_time=None):
+        """返回符合條件 (相同檔案 B 及 Lead Time) 的最近一次運行的 run_id。"""
+        clauses, params = [], []
+        if file_b_hash is not None:
+            clauses.append('file_b_hash = ?')
+            params.append(file_b_hash)
+        if lead_time is not None:
+            clauses.append('lead_time = ?')
+            params.append(float(lead_time))
+        where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+        with self._connect() as conn:
+            row = conn.execute(f'SELECT run_id FROM runs{where} ORDER BY created_at DESC, rowid DESC LIMIT 1',
+                               params).fetchone()
+        return row[0] if row else None
+
+    def load_frame(self, run_id, kind, columns=None, filters=None):
+        """載入某次運行的整個 (或經過濾的) 數據框。"""
+        return pq.read_table(self._frame_path(run_id, kind), columns=columns, filters=filters).to_pandas()
+
+    def load_summary(self, run_id, group_no=None):
+        filters = [('Group No.', '=', group_no)] if group_no is not None else None
+        return self.load_frame(run_id, 'summary', filters=filters)
+
+    def _where(self, group_no, article, site, run_ids):
+        clauses, params = [], []
+        for column, value in (('group_no', group_no), ('article', article), ('site', site)):
+            if value is not None:
+                clauses.append(f'i.{column} = ?')
+                params.append(str(value))
+        if run_ids:
+            clauses.append(f"i.run_id IN ({', '.join('?' * len(run_ids))})")
+            params.extend(run_ids)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def count_results(self, group_no=None, article=None, site=None, run_ids=None):
+        where, params = self._where(group_no, article, site, run_ids)
+        with self._connect() as conn:
+            return conn.execute(f'SELECT COUNT(*) FROM result_index i{where}', params).fetchone()[0]
+
+    def query_results(self, group_no=None, article=None, site=None, run_ids=None,
+                      offset=0, limit=100, columns=None):
+        """跨運行查詢計算結果的一頁，按運行時間倒序、行號順序排列。
+
+        只讀取包含命中行的 Parquet 行組，記憶體用量與頁面大小成正比。
+        """
+        where, params = self._where(group_no, article, site, run_ids)
+        sql = (f'SELECT i.run_id, i.row_no FROM result_index i JOIN runs r ON r.run_id = i.run_id{where} '
+               f'ORDER BY r.created_at DESC, i.run_id DESC, i.row_no LIMIT ? OFFSET ?')
+        with self._connect() as conn:
+            hits = conn.execute(sql, params + [int(limit), int(offset)]).fetchall()
+        if not hits:
+            return pd.DataFrame()
+
+        pages = []
+        for run_id in dict.fromkeys(run for run, _ in hits):
+            row_nos = np.array([row for run, row in hits if run == run_id])
+            page = self._read_rows(run_id, 'results', row_nos, columns)
+            page.insert(0, 'Run ID', run_id)
+            pages.append(page)
+        return pd.concat(pages, ignore_index=True)
+
+    def _read_rows(self, run_id, kind, row_nos, columns=None):
+        path = self._frame_path(run_id, kind)
+        parquet_file = pq.ParquetFile(path)
+        key = (run_id, kind)
+        if key not in self._row_group_offsets:
+            sizes = [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]
+            self._row_group_offsets[key] = np.concatenate([[0], np.cumsum(sizes)])
+        offsets = self._row_group_offsets[key]
+
+        row_groups = np.searchsorted(offsets, row_nos, side='right') - 1
+        wanted = np.unique(row_groups)
+        table = parquet_file.read_row_groups(wanted.tolist(), columns=columns)
+        # 將全局行號換算為所讀取行組拼接後的本地位置
+        local_start = np.concatenate([[0], np.cumsum(offsets[wanted + 1] - offsets[wanted])])[:-1]
+        local = local_start[np.searchsorted(wanted, row_groups)] + (row_nos - offsets[row_groups])
+        return table.take(pa.array(local)).to_pandas()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Multi-month sales history store with rolling per-(Article, Site) rates
+Author: Ricky
+
+Keeps one Parquet file of (Article, Site, Sold Qty) per sales month and a
+rolling aggregate of the most recent months per (Article, Site). Ingesting a
+month only reads the month files that enter or leave the rolling window, so
+the cost of an update does not grow with the length of the history. The
+analysis looks rates up by key from the rolling aggregate instead of using
+Last Month Sold Qty / 30.
+
+Usage:
+    python sales_history.py ingest --month 2024-05 snapshot_2024-06-01.xlsx
+    python sales_history.py show
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import Config
+
+KEY_COLUMNS = ['Article', 'Site']
+SOLD_COLUMN = 'Last Month Sold Qty'
+# 合併數據中保存滾動日均銷量的欄位；demand_rows 見到此欄位時以其取代 Last Month Sold Qty / 30
+HISTORY_RATE_COLUMN = 'History Daily Sales Rate'
+ROLLING_COLUMNS = KEY_COLUMNS + ['Sold Qty', 'Days', 'Months']
+_ORPHAN_GRACE_SECONDS = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS months (
+    month TEXT PRIMARY KEY,
+    rows INTEGER,
+    sold_qty INTEGER,
+    source_name TEXT,
+    ingested_at TEXT NOT NULL,
+    in_window INTEGER NOT NULL DEFAULT 0,
+    file TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _month(value):
+    return pd.Period(value, freq='M')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def monthly_sales(df_a):
+    """從未清理的檔案 A 快照取出各 (Article, Site) 的上月銷量；重複的鍵 (例如多個地區檔案) 相加。
+
+    銷量先經過與分析相同的 clean_file_a (無效值及負數改為 0、異常銷量封頂)。
+    """
+    from app import clean_file_a
+
+    missing_cols = [col for col in KEY_COLUMNS + [SOLD_COLUMN] if col not in df_a.columns]
+    if missing_cols:
+        raise ValueError(f"檔案 A 缺少必要欄位：{', '.join(missing_cols)}")
+    df = df_a[KEY_COLUMNS + [SOLD_COLUMN]].copy()
+    for col in KEY_COLUMNS:
+        df[col] = df[col].astype(str).where(df[col].notna())
+    df = clean_file_a(df)
+    sales = pd.DataFrame({col: df[col].fillna('nan').astype(str) for col in KEY_COLUMNS})
+    sales['Sold Qty'] = df[SOLD_COLUMN].to_numpy(dtype=np.int64)
+    return sales.groupby(KEY_COLUMNS, as_index=False, sort=True)['Sold Qty'].sum()
+
+
+class SalesHistory:
+    """本地銷售歷史庫。
+
+    每個銷售月份的 (Article, Site, Sold Qty) 以 Parquet 保存於 `<root>/months/`，月份
+    元數據保存於 SQLite。`<root>/rolling-*.parquet` 保存最近 window_months 個月內各
+    (Article, Site) 的銷量、天數及月數累計；新增月份時只加上進入窗口的月份、減去離開
+    窗口的月份，不重新掃描整個歷史。
+
+    每次寫入都產生新檔名的 Parquet 檔案，再在同一個 SQLite 交易中更新月份記錄、窗口
+    標記及目前的滾動累計檔案；交易提交前失敗時，舊的檔案及記錄保持不變。
+    """
+
+    def __init__(self, root_dir=None, window_months=None):
+        self.root_dir = root_dir or Config.SALES_HISTORY_DIR
+        self.window_months = window_months or Config.SALES_HISTORY_WINDOW_MONTHS
+        os.makedirs(os.path.join(self.root_dir, 'months'), exist_ok=True)
+        self.db_path = os.path.join(self.root_dir, 'history.sqlite')
+        self._write_lock = threading.Lock()
+        self._lookup = None
+        self._lookup_version = None
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _path(self, name):
+        return os.path.join(self.root_dir, name)
+
+    def _read_month(self, file):
+        return pq.read_table(self._path(file)).to_pandas()
+
+    def _rolling_file(self, conn):
+        row = conn.execute("SELECT value FROM state WHERE key = 'rolling'").fetchone()
+        return row[0] if row else None
+
+    def _rolling_frame(self, file):
+        if file is None:
+            return pd.DataFrame({col: pd.Series(dtype=str if col in KEY_COLUMNS else np.int64)
+                                 for col in ROLLING_COLUMNS})
+        return pq.read_table(self._path(file)).to_pandas()
+
+    def _write(self, df, name):
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), self._path(name))
+        return name
+
+    def _commit(self, conn, rolling, new_files, window, month_row=None):
+        """寫入新的滾動累計並在同一交易中更新元數據；返回被取代、可刪除的舊檔案。"""
+        old_rolling = self._rolling_file(conn)
+        new_files.append(self._write(rolling, f'rolling-{uuid.uuid4().hex}.parquet'))
+        if month_row is not None:
+            conn.execute('INSERT OR REPLACE INTO months VALUES (?, ?, ?, ?, ?, 0, ?)', month_row)
+        conn.execute('UPDATE months SET in_window = 0')
+        conn.executemany('UPDATE months SET in_window = 1 WHERE month = ?', [(m,) for m in sorted(window)])
+        conn.execute("INSERT OR REPLACE INTO state VALUES ('rolling', ?)", (new_files[-1],))
+        return [old_rolling] if old_rolling else []
+
+    # --- 寫入 ---
+    def ingest(self, df_a, month, source_name=None, replace=False):
+        """加入一個月的銷量 (month 為銷售月份，例如 '2024-05')，返回該月的 (Article, Site) 數。
+
+        df_a 為該月之後取得的未清理檔案 A 快照，其 Last Month Sold Qty 即該月銷量。
+        month 已存在時須指定 replace=True 才會覆蓋。
+        """
+        month = str(_month(month))
+        sales = monthly_sales(df_a)
+        new_files = []
+        with self._write_lock:
+            try:
+                with self._connect() as conn:
+                    existing = {m: (in_window, file) for m, in_window, file
+                                in conn.execute('SELECT month, in_window, file FROM months')}
+                    if month in existing and not replace:
+                        raise ValueError(f"銷售月份 {month} 已存在")
+                    old_window = {m for m, (in_window, _) in existing.items() if in_window}
+                    months = set(existing) | {month}
+                    latest = max(_month(m) for m in months)
+                    new_window = {m for m in months if latest - self.window_months < _month(m)}
+
+                    # 只讀取進入或離開窗口的月份；被覆蓋的月份先減去舊數據再加上新數據
+                    deltas = []
+                    if month in old_window:
+                        deltas.append((self._read_month(existing[month][1]), month, -1))
+                        old_window.discard(month)
+                    for m in sorted(old_window - new_window):
+                        deltas.append((self._read_month(existing[m][1]), m, -1))
+                    for m in sorted(new_window - old_window):
+                        deltas.append((sales if m == month else self._read_month(existing[m][1]), m, 1))
+                    rolling = _apply_deltas(self._rolling_frame(self._rolling_file(conn)), deltas)
+
+                    new_files.append(self._write(sales, f'months/{month}-{uuid.uuid4().hex}.parquet'))
+                    month_row = (month, len(sales), int(sales['Sold Qty'].sum()), source_name,
+                                 datetime.now().isoformat(timespec='seconds'), new_files[0])
+                    replaced = self._commit(conn, rolling, new_files, new_window, month_row)
+                    if month in existing:
+                        replaced.append(existing[month][1])
+            except BaseException:
+                for name in new_files:
+                    _remove(self._path(name))
+                raise
+        for name in replaced:
+            _remove(self._path(name))
+        logging.info(f"Sales history: month {month} ingested ({len(sales)} keys), "
+                     f"{len(deltas)} month file(s) applied to the rolling window {sorted(new_window)}")
+        return len(sales)
+
+    def rebuild(self):
+        """按窗口內的全部月份重新計算滾動累計 (例如修改 window_months 後)，並刪除沒有記錄的
+        遺留檔案 (例如寫入中途失敗的進程留下的)，返回累計行數。"""
+        new_files = []
+        with self._write_lock:
+            try:
+                with self._connect() as conn:
+                    files = dict(conn.execute('SELECT month, file FROM months'))
+                    if not files:
+                        return 0
+                    latest = max(_month(m) for m in files)
+                    window = {m for m in files if latest - self.window_months < _month(m)}
+                    rolling = _apply_deltas(self._rolling_frame(None),
+                                            [(self._read_month(files[m]), m, 1) for m in sorted(window)])
+                    self._commit(conn, rolling, new_files, window)
+            except BaseException:
+                for name in new_files:
+                    _remove(self._path(name))
+                raise
+            # 只刪除超過一小時的遺留檔案，避免刪除其他進程尚未提交的寫入
+            referenced = set(files.values()) | set(new_files)
+            candidates = [f'months/{name}' for name in os.listdir(self._path('months'))]
+            candidates += [name for name in os.listdir(self.root_dir) if name.startswith('rolling-')]
+            cutoff = time.time() - _ORPHAN_GRACE_SECONDS
+            for name in candidates:
+                if name not in referenced and os.path.getmtime(self._path(name)) < cutoff:
+                    _remove(self._path(name))
+        return len(rolling)
+
+    # --- 讀取 ---
+    def list_months(self):
+        """已保存的月份及其是否在滾動窗口內，按月份倒序。"""
+        with self._connect() as conn:
+            return pd.read_sql_query('SELECT * FROM months ORDER BY month DESC', conn)
+
+    def rolling(self):
+        """滾動窗口內各 (Article, Site) 的累計銷量、天數、月數及日均銷量。"""
+        with self._connect() as conn:
+            return _with_rate(self._rolling_frame(self._rolling_file(conn)))
+
+    def _rate_lookup(self):
+        # 每次寫入都產生新的滾動累計檔案；按目前的檔名判斷是否需要重新載入 (其他進程亦可能寫入)
+        with self._connect() as conn:
+            version = self._rolling_file(conn)
+        if version is None:
+            return None
+        if self._lookup_version != version:
+            rolling = _with_rate(self._rolling_frame(version))
+            rolling = rolling[rolling['Months'] >= Config.SALES_HISTORY_MIN_MONTHS]
+            self._lookup = (pd.MultiIndex.from_frame(rolling[KEY_COLUMNS]),
+                            rolling['Daily Sales Rate'].to_numpy(dtype=float))
+            self._lookup_version = version
+        return self._lookup
+
+    def lookup_rates(self, df):
+        """按 df 的 (Article, Site) 查詢滾動日均銷量，返回與 df 對齊的陣列；沒有歷史的鍵為 NaN。"""
+        lookup = self._rate_lookup()
+        if lookup is None or df.empty:
+            return np.full(len(df), np.nan)
+        index, rates = lookup
+        positions = index.get_indexer(pd.MultiIndex.from_frame(df[KEY_COLUMNS].astype(str)))
+        return np.where(positions >= 0, rates[positions], np.nan)
+
+    def attach_rates(self, df):
+        """返回加上 HISTORY_RATE_COLUMN 欄位的合併數據副本，供 calculate_demand 作為銷售率來源。"""
+        return df.assign(**{HISTORY_RATE_COLUMN: self.lookup_rates(df)})
+
+
+def _with_rate(rolling):
+    return rolling.assign(**{'Daily Sales Rate': rolling['Sold Qty'] / rolling['Days'].where(rolling['Days'] > 0)})
+
+
+def _apply_deltas(rolling, deltas):
+    """把 [(月銷量, 月份, ±1)] 加到滾動累計上，移除月數歸零的鍵。"""
+    if not deltas:
+        return rolling
+    frames = [rolling]
+    for sales, month, sign in deltas:
+        frames.append(sales[KEY_COLUMNS].assign(**{
+            'Sold Qty': sign * sales['Sold Qty'].to_numpy(dtype=np.int64),
+            'Days': sign * _month(month).days_in_month,
+            'Months': sign,
+        }))
+    rolling = pd.concat(frames, ignore_index=True).groupby(KEY_COLUMNS, as_index=False, sort=True).sum()
+    return rolling[rolling['Months'] > 0].reset_index(drop=True)[ROLLING_COLUMNS]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Multi-month sales history store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest = subparsers.add_parser('ingest', help='add one month of sales from a File A snapshot')
+    ingest.add_argument('file_a', help='File A snapshot (.xlsx, .csv or .parquet)')
+    ingest.add_argument('--month', required=True, help='sales month the snapshot covers (YYYY-MM)')
+    ingest.add_argument('--replace', action='store_true', help='overwrite the month if already ingested')
+    subparsers.add_parser('show', help='list ingested months')
+    subparsers.add_parser('rebuild', help='recompute the rolling window from the month files')
+    parser.add_argument('--root', default=None, help='store directory (default: Config.SALES_HISTORY_DIR)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format=Config.LOG_FORMAT)
+    history = SalesHistory(args.root)
+    if args.command == 'ingest':
+        from out_of_core import iter_file_a
+
+        df_a = pd.concat(iter_file_a(args.file_a), ignore_index=True)
+        history.ingest(df_a, args.month, source_name=os.path.basename(args.file_a), replace=args.replace)
+    elif args.command == 'rebuild':
+        logging.info(f"Rolling window rebuilt: {history.rebuild()} keys")
+    print(history.list_months().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,8 @@ def generate_sample_inventory_data(num_records=50):
     descriptions = [f'Product {i}' for i in range(1, 21)]
     sites = [f'S{i:03d}' for i in range(1, 11)]  # S001 到 S010
     rp_types = ['RF', 'ND']
+    supply_sources = [1, 2, 4]
+    product_groups = ['Skin Care', 'Make Up', 'Fragrance', 'Hair Care']
     
     data = []
     for _ in range(num_records):
@@ -37,7 +39,9 @@ def generate_sample_inventory_data(num_records=50):
             'Pending Received': pending_received,
             'Safety Stock': safety_stock,
             'Last Month Sold Qty': last_month_sold,
-            'MTD Sold Qty': mtd_sold
+            'MTD Sold Qty': mtd_sold,
+            'Supply source': random.choice(supply_sources),
+            'Description p. group': product_groups[articles.index(article) % len(product_groups)]
         })
     
     return pd.DataFrame(data)
@@ -109,7 +113,9 @@ def generate_edge_case_data():
         'Pending Received': [0, -5, 200, 1000, 75],
         'Safety Stock': [0, 5, 50, 500, 30],
         'Last Month Sold Qty': [0, 150000, -50, 800, 300],  # 零值、超大值、負值
-        'MTD Sold Qty': [25, -25, 0, 600, 200]
+        'MTD Sold Qty': [25, -25, 0, 600, 200],
+        'Supply source': [1, 2, 4, 3, 2],  # 包含無效來源 3
+        'Description p. group': ['Skin Care', 'Make Up', 'Fragrance', 'Hair Care', 'Skin Care']
     })
     
     edge_case_sku = pd.DataFrame({
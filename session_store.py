@@ -0,0 +1,288 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from config import Config
+from parallel_demand import decode_frame, encode_frame
+
+FRAME_NAMES = ('merged', 'derived', 'summary')
+
+
+def split_results(results, merged):
+    """把計算結果拆分為只包含衍生欄位的數據框。
+
+    calculate_demand 的結果包含合併數據的全部欄位及其衍生欄位，且行順序一致；
+    只保留新增或值已改變的欄位 (例如 Notes)。無法對應時返回 (results, None)，
+    表示須保存完整結果。返回 (衍生欄位數據框, 結果欄位順序)。
+    """
+    if merged is None or len(results) != len(merged) or not results.index.equals(merged.index):
+        return results, None
+    derived = [col for col in results.columns if col not in merged.columns or not results[col].equals(merged[col])]
+    return results[derived], list(results.columns)
+
+
+def join_results(merged, derived, columns):
+    """split_results 的逆操作；結果與合併數據共用未改變的欄位而不複製。
+
+    在 Copy-on-Write 下 (pandas 3 預設；pandas 2 由 app.main 開啟) 修改任一方不會影響另一方。
+    """
+    if columns is None:
+        return derived
+    results = merged.copy(deep=False)
+    for col in derived.columns:
+        results[col] = derived[col]
+    return results[columns]
+
+
+def frame_bytes(df):
+    return 0 if df is None else int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _buffer_key(series):
+    """欄位數據緩衝區的位址，用於識別多個數據框共用的欄位。"""
+    array = series.array
+    if hasattr(array, '__arrow_array__'):
+        chunks = array.__arrow_array__().chunks
+        return tuple(buffer.address for chunk in chunks for buffer in chunk.buffers() if buffer is not None)
+    if isinstance(series.dtype, np.dtype):
+        values = series.to_numpy(copy=False)
+        return values.__array_interface__['data'][0], values.strides, len(values)
+    return id(array)
+
+
+def shared_frame_bytes(frames):
+    """多個數據框的總記憶體用量；共用同一緩衝區的欄位 (例如 join_results 的結果) 只計算一次。"""
+    seen = set()
+    total = 0
+    for df in frames:
+        if df is None:
+            continue
+        if id(df.index) not in seen:
+            seen.add(id(df.index))
+            total += int(df.index.memory_usage(deep=True))
+        for col in range(df.shape[1]):
+            series = df.iloc[:, col]
+            key = _buffer_key(series)
+            if key not in seen:
+                seen.add(key)
+                total += int(series.memory_usage(index=False, deep=True))
+    return total
+
+
+class SessionEntry:
+    """一個瀏覽器會話的數據：合併數據、衍生欄位、總結表，閒置時壓縮為 Arrow IPC。"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.frames = dict.fromkeys(FRAME_NAMES)
+        self.columns = None
+        self.compressed = None
+        self.nbytes = 0
+        self.evicted = False
+        self.last_access = time.monotonic()
+        self.grid = None
+        self.matrix = None
+        self._results = None
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    def _update_size(self):
+        if self.compressed is not None:
+            self.nbytes = sum(len(payload[1]) for payload in self.compressed.values())
+        else:
+            # 合併後的結果、表格索引及稀疏矩陣與原始數據共用欄位，只計算各自額外的部分
+            self.nbytes = shared_frame_bytes([*self.frames.values(), self._results]) + sum(
+                derived.nbytes() for derived in (self.grid, self.matrix) if derived is not None)
+
+    def compress(self):
+        if self.compressed is not None or not any(df is not None for df in self.frames.values()):
+            return
+        self.compressed = {name: encode_frame(df, compression=Config.SESSION_COMPRESSION)
+                           for name, df in self.frames.items() if df is not None}
+        self.frames = dict.fromkeys(FRAME_NAMES)
+        self._results = self.grid = self.matrix = None
+        self._update_size()
+
+    def decompress(self):
+        if self.compressed is None:
+            return
+        for name, payload in self.compressed.items():
+            self.frames[name] = decode_frame(payload)
+        self.compressed = None
+        self._update_size()
+
+    def clear(self):
+        self.frames = dict.fromkeys(FRAME_NAMES)
+        self.columns = self.compressed = self._results = self.grid = self.matrix = None
+        self.nbytes = 0
+
+    def results(self):
+        if self.frames['derived'] is None:
+            return None
+        if self._results is None:
+            self._results = join_results(self.frames['merged'], self.frames['derived'], self.columns)
+            self._update_size()
+        return self._results
+
+
+class SessionStore:
+    """伺服器共用的會話數據存儲，按會話統計記憶體用量。
+
+    超過 Config.SESSION_IDLE_SECONDS 未使用的會話壓縮為 Arrow IPC；總用量超過
+    Config.SESSION_MEMORY_CAP_BYTES 時，按最近最少使用的順序釋放其他會話的數據。
+    被釋放的會話以 evicted 標記，UI 可從分析記錄庫重新載入。
+    """
+
+    def __init__(self, memory_cap=None, idle_seconds=None, retention_seconds=None):
+        self.memory_cap = memory_cap if memory_cap is not None else Config.SESSION_MEMORY_CAP_BYTES
+        self.idle_seconds = idle_seconds if idle_seconds is not None else Config.SESSION_IDLE_SECONDS
+        self.retention_seconds = retention_seconds if retention_seconds is not None \
+            else Config.SESSION_RETENTION_SECONDS
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _entry(self, session_id):
+        entry = self._entries.get(session_id)
+        if entry is None:
+            entry = self._entries[session_id] = SessionEntry(session_id)
+        self._entries.move_to_end(session_id)
+        entry.touch()
+        entry.decompress()
+        return entry
+
+    # --- 寫入 ---
+    def set_merged(self, session_id, df_merged):
+        """保存上傳檔案的合併數據；已有的計算結果會保留。"""
+        with self._lock:
+            entry = self._entry(session_id)
+            if entry.frames['merged'] is df_merged:
+                return
+            # 舊結果以舊的合併數據為基準，先還原為完整結果再按新數據重新拆分
+            results, summary = entry.results(), entry.frames['summary']
+            entry.clear()
+            entry.frames['merged'] = df_merged
+            entry.evicted = False
+            if results is not None:
+                entry.frames['derived'], entry.columns = split_results(results, df_merged)
+                entry.frames['summary'] = summary
+            entry._update_size()
+            self._maintain(session_id)
+
+    def set_results(self, session_id, results, summary):
+        with self._lock:
+            entry = self._entry(session_id)
+            entry.frames['derived'], entry.columns = split_results(results, entry.frames['merged'])
+            entry.frames['summary'] = summary
+            entry._results = results if entry.columns is None else None
+            entry.evicted = False
+            entry._update_size()
+            self._maintain(session_id)
+
+    def restore(self, session_id, df_merged, results, summary):
+        """重新載入被釋放的會話數據 (例如從分析記錄庫)。"""
+        with self._lock:
+            self.set_merged(session_id, df_merged)
+            self.set_results(session_id, results, summary)
+
+    def discard(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    # --- 讀取 ---
+    def get_merged(self, session_id):
+        with self._lock:
+            if session_id not in self._entries:
+                return None
+            entry = self._entry(session_id)
+            self._maintain(session_id)
+            return entry.frames['merged']
+
+    def get_results(self, session_id):
+        """返回 (results, summary)；沒有結果時返回 (None, None)。"""
+        with self._lock:
+            if session_id not in self._entries:
+                return None, None
+            entry = self._entry(session_id)
+            self._maintain(session_id)
+            return entry.results(), entry.frames['summary']
+
+    def results_grid(self, session_id, build):
+        """返回會話結果的表格索引 (build(results, summary) 建立)；結果改變或被壓縮後重新建立。"""
+        return self._derived(session_id, 'grid', 'results_grid', build)
+
+    def site_article_matrix(self, session_id, build):
+        """返回會話結果的稀疏 Site×Article 矩陣 (build(results, summary) 建立)，每次運行只建立一次。"""
+        return self._derived(session_id, 'matrix', 'site_article_matrix', build)
+
+    def _derived(self, session_id, attr, cache, build):
+        results, summary = self.get_results(session_id)
+        if results is None:
+            return None
+        with self._lock:
+            value = getattr(self._entries[session_id], attr)
+        reuse = value is not None and value.source is results
+        metrics.inc('cache_requests_total', cache=cache, result='hit' if reuse else 'miss')
+        if not reuse:
+            value = build(results, summary)
+            with self._lock:
+                entry = self._entries.get(session_id)
+                if entry is not None and entry.results() is results:
+                    setattr(entry, attr, value)
+                    entry._update_size()
+        return value
+
+    def is_evicted(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            return entry is not None and entry.evicted
+
+    def session_bytes(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            return entry.nbytes if entry is not None else 0
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def usage(self):
+        """各會話的記憶體用量，按最近使用時間倒序。"""
+        now = time.monotonic()
+        with self._lock:
+            rows = [{
+                'session_id': entry.session_id,
+                'bytes': entry.nbytes,
+                'compressed': entry.compressed is not None,
+                'evicted': entry.evicted,
+                'idle_seconds': round(now - entry.last_access, 1),
+            } for entry in reversed(self._entries.values())]
+        return pd.DataFrame(rows, columns=['session_id', 'bytes', 'compressed', 'evicted', 'idle_seconds'])
+
+    # --- 維護 ---
+    def _maintain(self, current_session):
+        now = time.monotonic()
+        for session_id, entry in list(self._entries.items()):
+            if session_id == current_session:
+                continue
+            idle = now - entry.last_access
+            if idle > self.retention_seconds:
+                del self._entries[session_id]
+            elif idle > self.idle_seconds:
+                entry.compress()
+
+        total = self.total_bytes()
+        for session_id, entry in list(self._entries.items()):
+            if total <= self.memory_cap:
+                break
+            if session_id == current_session or entry.nbytes == 0:
+                continue
+            total -= entry.nbytes
+            logging.info(f"Session {session_id} data evicted ({entry.nbytes} bytes, memory cap {self.memory_cap})")
+            entry.clear()
+            entry.evicted = True
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from charts import bin_codes
+from config import Config
+
+
+class SiteArticleMatrix:
+    """計算結果的稀疏 Site×Article 矩陣 (CSR 格式，每個結果行一個非零格)。
+
+    Site、Article 及 Group No. 軸在建立時編碼為整數一次；各數值欄位 (淨需求、庫存、
+    派貨量等) 共用同一組行列索引。格子按 (Site, Article) 排序，
+    indptr[i]:indptr[i + 1] 為第 i 個 Site 的格子；同一格可有多行 (例如同一 Article
+    屬於多個組別)，彙總時相加。篩選、彙總及分箱的時間和記憶體只與非零格數量成正比，
+    不會建立 Site × Article 的密集矩陣。
+    """
+
+    def __init__(self, sites, articles, groups, site_codes, article_codes, group_codes, values, source=None):
+        self.sites = sites
+        self.articles = articles
+        self.groups = groups
+        self.site_codes = site_codes
+        self.article_codes = article_codes
+        self.group_codes = group_codes
+        self.values = values
+        self.source = source
+        self.indptr = np.searchsorted(site_codes, np.arange(len(sites) + 1))
+        self._by_article = None
+
+    @classmethod
+    def from_results(cls, results, values=None):
+        """由 calculate_demand 的結果建立；沒有 Site 或 Article 的行不計入。"""
+        values = values or Config.SPARSE_MATRIX_VALUES
+        site_codes, sites = pd.factorize(results['Site'], sort=True)
+        article_codes, articles = pd.factorize(results['Article'], sort=True)
+        group_codes, groups = pd.factorize(results['Group No.'], sort=True)
+        valid = np.flatnonzero((site_codes >= 0) & (article_codes >= 0))
+        order = valid[np.lexsort((article_codes[valid], site_codes[valid]))]
+        data = {name: np.nan_to_num(results[name].to_numpy(dtype=float)[order])
+                for name in values if name in results.columns}
+        return cls(pd.Index(sites), pd.Index(articles), pd.Index(groups),
+                   site_codes[order].astype(np.int32), article_codes[order].astype(np.int32),
+                   group_codes[order].astype(np.int32), data, source=results)
+
+    @property
+    def nnz(self):
+        return len(self.site_codes)
+
+    @property
+    def shape(self):
+        return len(self.sites), len(self.articles)
+
+    def nbytes(self):
+        arrays = [self.site_codes, self.article_codes, self.group_codes, self.indptr, *self.values.values()]
+        return sum(array.nbytes for array in arrays)
+
+    def _subset(self, positions):
+        return SiteArticleMatrix(self.sites, self.articles, self.groups, self.site_codes[positions],
+                                 self.article_codes[positions], self.group_codes[positions],
+                                 {name: data[positions] for name, data in self.values.items()})
+
+    def select(self, group=None, exclude_sites=()):
+        """篩選某個 Group No. 及/或排除指定 Site，返回共用同一組軸的新矩陣。"""
+        mask = np.ones(self.nnz, dtype=bool)
+        if group is not None:
+            code = self.groups.get_indexer([group])[0]
+            mask &= self.group_codes == code
+        excluded = self.sites.get_indexer(list(exclude_sites))
+        excluded = excluded[excluded >= 0]
+        if len(excluded):
+            mask &= ~np.isin(self.site_codes, excluded)
+        return self._subset(np.flatnonzero(mask))
+
+    def _totals(self, codes, labels, name, values):
+        counts = np.bincount(codes, minlength=len(labels))
+        present = np.flatnonzero(counts)
+        return pd.DataFrame({value: np.bincount(codes, weights=self.values[value], minlength=len(labels))[present]
+                             for value in (values or list(self.values))},
+                            index=pd.Index(labels[present], name=name))
+
+    def site_totals(self, values=None):
+        """每個 Site 的合計 (只包含有數據的 Site)，等同 groupby('Site')[values].sum()。"""
+        return self._totals(self.site_codes, self.sites, 'Site', values)
+
+    def article_totals(self, values=None):
+        """每個 Article 的合計 (只包含有數據的 Article)，等同 groupby('Article')[values].sum()。"""
+        return self._totals(self.article_codes, self.articles, 'Article', values)
+
+    def site_row(self, site):
+        """某個 Site 各 Article 的數值 (CSR 的一行)。"""
+        code = self.sites.get_indexer([site])[0]
+        if code < 0:
+            return pd.DataFrame(columns=list(self.values), index=pd.Index([], name='Article'))
+        rows = slice(self.indptr[code], self.indptr[code + 1])
+        return self._frame(rows, self.article_codes[rows], self.articles, 'Article')
+
+    def allocation(self, article):
+        """某個 Article 在各 Site 的數值 (淨需求、庫存、派貨量等)，用於查詢派貨分配。
+
+        首次調用時建立按 Article 排序的索引 (相當於 CSC)，其後每次查詢只讀取該列的格子。
+        """
+        if self._by_article is None:
+            order = np.argsort(self.article_codes, kind='stable')
+            self._by_article = order, np.searchsorted(self.article_codes[order], np.arange(len(self.articles) + 1))
+        order, colptr = self._by_article
+        code = self.articles.get_indexer([article])[0]
+        rows = order[colptr[code]:colptr[code + 1]] if code >= 0 else order[:0]
+        return self._frame(rows, self.site_codes[rows], self.sites, 'Site')
+
+    def _frame(self, rows, codes, labels, name):
+        frame = pd.DataFrame({value: data[rows] for value, data in self.values.items()})
+        frame.index = pd.Index(labels[codes], name=name)
+        return frame.groupby(level=0, sort=True).sum() if frame.index.has_duplicates else frame
+
+    def pivot(self, value):
+        """密集的 Site×Article 表 (只包含有數據的行列，空格為 NaN)，等同 pivot_table(aggfunc='sum')。
+
+        只適合小範圍 (例如單個組別)；大範圍請使用 bin()。選擇為空時返回沒有行列的空表。
+        """
+        if self.nnz == 0:
+            return pd.DataFrame(index=pd.Index([], dtype=object, name='Site'),
+                                columns=pd.Index([], dtype=object, name='Article'), dtype=float)
+        matrix, sites, articles = self._compact(value)
+        return pd.DataFrame(matrix, index=pd.Index(sites, name='Site'), columns=pd.Index(articles, name='Article'))
+
+    def _compact(self, value, max_rows=None, max_columns=None):
+        used_sites, row_codes = np.unique(self.site_codes, return_inverse=True)
+        used_articles, col_codes = np.unique(self.article_codes, return_inverse=True)
+        max_rows = max_rows or len(used_sites)
+        max_columns = max_columns or len(used_articles)
+        return bin_codes(row_codes, self.sites[used_sites], col_codes, self.articles[used_articles],
+                         self.values[value], max_rows, max_columns)
+
+    def bin(self, value='Net Demand', max_rows=None, max_columns=None):
+        """與 charts.bin_matrix 相同的分箱熱圖數據，直接以整數編碼計算。"""
+        return self._compact(value, max_rows or Config.HEATMAP_MAX_ROWS, max_columns or Config.HEATMAP_MAX_COLUMNS)
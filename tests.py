@@ -1,6 +1,71 @@
+import functools
+import gc
+import inspect
+import io
+import json
+import logging
+import os
+import queue
+import sqlite3
+import subprocess
+import sys
 import unittest
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from app import load_data, calculate_demand
+from unittest import mock
+from app import load_data, calculate_demand, merge_data, preflight_check
+from config import Config
+from jobs import JobManager, JobLimitError, Job
+from parallel_demand import calculate_demand_parallel, get_executor, partition_by_group, shutdown_executor
+from run_store import RunStore
+from sales_history import HISTORY_RATE_COLUMN, SalesHistory
+from delta_demand import calculate_demand_delta
+from results_grid import ResultsGrid
+from api_server import ApiService, ServiceMetrics, create_server
+from dataset_store import DatasetStore, dataset_key
+from session_store import SessionStore, frame_bytes, join_results, split_results
+from logging_setup import NonBlockingQueueHandler, setup_logging, shutdown_logging
+from charts import bin_matrix, top_n_with_others
+from sparse_matrix import SiteArticleMatrix
+import metrics
+from out_of_core import calculate_demand_out_of_core, stream_merged
+from dispatch_files import build_dispatch_archive, dispatch_archive_bytes, plan_files, write_dispatch_zip
+from campaigns import calculate_campaigns, compare_campaigns, stack_campaigns
+import load_test
+from fuzz_harness import check_engine, generate_case, reference_calculate_demand
+
+
+def make_merged_frame(num_rows, seed=0):
+    """生成一個與 load_data 輸出結構相同的隨機合併數據框。"""
+    rng = np.random.default_rng(seed)
+    articles = [f'A{i:03d}' for i in range(40)]
+    sites = ['D001'] + [f'S{i:03d}' for i in range(30)]
+    groups = {article: (f'G{i % 12:02d}' if i < 36 else '') for i, article in enumerate(articles)}
+    article = rng.choice(articles, num_rows)
+    return pd.DataFrame({
+        'Article': article,
+        'Site': rng.choice(sites, num_rows),
+        'RP Type': rng.choice(['RF', 'ND'], num_rows),
+        'MOQ': rng.choice([0, 1, 6, 12], num_rows),
+        'SaSa Net Stock': rng.integers(0, 200, num_rows),
+        'Pending Received': rng.integers(0, 50, num_rows),
+        'Safety Stock': rng.integers(0, 20, num_rows),
+        'Last Month Sold Qty': rng.integers(0, 500, num_rows),
+        'Supply source': rng.choice([1, 2, 4], num_rows),
+        'Notes': '',
+        'Group No.': [groups[a] for a in article],
+        'SKU Target': rng.integers(0, 300, num_rows),
+        'Target Type': rng.choice(['HK', 'MO', 'ALL', ''], num_rows),
+        'Target Cover Days': rng.integers(0, 14, num_rows),
+        'Shop Target(HK)': rng.random(num_rows).round(3),
+        'Shop Target(MO)': rng.random(num_rows).round(3),
+        'Shop Target(ALL)': rng.random(num_rows).round(3),
+    })
 
 class TestApp(unittest.TestCase):
 
@@ -129,5 +194,1202 @@ class TestApp(unittest.TestCase):
         self.assertEqual(result['Suggested Dispatch Qty'].iloc[0], 62)
         self.assertEqual(result['Dispatch Type'].iloc[0], '需生成 DN')
 
+class TestPreflight(unittest.TestCase):
+
+    def make_files(self, drop_col=None):
+        from io import BytesIO
+        data_a = {'Article': ['A1'], 'Article Description': ['Desc1'], 'RP Type': ['RF'], 'Site': ['S1'], 'MOQ': [10], 'SaSa Net Stock': [10], 'Pending Received': [0], 'Safety Stock': [0], 'Last Month Sold Qty': [30], 'MTD Sold Qty': [15], 'Supply source': [2], 'Description p. group': ['Buyer1']}
+        df_a = pd.DataFrame(data_a).drop(columns=[drop_col] if drop_col else [])
+        file_a = BytesIO()
+        df_a.to_excel(file_a, index=False)
+        file_a.seek(0)
+        file_b = BytesIO()
+        with pd.ExcelWriter(file_b, engine='openpyxl') as writer:
+            pd.DataFrame({'Group No.': ['G1'], 'Article': ['A1'], 'SKU Target': [10], 'Target Type': ['HK'], 'Promotion Days': [7], 'Target Cover Days': [14]}).to_excel(writer, sheet_name='Sheet 1', index=False)
+            pd.DataFrame({'Site': ['S1'], 'Shop Target(HK)': [0.1]}).to_excel(writer, sheet_name='Sheet2', index=False)
+        file_b.seek(0)
+        return file_a, file_b
+
+    def test_reports_header_errors_without_full_parse(self):
+        file_a, file_b = self.make_files(drop_col='MOQ')
+        with mock.patch('app.pd.read_excel') as read_excel:
+            result, _ = load_data(file_a, file_b)
+        self.assertIsNone(result)
+        read_excel.assert_not_called()
+
+        errors = preflight_check(file_a, file_b)
+        self.assertEqual(len(errors), 2)
+        self.assertIn('MOQ', errors[0])
+        self.assertIn('Shop Target(MO)', errors[1])
+        self.assertEqual(file_a.tell(), 0)
+
+    def test_rejects_type_size_and_non_excel(self):
+        from io import BytesIO
+        file_a, file_b = self.make_files()
+        file_a.name = 'inventory.csv'
+        self.assertIn('類型', preflight_check(file_a, file_b)[0])
+
+        file_a, file_b = self.make_files()
+        with mock.patch.object(Config, 'MAX_FILE_SIZE_BYTES', 10):
+            errors = preflight_check(file_a, file_b)
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(all('大小' in error for error in errors))
+
+        errors = preflight_check(BytesIO(b'not a workbook'), file_b)
+        self.assertEqual(len(errors), 2)
+        self.assertIn('不是有效', errors[0])
+
+
+class TestMultipleFileA(unittest.TestCase):
+
+    def workbook(self, df):
+        from io import BytesIO
+        buffer = BytesIO()
+        df.to_excel(buffer, index=False)
+        buffer.seek(0)
+        return buffer
+
+    def setUp(self):
+        from io import BytesIO
+        base = {'Article Description': 'd', 'RP Type': 'RF', 'MOQ': 6, 'SaSa Net Stock': 1, 'Pending Received': 0, 'Safety Stock': 0, 'Last Month Sold Qty': 30, 'MTD Sold Qty': 1, 'Supply source': 2, 'Description p. group': 'B1'}
+        self.hk = pd.DataFrame({'Article': ['A1', 'A2', 'A1'], 'Site': ['H1', 'H1', 'H2'], **base})
+        self.mo = pd.DataFrame({'Article': ['A1', 'A2'], 'Site': ['M1', 'H1'], **base}).assign(**{'SaSa Net Stock': 9})
+        self.file_b = BytesIO()
+        with pd.ExcelWriter(self.file_b, engine='openpyxl') as writer:
+            pd.DataFrame({'Group No.': ['G1'], 'Article': ['A1'], 'SKU Target': [10], 'Target Type': ['HK'], 'Promotion Days': [7], 'Target Cover Days': [14]}).to_excel(writer, sheet_name='Sheet1', index=False)
+            pd.DataFrame({'Site': ['H1', 'M1'], 'Shop Target(HK)': [0.1, 0], 'Shop Target(MO)': [0, 0.2], 'Shop Target(ALL)': [0, 0]}).to_excel(writer, sheet_name='Sheet2', index=False)
+
+    def expected(self):
+        self.file_b.seek(0)
+        combined = pd.concat([self.hk, self.mo.iloc[:1]], ignore_index=True)
+        result, _ = load_data(self.workbook(combined), self.file_b)
+        return result
+
+    def test_concatenates_and_deduplicates(self):
+        result, _ = load_data([self.workbook(self.hk), self.workbook(self.mo)], self.file_b)
+        self.assertEqual(len(result), 4)
+        self.assertEqual(result.loc[(result['Article'] == 'A2') & (result['Site'] == 'H1'), 'SaSa Net Stock'].iloc[0], 1)
+        pd.testing.assert_frame_equal(result, self.expected())
+
+    def test_parallel_parse_matches(self):
+        with mock.patch.object(Config, 'INGEST_PARALLEL_MIN_BYTES', 0):
+            result, _ = load_data([self.workbook(self.hk), self.workbook(self.mo)], self.file_b)
+        shutdown_executor()
+        pd.testing.assert_frame_equal(result, self.expected())
+
+    def test_schema_mismatch_rejected(self):
+        result, _ = load_data([self.workbook(self.hk), self.workbook(self.mo.drop(columns='MOQ'))], self.file_b)
+        self.assertIsNone(result)
+        errors = preflight_check([self.workbook(self.hk), self.workbook(self.mo.drop(columns='MOQ'))], self.file_b)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('檔案 A (2)', errors[0])
+
+    def test_run_load_reports_notices(self):
+        from app import run_load
+        self.file_b.seek(0)
+        result = run_load([self.workbook(self.hk), self.workbook(self.mo)], self.file_b)
+        pd.testing.assert_frame_equal(result['merged'], self.expected())
+        self.assertEqual([level for level, _ in result['notices']], ['warning'])
+        self.assertIn('1 行重複', result['notices'][0][1])
+
+        with self.assertRaisesRegex(ValueError, 'MOQ'):
+            run_load([self.workbook(self.hk), self.workbook(self.mo.drop(columns='MOQ'))], self.file_b)
+
+
+class TestJobManager(unittest.TestCase):
+
+    def wait_for(self, job, timeout=5):
+        deadline = time.time() + timeout
+        while not job.done and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(job.done)
+
+    def test_progress_and_result(self):
+        manager = JobManager(max_workers=1, max_queued=0)
+        seen = []
+
+        def work(value, progress_callback=None):
+            for pct in (25, 50, 75):
+                progress_callback(pct, f'stage {pct}')
+                seen.append(pct)
+            return value * 2
+
+        job = manager.submit(work, 21)
+        self.wait_for(job)
+        self.assertEqual(job.status, Job.COMPLETED)
+        self.assertEqual(job.result, 42)
+        self.assertEqual(job.progress, 100)
+        self.assertEqual(seen, [25, 50, 75])
+        manager.shutdown()
+
+    def test_cancel_running_job(self):
+        manager = JobManager(max_workers=1, max_queued=0)
+        started = threading.Event()
+
+        def work(progress_callback=None):
+            started.set()
+            while True:
+                progress_callback(10, 'looping')
+                time.sleep(0.01)
+
+        job = manager.submit(work)
+        started.wait(2)
+        manager.cancel(job.job_id)
+        self.wait_for(job)
+        self.assertEqual(job.status, Job.CANCELLED)
+        manager.shutdown()
+
+    def test_concurrency_limit(self):
+        manager = JobManager(max_workers=1, max_queued=1)
+        release = threading.Event()
+
+        def work(progress_callback=None):
+            release.wait(2)
+
+        jobs = [manager.submit(work), manager.submit(work)]
+        with self.assertRaises(JobLimitError):
+            manager.submit(work)
+        release.set()
+        for job in jobs:
+            self.wait_for(job)
+        manager.shutdown()
+
+    def test_calculate_demand_reports_progress(self):
+        data = {'Article': ['A1'], 'Site': ['S1'], 'Last Month Sold Qty': [30], 'Target Cover Days': [14], 'SKU Target': [100], 'Target Type': ['HK'], 'Shop Target(HK)': [0.5], 'Shop Target(MO)': [0], 'Shop Target(ALL)': [0], 'SaSa Net Stock': [5], 'Pending Received': [2], 'Safety Stock': [3], 'RP Type': ['RF'], 'MOQ': [10], 'Supply source': [2], 'Group No.': ['G1'], 'Notes': ['']}
+        progress = []
+        calculate_demand(pd.DataFrame(data), 2, progress_callback=lambda pct, msg: progress.append(pct))
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 100)
+
+
+class TestParallelDemand(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_executor()
+
+    def test_partitions_keep_groups_together(self):
+        df = make_merged_frame(500)
+        partitions = partition_by_group(df, 4)
+        self.assertEqual(sorted(np.concatenate(partitions)), list(range(len(df))))
+        owner = {}
+        for i, part in enumerate(partitions):
+            for group in df['Group No.'].iloc[part].unique():
+                self.assertNotIn(group, owner)
+                owner[group] = i
+        unmatched = [part for part in partitions if (df['Group No.'].iloc[part] == '').all()]
+        self.assertEqual(len(unmatched), 1)
+
+    def test_parallel_matches_sequential(self):
+        df = make_merged_frame(2000, seed=1)
+        expected_results, expected_summary = calculate_demand(df, 2.5)
+        with mock.patch.object(Config, 'PARALLEL_MIN_ROWS', 0):
+            results, summary = calculate_demand_parallel(df, 2.5, max_workers=2)
+        pd.testing.assert_frame_equal(results, expected_results)
+        pd.testing.assert_frame_equal(summary, expected_summary)
+
+    def test_other_pool_sizes_do_not_cancel_work(self):
+        executor = get_executor(1)
+        running = executor.submit(time.sleep, 0.5)
+        queued = executor.submit(os.getpid)
+        other = get_executor(2)
+        self.assertIsNot(other, executor)
+        self.assertIs(get_executor(1), executor)
+        self.assertIsNone(running.result(timeout=60))
+        self.assertIsInstance(queued.result(timeout=60), int)
+        self.assertFalse(queued.cancelled())
+
+
+class TestRunStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = RunStore(self.tmp.name)
+        self.df = make_merged_frame(300, seed=2)
+        self.results, self.summary = calculate_demand(self.df, 2)
+
+    def test_save_and_load_run(self):
+        run_id = self.store.save_run(self.df, self.results, self.summary, 2, file_a=b'a', file_b=b'b')
+        runs = self.store.list_runs()
+        self.assertEqual(runs['run_id'].tolist(), [run_id])
+        self.assertEqual(runs['result_rows'].iloc[0], len(self.results))
+        pd.testing.assert_frame_equal(self.store.load_frame(run_id, 'summary'), self.summary, check_dtype=False)
+
+    def test_indexed_paged_query(self):
+        with mock.patch.object(Config, 'RUN_STORE_ROW_GROUP_SIZE', 32):
+            run_a = self.store.save_run(self.df, self.results, self.summary, 2)
+            run_b = self.store.save_run(self.df, self.results, self.summary, 3)
+        expected = self.results[self.results['Site'] == 'S001'].reset_index(drop=True)
+
+        self.assertEqual(self.store.count_results(site='S001'), 2 * len(expected))
+        page = self.store.query_results(site='S001', run_ids=[run_a], offset=0, limit=len(expected))
+        self.assertEqual(set(page['Run ID']), {run_a})
+        pd.testing.assert_frame_equal(page.drop(columns='Run ID'), expected, check_dtype=False)
+
+        second = self.store.query_results(site='S001', run_ids=[run_a, run_b], offset=len(expected), limit=5)
+        self.assertEqual(len(second), min(5, len(expected)))
+        self.assertEqual(self.store.count_results(group_no='G01', article='A001', run_ids=[run_b]),
+                         int(((self.results['Group No.'] == 'G01') & (self.results['Article'] == 'A001')).sum()))
+
+    def test_prune_old_runs(self):
+        with mock.patch.object(Config, 'RUN_STORE_MAX_RUNS', 2):
+            runs = [self.store.save_run(self.df, self.results, self.summary, lead_time) for lead_time in (1, 2, 3)]
+        self.assertEqual(set(self.store.list_runs()['run_id']), set(runs[1:]))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, runs[0])))
+        self.assertEqual(self.store.count_results(run_ids=[runs[0]]), 0)
+
+        # 最近一次運行即使已過期亦會保留
+        with self.store._connect() as conn:
+            conn.execute("UPDATE runs SET created_at = '2000-01-01T00:00:00'")
+        self.assertEqual(len(self.store.prune(max_runs=0, max_age_days=30)), 1)
+        self.assertEqual(len(self.store.list_runs()), 1)
+
+
+class TestSalesHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.history = SalesHistory(self.tmp.name, window_months=3)
+        self.df = make_merged_frame(400, seed=7).drop_duplicates(['Article', 'Site']).reset_index(drop=True)
+
+    def snapshot(self, seed):
+        rng = np.random.default_rng(seed)
+        rows = rng.random(len(self.df)) < 0.8
+        return self.df[rows].assign(**{'Last Month Sold Qty': rng.integers(0, 300, rows.sum())})
+
+    def test_incremental_matches_rebuild(self):
+        months = ['2024-01', '2024-02', '2024-04', '2024-03', '2024-05']
+        for i, month in enumerate(months):
+            with mock.patch.object(self.history, '_read_month', wraps=self.history._read_month) as read_month:
+                self.history.ingest(self.snapshot(i), month)
+            # 每次只讀取離開窗口的月份，不重新掃描整個歷史
+            self.assertLessEqual(read_month.call_count, 1)
+        self.history.ingest(self.snapshot(10), '2024-04', replace=True)
+        with self.assertRaises(ValueError):
+            self.history.ingest(self.snapshot(11), '2024-04')
+
+        incremental = self.history.rolling()
+        self.history.rebuild()
+        pd.testing.assert_frame_equal(incremental, self.history.rolling(), check_dtype=False)
+        window = self.history.list_months()
+        self.assertEqual(window.loc[window['in_window'] == 1, 'month'].tolist(), ['2024-05', '2024-04', '2024-03'])
+        self.assertEqual(incremental['Days'].max(), 31 + 30 + 31)
+
+    def test_snapshot_cleaned_and_failed_ingest_rolled_back(self):
+        snapshot = self.snapshot(1).iloc[:50].copy()
+        snapshot.iloc[0, snapshot.columns.get_loc('Last Month Sold Qty')] = 5000000
+        snapshot.iloc[1, snapshot.columns.get_loc('Last Month Sold Qty')] = -7
+        self.history.ingest(snapshot, '2024-05')
+        sold = self.history.rolling().set_index(['Article', 'Site'])['Sold Qty']
+        self.assertEqual(sold.loc[tuple(snapshot.iloc[0][['Article', 'Site']])], 100000)
+        self.assertEqual(sold.loc[tuple(snapshot.iloc[1][['Article', 'Site']])], 0)
+
+        before = self.history.rolling()
+        files = sorted(os.listdir(os.path.join(self.tmp.name, 'months')))
+        with sqlite3.connect(self.history.db_path) as conn:
+            conn.execute("CREATE TRIGGER fail BEFORE INSERT ON state BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.history.ingest(self.snapshot(2), '2024-06')
+        # 元數據未提交時，月份檔案及滾動累計保持原狀
+        pd.testing.assert_frame_equal(self.history.rolling(), before)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp.name, 'months'))), files)
+        self.assertEqual(self.history.list_months()['month'].tolist(), ['2024-05'])
+
+    def test_rates_used_by_calculate_demand(self):
+        self.history.ingest(self.snapshot(1).iloc[:100], '2024-05')
+        merged = self.history.attach_rates(self.df)
+        has_history = merged[HISTORY_RATE_COLUMN].notna()
+        self.assertEqual(has_history.sum(), 100)
+
+        results, _ = calculate_demand(merged, 2.5)
+        np.testing.assert_allclose(results.loc[has_history, 'Daily Sales Rate'],
+                                   merged.loc[has_history, HISTORY_RATE_COLUMN])
+        np.testing.assert_allclose(results.loc[~has_history, 'Daily Sales Rate'],
+                                   merged.loc[~has_history, 'Last Month Sold Qty'] / 30)
+
+
+class TestDeltaDemand(unittest.TestCase):
+
+    def setUp(self):
+        base = make_merged_frame(1500, seed=3).drop_duplicates(['Article', 'Site']).reset_index(drop=True)
+        removed = base.index[base['Group No.'] == 'G01'][:10]
+        added = base.index[base['Group No.'] == 'G02'][:20]
+        self.prev = base.drop(added).reset_index(drop=True)
+        self.prev_results, self.prev_summary = calculate_demand(self.prev, 2)
+
+        new = base.drop(removed)
+        changed = new.index[new['Group No.'] == 'G03'][:3]
+        new.loc[changed, 'SaSa Net Stock'] += 7
+        self.new = new.sample(frac=1, random_state=0).reset_index(drop=True)
+
+    def test_delta_matches_full_recompute(self):
+        expected_results, expected_summary = calculate_demand(self.new, 2)
+        results, summary, report = calculate_demand_delta(
+            self.prev, self.prev_results, self.prev_summary, 2, self.new, 2)
+        self.assertFalse(report.full_recompute)
+        self.assertEqual((report.added, report.removed, report.changed), (20, 10, 3))
+        self.assertIn('G03', report.affected_groups)
+        self.assertLess(report.recomputed_rows, len(self.new))
+        pd.testing.assert_frame_equal(results, expected_results)
+        pd.testing.assert_frame_equal(summary, expected_summary)
+
+    def test_lead_time_change_falls_back_to_full(self):
+        _, _, report = calculate_demand_delta(self.prev, self.prev_results, self.prev_summary, 2, self.new, 3)
+        self.assertTrue(report.full_recompute)
+
+    def test_baseline_from_run_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = RunStore(tmp)
+            run_id = store.save_run(self.prev, self.prev_results, self.prev_summary, 2)
+            baseline = [store.load_frame(run_id, kind) for kind in ('merged', 'results', 'summary')]
+        results, summary, report = calculate_demand_delta(*baseline, 2, self.prev, 2)
+        self.assertEqual((report.added, report.removed, report.changed, report.recomputed_rows), (0, 0, 0, 0))
+        pd.testing.assert_frame_equal(results, self.prev_results, check_dtype=False)
+
+
+class TestResultsGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.results, self.summary = calculate_demand(make_merged_frame(800, seed=4), 2)
+        self.grid = ResultsGrid(self.results, self.summary)
+
+    def test_filter_and_sort_match_pandas(self):
+        filters = {'Group No.': ['G01', 'G02'], 'Dispatch Type': ['需生成 DN']}
+        positions = self.grid.query(filters, sort_by='Net Demand', ascending=False)
+        mask = self.results['Group No.'].isin(['G01', 'G02']) & (self.results['Dispatch Type'] == '需生成 DN')
+        self.assertEqual(sorted(positions.tolist()), np.flatnonzero(mask).tolist())
+        net = self.results['Net Demand'].to_numpy()[positions]
+        self.assertTrue((np.diff(net) <= 0).all())
+
+        # 文字欄位 (派貨類型、缺貨警告) 同樣可排序，結果與 pandas 的穩定排序一致
+        self.assertIn('Dispatch Type', self.grid.sort_columns())
+        self.assertIn('Out_of_Stock_Warning', self.grid.sort_columns())
+        for ascending in (True, False):
+            positions = self.grid.query(filters, sort_by='Dispatch Type', ascending=ascending)
+            expected = self.results[mask.to_numpy()].sort_values('Dispatch Type', ascending=ascending, kind='stable')
+            self.assertEqual(positions.tolist(), expected.index.tolist())
+
+
+        results = pd.DataFrame({'Group No.': ['G1', 'G2', 'G1', 'G3', 'G2'],
+                                'Article': ['A1', 'A2', 'A1', 'A3', 'A2'],
+                                'Net Demand': [1, 2, 3, 4, 5]})
+        summary = pd.DataFrame({'Group No.': ['G1', 'G2'], 'SKU': ['A1', 'A2'],
+                                'Out_of_Stock_Warning': ['D001 缺貨', '']})
+        grid = ResultsGrid(results, summary)
+        self.assertEqual(grid.query(sort_by='Out_of_Stock_Warning').tolist(), [1, 3, 4, 0, 2])
+        self.assertEqual(grid.query(sort_by='Out_of_Stock_Warning', ascending=False).tolist(), [0, 2, 1, 3, 4])
+
+    def test_descending_sort_is_stable_and_numeric(self):
+        results = pd.DataFrame({'Group No.': ['10', '9', '100', '9', '', '10'],
+                                'Net Demand': [5, 7, 5, 7, 1, 5]})
+        grid = ResultsGrid(results)
+        self.assertEqual(grid.query(sort_by='Net Demand', ascending=False).tolist(), [1, 3, 0, 2, 5, 4])
+        self.assertEqual(grid.query(sort_by='Net Demand').tolist(), [4, 0, 2, 5, 1, 3])
+        self.assertEqual(grid.query(sort_by='Group No.').tolist(), [1, 3, 0, 5, 2, 4])
+        self.assertEqual(grid.query(sort_by='Group No.', ascending=False).tolist(), [2, 0, 5, 1, 3, 4])
+        expected = results.sort_values('Net Demand', ascending=False, kind='stable').index.tolist()
+        self.assertEqual(grid.query(sort_by='Net Demand', ascending=False).tolist(), expected)
+
+    def test_pages_and_warning_filter(self):
+        positions = self.grid.query({'Out_of_Stock_Warning': ['D001 缺貨']})
+        page = self.grid.page(positions, 2, 10)
+        self.assertEqual(page.index.tolist(), positions[10:20].tolist())
+        self.assertTrue((page['Out_of_Stock_Warning'] == 'D001 缺貨').all())
+        self.assertEqual(len(self.grid.query({'Site': ['NOPE']})), 0)
+
+
+class TestApiServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.service = ApiService(workers=1)
+        cls.service.warm_up()
+        cls.server = create_server(cls.service, port=0)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.service.shutdown()
+
+    def post(self, payload):
+        import json
+        import urllib.error
+        import urllib.request
+        request = urllib.request.Request(self.url + '/analyze', data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def make_payload(self, drop_col=None):
+        import base64
+        from io import BytesIO
+        df_a = pd.DataFrame({'Article': ['A1', 'A2', 'A1'], 'Article Description': ['d1', 'd2', 'd1'], 'RP Type': ['RF', 'RF', 'ND'], 'Site': ['S1', 'S1', 'D001'], 'MOQ': [6, 0, 6], 'SaSa Net Stock': [5, 1, 100], 'Pending Received': [0, 0, 0], 'Safety Stock': [1, 1, 0], 'Last Month Sold Qty': [30, 45, 0], 'MTD Sold Qty': [1, 2, 0], 'Supply source': [2, 1, 2], 'Description p. group': ['B1', 'B2', 'B1']})
+        if drop_col:
+            df_a = df_a.drop(columns=drop_col)
+        df_b1 = pd.DataFrame({'Group No.': ['G1', 'G1'], 'Article': ['A1', 'A2'], 'SKU Target': [10, 20], 'Target Type': ['HK', 'HK'], 'Promotion Days': [7, 7], 'Target Cover Days': [14, 14]})
+        df_b2 = pd.DataFrame({'Site': ['S1', 'D001'], 'Shop Target(HK)': [0.5, 0], 'Shop Target(MO)': [0, 0], 'Shop Target(ALL)': [0, 0]})
+        file_b = BytesIO()
+        with pd.ExcelWriter(file_b, engine='openpyxl') as writer:
+            df_b1.to_excel(writer, sheet_name='Sheet1', index=False)
+            df_b2.to_excel(writer, sheet_name='Sheet2', index=False)
+        encode = lambda data: base64.b64encode(data).decode()
+        payload = {
+            'lead_time': 2,
+            'file_a': {'format': 'csv', 'content': encode(df_a.to_csv(index=False).encode())},
+            'file_b': {'format': 'xlsx', 'content': encode(file_b.getvalue())},
+        }
+        return payload, file_b
+
+    def test_analyze_csv_matches_load_data(self):
+        from io import BytesIO
+        payload, file_b = self.make_payload()
+        status, body = self.post(payload)
+        self.assertEqual(status, 200)
+
+        import base64
+        file_a = BytesIO()
+        pd.read_csv(BytesIO(base64.b64decode(payload['file_a']['content']))).to_excel(file_a, index=False)
+        file_a.seek(0)
+        file_b.seek(0)
+        merged, _ = load_data(file_a, file_b)
+        _, expected_summary = calculate_demand(merged, 2)
+        self.assertEqual(body['rows'], 3)
+        self.assertEqual(pd.DataFrame(body['summary'])['Total_Dispatch'].tolist(), expected_summary['Total_Dispatch'].tolist())
+
+        import json
+        import urllib.request
+        with urllib.request.urlopen(self.url + '/metrics', timeout=10) as response:
+            metrics = json.loads(response.read())
+        self.assertGreaterEqual(metrics['requests_total'], 1)
+        self.assertIsNotNone(metrics['latency_p95_ms'])
+        self.assertEqual(metrics['queue_depth'], 0)
+
+    def test_missing_column_returns_400(self):
+        payload, _ = self.make_payload(drop_col='MOQ')
+        status, body = self.post(payload)
+        self.assertEqual(status, 400)
+        self.assertIn('MOQ', body['error'])
+
+    def test_non_object_payload_returns_400(self):
+        for payload in ([1, 2], "lead_time", None):
+            status, body = self.post(payload)
+            self.assertEqual(status, 400, payload)
+            self.assertIn('JSON 物件', body['error'])
+        payload, _ = self.make_payload()
+        payload['lead_time'] = [2]
+        self.assertEqual(self.post(payload)[0], 400)
+
+    def test_invalid_lead_time_returns_400(self):
+        payload, _ = self.make_payload()
+        for lead_time in ("NaN", "inf", "-inf", -1, 0, Config.LEAD_TIME_MAX + 0.5):
+            payload['lead_time'] = lead_time
+            status, body = self.post(payload)
+            self.assertEqual(status, 400, lead_time)
+            self.assertIn('lead_time', body['error'])
+
+        payload['lead_time'] = Config.LEAD_TIME_MAX
+        status, body = self.post(payload)
+        self.assertEqual(status, 200)
+        self.assertEqual(body['lead_time'], Config.LEAD_TIME_MAX)
+        self.assertEqual(len(body['results']), body['rows'])
+
+    def test_capacity_check_is_atomic(self):
+        metrics = ServiceMetrics()
+        barrier = threading.Barrier(16)
+
+        def claim():
+            barrier.wait()
+            return metrics.try_begin(3)
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            admitted = list(pool.map(lambda _: claim(), range(16)))
+        self.assertEqual(sum(admitted), 3)
+        self.assertEqual((metrics.in_flight, metrics.rejected_total), (3, 13))
+
+    def test_dispatch_archive_streamed(self):
+        import urllib.error
+        import urllib.request
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        store = RunStore(tmp.name)
+        df = make_merged_frame(300, seed=5)
+        results, summary = calculate_demand(df, 2)
+        run_id = store.save_run(df, results, summary, 2)
+
+        expected = io.BytesIO()
+        write_dispatch_zip(results, expected, fmt='csv')
+        with mock.patch.object(self.service, 'run_store', store):
+            with urllib.request.urlopen(f'{self.url}/runs/{run_id}/dispatch.zip?format=csv', timeout=60) as response:
+                self.assertEqual(response.headers['Content-Type'], 'application/zip')
+                content = response.read()
+            with self.assertRaises(urllib.error.HTTPError) as missing:
+                urllib.request.urlopen(f'{self.url}/runs/nope/dispatch.zip', timeout=10)
+        self.assertEqual(missing.exception.code, 404)
+        with zipfile.ZipFile(io.BytesIO(content)) as archive, zipfile.ZipFile(expected) as reference:
+            self.assertEqual(archive.namelist(), reference.namelist())
+            self.assertEqual(archive.read('manifest.csv'), reference.read('manifest.csv'))
+
+
+class TestDatasetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = DatasetStore(self.tmp.name)
+        self.df = make_merged_frame(200, seed=9)
+
+    def test_load_data_reuses_snapshots(self):
+        files = TestMultipleFileA()
+        files.setUp()
+        file_a = [files.workbook(files.hk), files.workbook(files.mo)]
+        expected, _ = load_data(file_a, files.file_b)
+
+        import app
+        with mock.patch.object(Config, 'DATASET_STORE_ENABLED', True), \
+                mock.patch.object(app, 'get_dataset_store', return_value=self.store):
+            first, _ = load_data(file_a, files.file_b)
+            self.assertEqual(len(self.store.keys()), 4)
+            with mock.patch.object(app.pd, 'read_excel', side_effect=AssertionError("re-parsed")), \
+                    mock.patch('ingest.parse_file_a', side_effect=AssertionError("re-parsed")):
+                second, _ = load_data(file_a, files.file_b)
+        pd.testing.assert_frame_equal(first, expected)
+        pd.testing.assert_frame_equal(second, expected)
+
+    def test_snapshot_shared_with_other_process(self):
+        key = dataset_key('file_a', 'abc')
+        self.store.put(key, self.df)
+        script = ("import sys; from dataset_store import DatasetStore; "
+                  "h = DatasetStore(sys.argv[1]).open(sys.argv[2]); print(h.table.num_rows, h.to_pandas()['MOQ'].sum())")
+        output = subprocess.run([sys.executable, '-c', script, self.tmp.name, key],
+                                capture_output=True, text=True, check=True).stdout.split()
+        self.assertEqual(output, [str(len(self.df)), str(self.df['MOQ'].sum())])
+
+        with self.store.open(key) as handle:
+            pd.testing.assert_frame_equal(handle.to_pandas(), self.df)
+
+    def test_refcount_and_cleanup(self):
+        key = dataset_key('file_b1', 'abc')
+        self.store.put(key, self.df)
+        handle = self.store.open(key)
+        self.assertEqual(self.store.refcount(key), 1)
+        self.assertEqual(self.store.cleanup(max_idle_seconds=0), [])
+
+        # 轉出的數據框仍在使用時，關閉 handle 不會釋放引用
+        df = handle.to_pandas()
+        handle.close()
+        self.assertEqual(self.store.refcount(key), 1)
+        self.assertEqual(self.store.cleanup(max_idle_seconds=0), [])
+        del df
+        gc.collect()
+        self.assertEqual(self.store.refcount(key), 0)
+
+        open(os.path.join(self.tmp.name, f'{key}.refs', '999999999-dead'), 'w').close()
+        self.assertEqual(self.store.refcount(key), 0)
+        self.assertEqual(self.store.cleanup(max_idle_seconds=3600), [])
+        self.assertEqual(self.store.cleanup(max_idle_seconds=0), [key])
+        self.assertIsNone(self.store.open(key))
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.df = make_merged_frame(500, seed=8)
+        self.results, self.summary = calculate_demand(self.df, 2)
+
+    def test_results_stored_as_derived_columns(self):
+        derived, columns = split_results(self.results, self.df)
+        self.assertNotIn('SaSa Net Stock', derived.columns)
+        self.assertIn('Notes', derived.columns)
+        self.assertIn('Suggested Dispatch Qty', derived.columns)
+        pd.testing.assert_frame_equal(join_results(self.df, derived, columns), self.results)
+
+        store = SessionStore(memory_cap=10 ** 9)
+        store.set_merged('s1', self.df)
+        store.set_results('s1', self.results, self.summary)
+        self.assertLess(store.session_bytes('s1'),
+                        frame_bytes(self.df) + frame_bytes(self.results) + frame_bytes(self.summary))
+        results, summary = store.get_results('s1')
+        pd.testing.assert_frame_equal(results, self.results)
+        self.assertIs(store.get_results('s1')[0], results)
+
+    def test_cached_views_counted_once(self):
+        store = SessionStore(memory_cap=10 ** 9)
+        store.set_merged('s1', self.df)
+        store.set_results('s1', self.results, self.summary)
+        stored = store.session_bytes('s1')
+        # 合併後的結果與合併數據及衍生欄位共用緩衝區，不重複計算
+        store.get_results('s1')
+        self.assertLess(store.session_bytes('s1') - stored, frame_bytes(self.results) // 10)
+
+        grid = store.results_grid('s1', ResultsGrid)
+        matrix = store.site_article_matrix('s1', lambda results, summary: SiteArticleMatrix.from_results(results))
+        self.assertGreaterEqual(store.session_bytes('s1') - stored, grid.nbytes() + matrix.nbytes())
+
+    def test_idle_sessions_compressed(self):
+        store = SessionStore(memory_cap=10 ** 9, idle_seconds=0)
+        store.set_merged('s1', self.df)
+        store.set_results('s1', self.results, self.summary)
+        uncompressed = store.session_bytes('s1')
+        store.set_merged('s2', self.df.head(10))
+        usage = store.usage().set_index('session_id')
+        self.assertTrue(usage.loc['s1', 'compressed'])
+        self.assertLess(store.session_bytes('s1'), uncompressed)
+
+        results, summary = store.get_results('s1')
+        pd.testing.assert_frame_equal(results, self.results, check_dtype=False)
+        pd.testing.assert_frame_equal(summary, self.summary, check_dtype=False)
+
+    def test_lru_sessions_evicted_over_cap(self):
+        store = SessionStore(memory_cap=int(frame_bytes(self.df) * 2.5))
+        for session_id in ('s1', 's2', 's3'):
+            store.set_merged(session_id, self.df.copy())
+        store.get_merged('s2')
+        store.set_merged('s4', self.df.copy())
+        self.assertTrue(store.is_evicted('s1'))
+        self.assertIsNone(store.get_merged('s1'))
+        self.assertFalse(store.is_evicted('s2'))
+        self.assertLessEqual(store.total_bytes(), store.memory_cap)
+
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.log_file = os.path.join(self.tmp.name, 'app.log')
+        self.json_file = os.path.join(self.tmp.name, 'app.jsonl')
+
+    def read_records(self, path=None):
+        with open(path or self.json_file, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_structured_records_written_by_background_thread(self):
+        with mock.patch.object(Config, 'LOG_ROTATION', 'size'):
+            setup_logging(self.log_file, self.json_file)
+        self.assertIs(setup_logging(self.log_file), setup_logging())
+        logging.info("Analysis completed", extra={'run_id': 'r1', 'result_rows': 3, 'stage_durations': {'calculate': 0.5}})
+        try:
+            raise ValueError("bad MOQ")
+        except ValueError:
+            logging.error("Demand calculation error", exc_info=True)
+        shutdown_logging()
+
+        info, error = self.read_records()[-2:]
+        self.assertEqual(info['message'], "Analysis completed")
+        self.assertEqual((info['run_id'], info['result_rows']), ('r1', 3))
+        self.assertEqual(info['stage_durations'], {'calculate': 0.5})
+        self.assertEqual(error['level'], 'ERROR')
+        self.assertIn('ValueError: bad MOQ', error['exception'])
+        # app.log 保持純文字，JSON 記錄只寫入獨立的檔案
+        with open(self.log_file, encoding='utf-8') as f:
+            text = f.read()
+        self.assertIn('INFO - Analysis completed', text)
+        self.assertNotIn('{', text)
+
+    def test_worker_process_records_forwarded(self):
+        shutdown_executor()
+        setup_logging(self.log_file, self.json_file)
+        try:
+            with mock.patch.object(Config, 'PARALLEL_START_METHOD', 'spawn'):
+                executor = get_executor(1)
+            executor.submit(logging.warning, "from worker").result()
+        finally:
+            shutdown_executor()
+            shutdown_logging()
+        records = [record for record in self.read_records() if record['message'] == "from worker"]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['level'], 'WARNING')
+
+    def test_rotation_by_size(self):
+        with mock.patch.object(Config, 'LOG_MAX_BYTES', 2000), mock.patch.object(Config, 'LOG_BACKUP_COUNT', 2):
+            setup_logging(self.log_file)
+        for i in range(100):
+            logging.info(f"record {i}")
+        shutdown_logging()
+        self.assertLessEqual(os.path.getsize(self.log_file), 2000)
+        self.assertTrue(os.path.exists(self.log_file + '.1'))
+        self.assertFalse(os.path.exists(self.log_file + '.3'))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        logger = logging.getLogger('tests.queue')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        for _ in range(3):
+            logger.warning("message")
+        self.assertEqual(handler.dropped, 2)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(metrics.disable)
+
+    def test_disabled_is_noop(self):
+        metrics.disable()
+        metrics.inc('load_errors_total')
+        metrics.observe('export_bytes', 10)
+        self.assertIs(metrics.timer('export_duration_seconds'), metrics.timer('load_duration_seconds'))
+        self.assertIsNone(metrics.get_registry())
+
+    def test_prometheus_text_format(self):
+        registry = metrics.enable(metrics.MetricsRegistry())
+        for value in (0.02, 0.3, 0.4, 3):
+            metrics.observe('calculate_duration_seconds', value, mode='parallel')
+        metrics.inc('cache_requests_total', cache='up"load', result='hit')
+        text = registry.render()
+        self.assertIn('# TYPE promo_calculate_duration_seconds histogram', text)
+        self.assertIn('promo_calculate_duration_seconds_bucket{mode="parallel",le="0.5"} 3', text)
+        self.assertIn('promo_calculate_duration_seconds_bucket{mode="parallel",le="+Inf"} 4', text)
+        self.assertIn('promo_calculate_duration_seconds_count{mode="parallel"} 4', text)
+        self.assertIn('promo_cache_requests_total{cache="up\\"load",result="hit"} 1', text)
+        p50 = registry.snapshot().set_index('metric').loc['promo_calculate_duration_seconds', 'p50']
+        self.assertTrue(0.25 <= p50 <= 0.5)
+        with self.assertRaises(ValueError):
+            metrics.inc('cache_requests_total', cache='upload')
+
+    def test_http_endpoint(self):
+        from urllib.request import urlopen
+        registry = metrics.enable(metrics.MetricsRegistry())
+        metrics.inc('load_errors_total')
+        server = metrics.start_http_server(registry, port=0)
+        self.addCleanup(server.shutdown)
+        with urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics', timeout=5) as response:
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            self.assertIn('promo_load_errors_total 1', response.read().decode('utf-8'))
+
+    def test_load_and_export_instrumented(self):
+        from app import export_to_excel
+        registry = metrics.enable(metrics.MetricsRegistry())
+        files = TestMultipleFileA()
+        files.setUp()
+        df_merged, _ = load_data(files.workbook(files.hk), files.file_b)
+        results, summary = calculate_demand(df_merged, 2.5)
+        export_to_excel(df_merged, results, summary)
+        self.assertEqual(registry.value('load_rows_total', file='a'), 3)
+        self.assertEqual(registry.value('load_duration_seconds'), 1)
+        self.assertEqual(registry.value('export_bytes'), 1)
+
+
+class TestCharts(unittest.TestCase):
+
+    def test_top_n_with_others(self):
+        data = pd.DataFrame({'Article': ['A1', 'A2', 'A3', 'A4'],
+                             'Total Demand': [5.0, 20.0, 1.0, 10.0], 'Stock Available': [1, 2, 3, 4]})
+        pd.testing.assert_frame_equal(top_n_with_others(data, 4), data)
+        top = top_n_with_others(data, 2)
+        self.assertEqual(top['Article'].tolist(), ['A2', 'A4', 'Others (2 SKUs)'])
+        self.assertEqual(top['Total Demand'].tolist(), [20.0, 10.0, 6.0])
+        self.assertEqual(top['Stock Available'].tolist(), [2, 4, 4])
+        pd.testing.assert_series_equal(top.dtypes, data.dtypes)
+
+    def test_bin_matrix_matches_pivot_when_small(self):
+        df = make_merged_frame(400, seed=6)
+        df['Net Demand'] = np.random.default_rng(6).normal(size=len(df))
+        matrix, rows, columns = bin_matrix(df, max_rows=100, max_columns=100)
+        expected = df.pivot_table(index='Site', columns='Article', values='Net Demand', aggfunc='sum')
+        self.assertEqual(rows, expected.index.tolist())
+        self.assertEqual(columns, expected.columns.tolist())
+        np.testing.assert_allclose(matrix, expected.to_numpy())
+
+    def test_bin_matrix_caps_shape_and_keeps_totals(self):
+        df = make_merged_frame(2000, seed=7)
+        df['Net Demand'] = np.random.default_rng(7).normal(size=len(df))
+        matrix, rows, columns = bin_matrix(df, max_rows=8, max_columns=5)
+        self.assertEqual(matrix.shape, (8, 5))
+        self.assertEqual((len(rows), len(columns)), (8, 5))
+        self.assertAlmostEqual(np.nansum(matrix), df['Net Demand'].sum())
+
+
+class TestSparseMatrix(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results, _ = calculate_demand(make_merged_frame(3000, seed=6), 2.5)
+        cls.matrix = SiteArticleMatrix.from_results(cls.results)
+
+    def test_matches_pandas_aggregations(self):
+        values = list(self.matrix.values)
+        self.assertEqual(self.matrix.nnz, len(self.results))
+        for group in (None, 'G03', ''):
+            selected = self.matrix.select(group=group, exclude_sites=['D001'])
+            df = self.results[self.results['Site'] != 'D001']
+            if group is not None:
+                df = df[df['Group No.'] == group]
+            for max_rows, max_columns in ((None, None), (4, 6)):
+                expected = bin_matrix(df, max_rows=max_rows, max_columns=max_columns)
+                matrix, row_labels, col_labels = selected.bin(max_rows=max_rows, max_columns=max_columns)
+                np.testing.assert_allclose(matrix, expected[0])
+                self.assertEqual((row_labels, col_labels), expected[1:])
+            pivot = df.pivot_table(index='Site', columns='Article', values='Net Demand', aggfunc='sum')
+            pd.testing.assert_frame_equal(selected.pivot('Net Demand'), pivot, check_dtype=False)
+            pd.testing.assert_frame_equal(selected.site_totals(), df.groupby('Site')[values].sum(), check_dtype=False)
+
+    def test_row_and_column_queries(self):
+        values = list(self.matrix.values)
+        expected = self.results[self.results['Article'] == 'A007'].groupby('Site')[values].sum()
+        pd.testing.assert_frame_equal(self.matrix.allocation('A007'), expected, check_dtype=False)
+        expected = self.results[self.results['Site'] == 'S004'].groupby('Article')[values].sum()
+        pd.testing.assert_frame_equal(self.matrix.site_row('S004'), expected, check_dtype=False)
+        self.assertTrue(self.matrix.allocation('missing').empty)
+
+    def test_empty_selection_pivot(self):
+        pivot = self.matrix.select(group='missing').pivot('Net Demand')
+        self.assertTrue(pivot.empty)
+        self.assertEqual((pivot.index.name, pivot.columns.name), ('Site', 'Article'))
+        expected = self.results[self.results['Group No.'] == 'missing'].pivot_table(
+            index='Site', columns='Article', values='Net Demand', aggfunc='sum')
+        pd.testing.assert_frame_equal(pivot, expected, check_dtype=False, check_index_type=False,
+                                      check_column_type=False)
+
+    def test_built_once_per_run(self):
+        store = SessionStore()
+        build = mock.Mock(side_effect=lambda results, _: SiteArticleMatrix.from_results(results))
+        store.set_results('s1', self.results, pd.DataFrame())
+        first = store.site_article_matrix('s1', build)
+        self.assertIs(store.site_article_matrix('s1', build), first)
+        store.set_results('s1', self.results.copy(), pd.DataFrame())
+        self.assertIsNot(store.site_article_matrix('s1', build), first)
+        self.assertEqual(build.call_count, 2)
+
+
+class TestOutOfCore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.files = TestMultipleFileA()
+        self.files.setUp()
+        self.file_a = pd.concat([self.files.hk, self.files.mo.iloc[:1]], ignore_index=True)
+
+    def run_out_of_core(self, path, **kwargs):
+        self.files.file_b.seek(0)
+        output = os.path.join(self.tmp.name, 'results.parquet')
+        rows, summary = calculate_demand_out_of_core(stream_merged(path, self.files.file_b, batch_rows=2), 2.5,
+                                                     output, work_dir=self.tmp.name, **kwargs)
+        return rows, pd.read_parquet(output), summary
+
+    def test_matches_pandas_path(self):
+        df_merged, _ = load_data(self.files.workbook(self.file_a), self.files.file_b)
+        expected, expected_summary = calculate_demand(df_merged, 2.5)
+        expected_summary = expected_summary.sort_values(['Group No.', 'SKU'], kind='stable').reset_index(drop=True)
+
+        csv_path = os.path.join(self.tmp.name, 'file_a.csv')
+        parquet_path = os.path.join(self.tmp.name, 'file_a.parquet')
+        self.file_a.to_csv(csv_path, index=False)
+        self.file_a.to_parquet(parquet_path, index=False)
+        for path in (csv_path, parquet_path):
+            rows, results, summary = self.run_out_of_core(path, num_buckets=3)
+            self.assertEqual(rows, len(expected))
+            pd.testing.assert_frame_equal(results, expected, check_dtype=False)
+            pd.testing.assert_frame_equal(summary, expected_summary, check_dtype=False)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['file_a.csv', 'file_a.parquet', 'results.parquet'])
+
+    def test_missing_column_rejected(self):
+        csv_path = os.path.join(self.tmp.name, 'file_a.csv')
+        self.file_a.drop(columns='MOQ').to_csv(csv_path, index=False)
+        with self.assertRaises(ValueError):
+            self.run_out_of_core(csv_path)
+
+
+class TestCampaigns(unittest.TestCase):
+
+    def setUp(self):
+        merged = make_merged_frame(800, seed=5)
+        self.df_a = merged[['Article', 'Site', 'RP Type', 'MOQ', 'SaSa Net Stock', 'Pending Received', 'Safety Stock',
+                            'Last Month Sold Qty', 'Supply source', 'Notes']].drop_duplicates(['Article', 'Site'])
+        rng = np.random.default_rng(5)
+        articles = sorted(self.df_a['Article'].unique())
+        sites = sorted(self.df_a['Site'].unique())
+        self.campaigns = []
+        for k in range(3):
+            campaign_articles = articles[:24 + 4 * k]
+            df_b1 = pd.DataFrame({
+                'Article': campaign_articles,
+                'Group No.': [f'G{i % (4 + k)}' for i in range(len(campaign_articles))],
+                'SKU Target': rng.integers(0, 300, len(campaign_articles)),
+                'Target Type': rng.choice(['HK', 'MO', 'ALL'], len(campaign_articles)),
+                'Target Cover Days': rng.integers(0, 14, len(campaign_articles)),
+            })
+            df_b2 = pd.DataFrame({'Site': sites, **{f'Shop Target({region})': rng.random(len(sites)).round(3)
+                                                    for region in ('HK', 'MO', 'ALL')}})
+            self.campaigns.append((f'Campaign {k}', df_b1, df_b2))
+
+    def test_matches_separate_runs(self):
+        results, summary = calculate_campaigns(stack_campaigns(self.df_a, self.campaigns), 2.5)
+        comparison = compare_campaigns(results, summary)
+        self.assertEqual(list(comparison['Campaign']), [label for label, _, _ in self.campaigns])
+        for label, df_b1, df_b2 in self.campaigns:
+            expected_results, expected_summary = calculate_demand(merge_data(self.df_a, df_b1, df_b2), 2.5)
+            campaign_results = results[results['Campaign'] == label].drop(columns='Campaign').reset_index(drop=True)
+            campaign_summary = summary[summary['Campaign'] == label].drop(columns='Campaign').reset_index(drop=True)
+            pd.testing.assert_frame_equal(campaign_results, expected_results)
+            pd.testing.assert_frame_equal(campaign_summary, expected_summary)
+
+            row = comparison.set_index('Campaign').loc[label]
+            self.assertEqual(row['Total_Dispatch'], expected_summary['Total_Dispatch'].sum())
+            shortfall = (expected_summary['Total_Dispatch'] - expected_summary['D001_SaSa_Net_Stock']).clip(lower=0)
+            self.assertEqual(row['D001_Shortfall'], shortfall.sum())
+            dn = expected_results[expected_results['Dispatch Type'] == '需生成 DN']
+            self.assertEqual(row['DN_Dispatch'], dn['Suggested Dispatch Qty'].sum())
+
+    def test_duplicate_names_rejected(self):
+        with self.assertRaises(ValueError):
+            stack_campaigns(self.df_a, self.campaigns[:1] * 2)
+
+    def test_comparison_job_loads_files(self):
+        from io import BytesIO
+
+        from app import run_campaign_comparison
+
+        def upload(content, name):
+            file = BytesIO(content)
+            file.name = name
+            return file
+
+        file_a, file_b = load_test.generate_workbooks(7, 120)
+        progress = []
+        result = run_campaign_comparison([upload(file_a, 'a.xlsx')], [upload(file_b, 'spring.xlsx'),
+                                                                      upload(file_b, 'summer.xlsx')], 2.5,
+                                         progress_callback=lambda value, message: progress.append(value))
+        self.assertEqual(list(result['comparison']['Campaign']), ['spring', 'summer'])
+        self.assertEqual(result['notices'], [])
+        self.assertEqual(progress, sorted(progress))
+        self.assertLessEqual(progress[-1], 100)
+
+        bad = BytesIO()
+        pd.DataFrame({'x': [1]}).to_excel(bad, index=False)
+        with self.assertRaisesRegex(ValueError, 'Sheet1'):
+            run_campaign_comparison([upload(file_a, 'a.xlsx')], [upload(bad.getvalue(), 'bad.xlsx')], 2.5)
+
+
+class TestDispatchFiles(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results, _ = calculate_demand(make_merged_frame(1500, seed=4), 2.5)
+        cls.results['Description p. group'] = 'P' + cls.results['Article'].str[-1]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_executor()
+
+    def read_zip(self, **kwargs):
+        buffer = io.BytesIO()
+        manifest = write_dispatch_zip(self.results, buffer, **kwargs)
+        with zipfile.ZipFile(buffer) as archive:
+            return manifest, {name: archive.read(name) for name in archive.namelist()}
+
+    def test_archive_spooled_to_disk(self):
+        _, expected = self.read_zip(fmt='csv')
+        with build_dispatch_archive(self.results, fmt='csv') as archive_file:
+            self.assertNotIsInstance(archive_file, io.BytesIO)
+            with zipfile.ZipFile(archive_file) as archive:
+                self.assertEqual({name: archive.read(name) for name in archive.namelist()}, expected)
+        self.assertTrue(archive_file.closed)
+
+        with zipfile.ZipFile(io.BytesIO(dispatch_archive_bytes(self.results, fmt='csv'))) as archive:
+            self.assertEqual({name: archive.read(name) for name in archive.namelist()}, expected)
+
+    def test_one_file_per_site_and_buyer_group(self):
+        files = plan_files(self.results)
+        dn = self.results[(self.results['Dispatch Type'] == '需生成 DN')
+                          & (self.results['Suggested Dispatch Qty'] > 0)]
+        dn_files = {recipient: rows for _, kind, recipient, rows in files if kind == 'DN'}
+        self.assertEqual(sorted(dn_files), sorted(dn['Site'].unique()))
+        for site, rows in dn_files.items():
+            self.assertEqual(sorted(self.results.index[rows]), sorted(dn.index[dn['Site'] == site]))
+        buyer_rows = np.concatenate([rows for _, kind, _, rows in files if kind == 'PO'])
+        self.assertTrue((self.results['Dispatch Type'].iloc[buyer_rows] == 'Buyer需要訂貨').all())
+
+    def test_zip_contents_and_manifest(self):
+        manifest, contents = self.read_zip(fmt='csv')
+        self.assertEqual(sorted(contents), sorted(list(manifest['file']) + ['manifest.csv']))
+        for row in manifest.itertuples():
+            df = pd.read_csv(io.BytesIO(contents[row.file]), encoding='utf-8-sig', dtype={'Site': str})
+            self.assertEqual(len(df), row.rows)
+            self.assertEqual(df['Suggested Dispatch Qty'].sum(), row.total_qty)
+        self.assertEqual(len(pd.read_csv(io.BytesIO(contents['manifest.csv']), encoding='utf-8-sig')), len(manifest))
+        with self.assertRaises(ValueError):
+            self.read_zip(fmt='pdf')
+
+    def test_parallel_matches_sequential(self):
+        expected_manifest, expected = self.read_zip(fmt='csv', max_workers=1)
+        with mock.patch.object(Config, 'BULK_EXPORT_PARALLEL_MIN_FILES', 0), \
+                mock.patch.object(Config, 'BULK_EXPORT_BATCH_FILES', 4):
+            manifest, contents = self.read_zip(fmt='csv', max_workers=2)
+        pd.testing.assert_frame_equal(manifest, expected_manifest)
+        self.assertEqual(contents, expected)
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_sessions_complete_full_flow(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp.name)
+        with mock.patch.object(Config, 'RUN_STORE_ENABLED', False):
+            report = load_test.run_level(2, num_rows=80, seed=3)
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['completed'], 2)
+        self.assertEqual(list(report['steps'].index[:3]), ['open', 'upload', 'analyze'])
+        self.assertEqual(report['steps'].loc['export', 'count'], 2)
+        self.assertEqual(report['steps'].loc['download', 'count'], 2)
+        self.assertGreater(report['sessions_per_minute'], 0)
+        # 重新執行按會話輪流進行，延遲包含等待其他會話的時間，但不會超過總延遲
+        self.assertGreaterEqual(report['rerun_wait_p95'], 0)
+        self.assertLessEqual(report['rerun_wait_p95'], report['rerun_p95'])
+        # 匯出檔案在點擊下載時才生成，渲染匯出區塊不會調用 export_to_excel
+        self.assertTrue({'page', 'visualization', 'results_grid', 'export'} <= set(report['sections'].index))
+        self.assertLess(report['sections'].loc['export', 'mean'], report['sections'].loc['page', 'mean'])
+
+
+class TestFragmentReruns(unittest.TestCase):
+    """選擇圖表組別只重新執行 visualization_panel，表格及匯出區塊不會重建。"""
+
+    def setUp(self):
+        import streamlit as st
+        from streamlit.testing.v1 import AppTest
+
+        # 伺服器共用的資源 (例如銷售歷史庫) 快取於進程內，可能指向其他測試已刪除的臨時目錄
+        st.cache_resource.clear()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp.name)
+        patcher = mock.patch.object(Config, 'RUN_STORE_ENABLED', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        metrics.disable()
+        self.registry = metrics.enable()
+        self.addCleanup(metrics.disable)
+
+        file_a, file_b = load_test.generate_workbooks(5, 80)
+        self.at = AppTest.from_file(load_test.APP_PATH, default_timeout=60).run()
+        self.at.file_uploader[0].set_value(('file_a.xlsx', file_a, load_test.XLSX_MIME))
+        self.at.file_uploader[1].set_value(('file_b.xlsx', file_b, load_test.XLSX_MIME))
+        self.at.run()
+        load_test._wait_for_job(self.at, 'load_job_id', 60, [])
+        next(button for button in self.at.button if button.label == '開始分析').click().run()
+        load_test._wait_for_job(self.at, 'job_id', 60, [])
+
+    def section_runs(self):
+        snapshot = self.registry.snapshot()
+        snapshot = snapshot[snapshot['metric'] == f'{metrics.NAMESPACE}_section_duration_seconds']
+        return dict(zip(snapshot['labels'].str.removeprefix('section='), snapshot['value']))
+
+    def fragment_id(self, name):
+        for fragment_id, fragment in self.at._fragment_storage._fragments.items():
+            if any(getattr(value, '__name__', None) == name
+                   for value in inspect.getclosurevars(fragment).nonlocals.values()):
+                return fragment_id
+        self.fail(f"fragment {name} not registered")
+
+    def test_group_selector_reruns_only_visualization(self):
+        from streamlit.runtime.scriptrunner_utils.script_requests import RerunData
+        import streamlit.testing.v1.local_script_runner as local_script_runner
+
+        selector = next(box for box in self.at.selectbox if box.label == 'Select Group No. to analyze')
+        group = selector.options[-1]
+        selector.set_value(group)
+        before = self.section_runs()
+        # 瀏覽器在 fragment 內的元件改變時只請求該 fragment 的重新執行；AppTest 預設重新執行整個腳本
+        rerun = functools.partial(RerunData, fragment_id_queue=[self.fragment_id('visualization_panel')])
+        with mock.patch.object(local_script_runner, 'RerunData', rerun):
+            self.at.run()
+        after = self.section_runs()
+
+        self.assertFalse(self.at.exception)
+        self.assertEqual(next(box for box in self.at.selectbox if box.label == 'Select Group No. to analyze').value,
+                         group)
+        runs = {section: after[section] - before.get(section, 0) for section in after}
+        self.assertEqual(runs.pop('visualization'), 1)
+        self.assertEqual(set(runs.values()), {0}, runs)
+        self.assertTrue({'page', 'results_grid', 'export'} <= set(runs))
+
+        # 對照：整頁重新執行時所有區塊都會執行
+        self.at.run()
+        self.assertEqual(self.section_runs()['export'], after['export'] + 1)
+
+
+class TestDifferentialHarness(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_executor()
+
+    def assert_engine_matches(self, engine, cases):
+        report = check_engine(engine, cases=cases, seed=100)
+        failures = [f"seed={case['seed']}: {case['error']}" for case in report if not case['ok']]
+        self.assertFalse(failures, '\n'.join(failures))
+
+    def test_generated_inputs_cover_edge_cases(self):
+        df = pd.concat([generate_case(np.random.default_rng(seed), 300) for seed in range(5)])
+        self.assertTrue((df['Site'] == 'D001').any())
+        self.assertTrue((df['MOQ'] == 0).any())
+        self.assertEqual(set(df['RP Type']), {'RF', 'ND'})
+        self.assertTrue((df['Group No.'] == '').any())
+        self.assertTrue((df.groupby('Group No.')['Article'].nunique() > 1).any())
+
+    def test_current_engine_matches_reference(self):
+        self.assert_engine_matches('current', 5)
+
+    def test_parallel_engine_matches_reference(self):
+        self.assert_engine_matches('parallel', 2)
+
+    def test_delta_engine_matches_reference(self):
+        self.assert_engine_matches('delta', 5)
+
+    def test_out_of_core_engine_matches_reference(self):
+        self.assert_engine_matches('out_of_core', 5)
+
+    def test_out_of_core_promotes_batch_dtypes(self):
+        # seed 108：前一批的 Site Target % 全為整數，後一批含小數
+        report = check_engine('out_of_core', cases=1, seed=108)
+        self.assertTrue(report[0]['ok'], report[0]['error'])
+
+    def test_out_of_core_buckets_numeric_groups_across_batch_dtypes(self):
+        # seed 149：數值 Group No.，含未匹配行的批次為 float64、其餘批次為 int64
+        self.assertTrue(pd.api.types.is_float_dtype(generate_case(np.random.default_rng(149))['Group No.']))
+        report = check_engine('out_of_core', cases=1, seed=149)
+        self.assertTrue(report[0]['ok'], report[0]['error'])
+
+    def test_detects_mismatch(self):
+        def off_by_one(df, lead_time, rng):
+            def run():
+                results, summary = reference_calculate_demand(df, lead_time)
+                results['Suggested Dispatch Qty'] += 1
+                return results, summary
+            return run
+
+        report = check_engine(off_by_one, cases=1, seed=100)
+        self.assertFalse(report[0]['ok'])
+        self.assertIn('Suggested Dispatch Qty', report[0]['error'])
+
+    def test_engine_exception_recorded_per_case(self):
+        def crashes_on_first(df, lead_time, rng):
+            if len(df) == first_rows:
+                raise ValueError('engine exploded')
+            return lambda: reference_calculate_demand(df, lead_time)
+
+        first_rows = len(generate_case(np.random.default_rng(100)))
+        report = check_engine(crashes_on_first, cases=2, seed=100)
+        self.assertEqual([case['ok'] for case in report], [False, True])
+        self.assertTrue(report[0]['crashed'])
+        self.assertEqual(report[0]['seed'], 100)
+        self.assertIn('Traceback', report[0]['error'])
+        self.assertIn('engine exploded', report[0]['error'])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file